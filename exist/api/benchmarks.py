@@ -0,0 +1,43 @@
+"""
+Compare UserSerializer's compiled read path with plain DRF.
+
+    DJANGO_SETTINGS_MODULE=exist.settings python -m api.benchmarks [count]
+
+Objects are built in memory, so this times serialization only, not the
+database. `values` is the path the list endpoint takes.
+"""
+import sys
+import timeit
+
+import django
+
+
+def run(count=10000, repeat=5):
+    from rest_framework import serializers
+    from core.models import User
+    from .serializers import UserSerializer
+
+    class DRFUserSerializer(serializers.ModelSerializer):
+        class Meta:
+            model = User
+            fields = UserSerializer.Meta.fields
+
+    users = [User(id=i, username='user%d' % i) for i in range(count)]
+    rows = [dict((key, getattr(user, key)) for key in UserSerializer.values_fields()) for user in users]
+
+    cases = [
+        ('drf, instances', lambda: DRFUserSerializer(users, many=True).data),
+        ('compiled, instances', lambda: UserSerializer(users, many=True).data),
+        ('compiled, values', lambda: UserSerializer(rows, many=True).data),
+    ]
+    results = []
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=repeat))
+        results.append((name, best))
+        print("%-20s %8.1f ms  %8.0f objects/s" % (name, best * 1000, count / best))
+    return results
+
+
+if __name__ == '__main__':
+    django.setup()
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
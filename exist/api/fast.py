@@ -0,0 +1,131 @@
+"""
+Fast read paths for DRF serializers.
+
+FastReadMixin compiles a serializer class's readable fields into a plan
+once: for each output name, the values() key to read, how to read it off a
+model instance, and a converter (None when the value from the database
+already is its representation, as for char, integer, float and boolean
+fields). Representing an object is then one dict built from that plan.
+With many=True a queryset is read with .values(), so no model instances
+are created at all.
+
+Only fields whose representation depends on the value alone are
+supported; anything needing the instance, request or other objects
+(method fields, nested serializers, hyperlinks, files) is rejected when the
+plan is compiled.
+"""
+from operator import attrgetter
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.db.models.query import QuerySet, ValuesQuerySet
+from rest_framework import fields, relations, serializers
+from rest_framework.serializers import LIST_SERIALIZER_KWARGS
+
+# Representation is the value itself, for values from the database.
+IDENTITY_FIELDS = (fields.CharField, fields.IntegerField, fields.FloatField,
+                   fields.BooleanField, fields.NullBooleanField)
+
+# Representation depends on the value alone, but needs converting.
+CONVERTED_FIELDS = (fields.DecimalField, fields.DateTimeField, fields.DateField,
+                    fields.TimeField, fields.DurationField, fields.ChoiceField, fields.UUIDField)
+
+
+class FieldPlan(object):
+
+    def __init__(self, serializer_class):
+        self.steps = []
+        self.keys = []
+        getters = []
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            source = field.source_attrs
+            if field.source == '*' or not source:
+                raise ImproperlyConfigured("%s.%s can't be compiled: it reads the whole object"
+                                           % (serializer_class.__name__, name))
+            if isinstance(field, relations.PrimaryKeyRelatedField) and len(source) == 1:
+                getter = attrgetter(source[0] + '_id')
+                convert = None
+            elif isinstance(field, IDENTITY_FIELDS):
+                getter = attrgetter('.'.join(source))
+                convert = None
+            elif isinstance(field, CONVERTED_FIELDS):
+                getter = attrgetter('.'.join(source))
+                convert = field.to_representation
+            else:
+                raise ImproperlyConfigured("%s.%s can't be compiled: %s isn't supported"
+                                           % (serializer_class.__name__, name, type(field).__name__))
+            key = '__'.join(source)
+            self.steps.append((name, key, convert))
+            self.keys.append(key)
+            getters.append(getter)
+        self.getters = list(zip([name for name, _, _ in self.steps], getters,
+                                [convert for _, _, convert in self.steps]))
+
+    def from_row(self, row):
+        item = {}
+        for name, key, convert in self.steps:
+            value = row[key]
+            item[name] = value if convert is None or value is None else convert(value)
+        return item
+
+    def from_instance(self, instance):
+        item = {}
+        for name, getter, convert in self.getters:
+            try:
+                value = getter(instance)
+            except AttributeError:
+                # a null relation somewhere along the source
+                value = None
+            item[name] = value if convert is None or value is None else convert(value)
+        return item
+
+    def represent(self, obj):
+        return self.from_row(obj) if isinstance(obj, dict) else self.from_instance(obj)
+
+    def represent_many(self, objects):
+        if isinstance(objects, models.Manager):
+            objects = objects.all()
+        if isinstance(objects, QuerySet) and not isinstance(objects, ValuesQuerySet):
+            objects = objects.values(*self.keys)
+        from_row, from_instance = self.from_row, self.from_instance
+        return [from_row(obj) if isinstance(obj, dict) else from_instance(obj) for obj in objects]
+
+
+class FastListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        return self.child.field_plan().represent_many(data)
+
+
+class FastReadMixin(object):
+    """
+    Compiled representation for a (Model)Serializer; see the module
+    docstring. Accepts model instances, values() dicts and querysets.
+    Validation and saving are left to the serializer.
+    """
+
+    @classmethod
+    def field_plan(cls):
+        # compiled per class, not inherited by subclasses
+        plan = cls.__dict__.get('_field_plan')
+        if plan is None:
+            plan = cls._field_plan = FieldPlan(cls)
+        return plan
+
+    @classmethod
+    def values_fields(cls):
+        """
+        The values() keys the plan reads.
+        """
+        return list(cls.field_plan().keys)
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child': cls(*args, **kwargs)}
+        list_kwargs.update(dict((key, value) for key, value in kwargs.items() if key in LIST_SERIALIZER_KWARGS))
+        return FastListSerializer(*args, **list_kwargs)
+
+    def to_representation(self, instance):
+        return self.field_plan().represent(instance)
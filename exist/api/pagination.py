@@ -0,0 +1,31 @@
+from django.utils import six
+from rest_framework.pagination import CursorPagination
+
+
+class UsernameCursorPagination(CursorPagination):
+    """
+    Keyset pages over username (unique and indexed): each page is a
+    `username > last` range scan however deep into the list it is.
+    """
+    ordering = 'username'
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # CursorPagination reads self.page_size and never asks get_page_size
+        self.page_size = self.get_page_size(request)
+        return super(UsernameCursorPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def _get_position_from_instance(self, instance, ordering):
+        # pages may be values() rows as well as instances
+        if isinstance(instance, dict):
+            return six.text_type(instance[ordering[0].lstrip('-')])
+        return super(UsernameCursorPagination, self)._get_position_from_instance(instance, ordering)
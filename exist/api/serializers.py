@@ -1,7 +1,8 @@
 from rest_framework import serializers
 from core import models
+from .fast import FastReadMixin
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(FastReadMixin, serializers.ModelSerializer):
     
     class Meta:
         model = models.User
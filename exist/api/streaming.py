@@ -0,0 +1,54 @@
+"""
+Streaming JSON list responses.
+
+The queryset is read in keyset chunks (`key > last key seen`, ordered by
+key) and each chunk is serialized and written out before the next is
+fetched, so memory stays at one chunk however long the list is.
+
+Each chunk is its own short query rather than a fetch from one named
+(server-side) cursor like core.history.server_side_chunks uses: a named
+cursor only lives inside a transaction, which would stay open for as long
+as the client takes to read the response.
+"""
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+CHUNK_SIZE = 500
+
+
+def keyset_chunks(queryset, key, chunk_size=CHUNK_SIZE):
+    """
+    `queryset` in chunks of at most `chunk_size`, ordered by `key`, which
+    must be unique.
+    """
+    queryset = queryset.order_by(key)
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(**{key + '__gt': last})
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = getattr(chunk[-1], key) if not isinstance(chunk[-1], dict) else chunk[-1][key]
+
+
+def stream_json(queryset, serializer_class, key, chunk_size=CHUNK_SIZE):
+    """
+    A JSON array of every object in `queryset`, serialized with
+    `serializer_class`, written out a chunk at a time.
+    """
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    yield '['
+    first = True
+    for chunk in keyset_chunks(queryset, key, chunk_size):
+        rows = [encoder.encode(row) for row in serializer_class(chunk, many=True).data]
+        yield (',' if not first else '') + ','.join(rows)
+        first = False
+    yield ']'
+
+
+def streaming_json_response(queryset, serializer_class, key, chunk_size=CHUNK_SIZE):
+    return StreamingHttpResponse(stream_json(queryset, serializer_class, key, chunk_size),
+                                 content_type='application/json; charset=utf-8')
@@ -1,3 +1,204 @@
-from django.test import TestCase
+import datetime
+import decimal
+import json
 
-# Create your tests here.
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase
+from rest_framework import serializers
+
+from core.cache import get_cache, profile_stamp
+from core.models import Attribute, User, UserAttribute, UserAttributeData
+from .fast import FastReadMixin
+from .serializers import UserSerializer
+from .streaming import keyset_chunks
+
+
+class DRFUserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'trial', 'last_seen_activity', 'bio']
+
+
+class FastUserSerializer(FastReadMixin, DRFUserSerializer):
+    pass
+
+
+class Money(serializers.Serializer):
+    amount = serializers.DecimalField(max_digits=8, decimal_places=2)
+
+
+class FastMoney(FastReadMixin, Money):
+    pass
+
+
+class MethodSerializer(FastReadMixin, serializers.Serializer):
+    label = serializers.SerializerMethodField()
+
+
+class FastReadMixinTest(SimpleTestCase):
+    def setUp(self):
+        self.users = [
+            User(id=1, username='ann', trial=True, bio=None,
+                 last_seen_activity=datetime.datetime(2015, 9, 1, 12, 30)),
+            User(id=2, username='bob', trial=False, bio='hi', last_seen_activity=None),
+        ]
+
+    def test_matches_drf_for_instances(self):
+        expected = [dict(row) for row in DRFUserSerializer(self.users, many=True).data]
+        self.assertEqual(list(FastUserSerializer(self.users, many=True).data), expected)
+        self.assertEqual(dict(FastUserSerializer(self.users[0]).data), expected[0])
+
+    def test_matches_drf_for_values_rows(self):
+        expected = [dict(row) for row in DRFUserSerializer(self.users, many=True).data]
+        rows = [dict((key, getattr(user, key)) for key in FastUserSerializer.values_fields())
+                for user in self.users]
+        self.assertEqual(list(FastUserSerializer(rows, many=True).data), expected)
+
+    def test_converted_fields(self):
+        self.assertEqual(FastMoney({'amount': decimal.Decimal('1.5')}).data['amount'], '1.50')
+
+    def test_user_serializer_is_compiled(self):
+        self.assertEqual(UserSerializer.values_fields(), ['username'])
+
+    def test_rejects_fields_needing_the_object(self):
+        self.assertRaises(ImproperlyConfigured, MethodSerializer.field_plan)
+
+
+class UserListTest(TestCase):
+    def setUp(self):
+        for name in ('dan', 'ann', 'cat', 'bob', 'eve'):
+            User.objects.create(username=name, email='%s@example.com' % name)
+
+    def usernames(self, rows):
+        return [row['username'] for row in rows]
+
+    def test_pages_by_username(self):
+        response = self.client.get('/api/users/', {'page_size': 2})
+        self.assertEqual(self.usernames(response.data['results']), ['ann', 'bob'])
+        seen = []
+        url = '/api/users/?page_size=2'
+        while url:
+            data = self.client.get(url).data
+            seen.extend(self.usernames(data['results']))
+            url = data['next']
+        self.assertEqual(seen, ['ann', 'bob', 'cat', 'dan', 'eve'])
+
+    def test_page_size_is_bounded(self):
+        self.assertEqual(len(self.client.get('/api/users/', {'page_size': 0}).data['results']), 1)
+        self.assertEqual(len(self.client.get('/api/users/', {'page_size': 'x'}).data['results']), 5)
+
+    def test_stream(self):
+        response = self.client.get('/api/users/', {'stream': 1})
+        self.assertEqual(response.status_code, 200)
+        body = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(self.usernames(json.loads(body)), ['ann', 'bob', 'cat', 'dan', 'eve'])
+
+    def test_keyset_chunks(self):
+        chunks = list(keyset_chunks(User.objects.values('username'), 'username', chunk_size=2))
+        self.assertEqual([self.usernames(chunk) for chunk in chunks],
+                         [['ann', 'bob'], ['cat', 'dan'], ['eve']])
+        chunks = list(keyset_chunks(User.objects.all(), 'username', chunk_size=5))
+        self.assertEqual(len(chunks), 1)
+
+
+class SeriesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ann', private=False)
+        self.user.set_password('secret')
+        self.user.save()
+        self.steps = self.user_attribute('steps')
+        self.weight = self.user_attribute('weight', private=True)
+        for day, steps in ((1, 100), (3, 200), (8, 50)):
+            self.add(self.steps, datetime.date(2015, 6, day), steps)
+        self.add(self.weight, datetime.date(2015, 6, 1), 70)
+
+    def user_attribute(self, name, private=False):
+        attribute = Attribute.objects.create(name=name, label=name, value_type=Attribute.INTEGER)
+        return UserAttribute.objects.create(user=self.user, attribute=attribute, private=private)
+
+    def add(self, user_attribute, day, value):
+        UserAttributeData.objects.create(user_attribute=user_attribute, time=day,
+                                         value_type=Attribute.INTEGER, int_value=value)
+
+    def get(self, username='ann', **params):
+        params.setdefault('attributes', 'steps,weight')
+        params.setdefault('start', '2015-06-01')
+        params.setdefault('end', '2015-06-14')
+        return self.client.get('/api/users/%s/series/' % username, params)
+
+    def test_downsamples_to_the_resolution(self):
+        response = self.get(resolution='week')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['dates'], [datetime.date(2015, 6, 1), datetime.date(2015, 6, 8)])
+        self.assertEqual(response.data['values'], {'steps': [300.0, 50.0]})
+
+        response = self.get()
+        self.assertEqual(len(response.data['dates']), 3)
+        self.assertEqual(response.data['values']['steps'], [100.0, 200.0, 50.0])
+
+    def test_private_attributes_are_only_for_the_owner(self):
+        self.assertNotIn('weight', self.get().data['values'])
+        self.assertTrue(self.client.login(username='ann', password='secret'))
+        self.assertEqual(self.get().data['values']['weight'], [70.0, None, None])
+
+    def test_private_users_are_hidden(self):
+        User.objects.filter(pk=self.user.pk).update(private=True)
+        self.assertEqual(self.get().status_code, 404)
+        self.assertTrue(self.client.login(username='ann', password='secret'))
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_unknown_user(self):
+        self.assertEqual(self.get(username='nobody').status_code, 404)
+
+    def test_validates_params(self):
+        self.assertEqual(self.get(attributes='').status_code, 400)
+        self.assertEqual(self.get(resolution='fortnight').status_code, 400)
+        self.assertEqual(self.get(start='June').status_code, 400)
+        self.assertEqual(self.get(start='2015-02-30').status_code, 400)
+        self.assertEqual(self.get(start='2015-07-01').status_code, 400)
+
+
+class ProfileRetrieveTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='ann', email='ann@example.com')
+
+    def test_unknown_users_get_no_stamp(self):
+        self.assertIsNone(profile_stamp('nobody'))
+        self.assertEqual(self.client.get('/api/users/nobody/').status_code, 404)
+
+    def test_conditional_requests(self):
+        response = self.client.get('/api/users/ann/')
+        self.assertEqual(response.status_code, 200)
+        etag, modified = response['ETag'], response['Last-Modified']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/users/ann/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get('/api/users/ann/', HTTP_IF_MODIFIED_SINCE=modified).status_code, 304)
+
+        # changed within the same second as the copy the client has
+        self.user.save()
+        self.assertEqual(self.client.get('/api/users/ann/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get('/api/users/ann/', HTTP_IF_MODIFIED_SINCE=modified).status_code, 200)
+
+    def test_stamps_move_on_by_a_second(self):
+        stamp = profile_stamp('ann')
+        self.assertEqual(stamp, self.user.profile_modified)
+        self.assertEqual(stamp % 1000, 0)
+        # a copy loaded before another save still moves the stamp on
+        stale = User.objects.get(pk=self.user.pk)
+        self.user.save()
+        stale.save()
+        self.assertGreaterEqual(profile_stamp('ann'), stamp + 2000)
+
+    def test_saving_other_fields_keeps_the_stamp(self):
+        stamp = profile_stamp('ann')
+        self.user.bio = 'hi'
+        self.user.save(update_fields=['bio'])
+        self.assertEqual(profile_stamp('ann'), stamp)
+
+    def test_rename(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.username = 'bob'
+        user.save()
+        self.assertEqual(self.client.get('/api/users/ann/').status_code, 404)
+        self.assertEqual(self.client.get('/api/users/bob/').status_code, 200)
@@ -1,8 +1,10 @@
 from django.conf.urls import url, include
 from rest_framework import routers
-from .views import UserViewSet
+from .views import InstrumentationView, UserViewSet
 
 router = routers.SimpleRouter()
 router.register(r'users', UserViewSet, base_name='user')
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    url(r'^instrumentation/$', InstrumentationView.as_view(), name='instrumentation'),
+]
@@ -1,18 +1,151 @@
-from core.models import User
+import datetime
+import os
+
+from core import logbuffer
+from core.cache import get_cache, profile_stamp
+from core.db import pool
+from core.models import User, UserAttribute, UserAttributeData
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from .pagination import UsernameCursorPagination
 from .serializers import UserSerializer
-from rest_framework import viewsets
+from .streaming import streaming_json_response
+from exist import threadpool
+from rest_framework import permissions, viewsets
+from rest_framework.decorators import detail_route
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
 class UserViewSet(viewsets.ViewSet):
-    
+
+    def perform_authentication(self, request):
+        # A profile retrieve authenticates when request.user is first used
+        # (it never is) rather than up front, so conditional requests don't
+        # load a session user. Everything else authenticates as usual.
+        if self.action != 'retrieve':
+            super(UserViewSet, self).perform_authentication(request)
+
     def list(self, request):
-        queryset = User.objects.all()
-        serializer = UserSerializer(queryset, many=True)
-        return Response(serializer.data)
+        """
+        Users by username, a page at a time (?cursor= from `next`), or with
+        ?stream=1 the whole list as one JSON array, streamed.
+        """
+        # rows for the serializer's compiled plan, plus the paging key
+        fields = UserSerializer.values_fields()
+        queryset = User.objects.values(*(fields if 'username' in fields else ['username'] + fields))
+        if request.query_params.get('stream'):
+            return streaming_json_response(queryset, UserSerializer, 'username')
+        paginator = UsernameCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = UserSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     def retrieve(self, request, pk=None):
-        queryset = User.objects.all()
+        """
+        A user's profile, with an ETag and Last-Modified from the profile's
+        stamp (see core.cache.profile_stamp). A matching If-None-Match or
+        If-Modified-Since gets a 304 from the stamp alone, and the rendered
+        body is cached per stamp in the shared cache.
+        """
+        stamp = profile_stamp(pk)
+        if stamp is None:
+            raise Http404
+        tag = '%s-%x' % (pk, stamp)
+
+        if self._not_modified(request, tag, stamp):
+            response = HttpResponse(status=304)
+        else:
+            cache = get_cache()
+            key = 'users:profile:%s:%s' % (pk, stamp)
+            content = cache.get(key)
+            if content is None:
+                user = get_object_or_404(User, username=pk)
+                content = JSONRenderer().render(UserSerializer(user).data)
+                cache.set(key, content, getattr(settings, 'ATTRIBUTE_CACHE_TIMEOUT', 3600))
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = quote_etag(tag)
+        response['Last-Modified'] = http_date(stamp // 1000)
+        return response
+
+    def _not_modified(self, request, tag, stamp):
+        # the ETag is exact; If-Modified-Since only has whole seconds, which
+        # is as fine as stamps go
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return tag in parse_etags(if_none_match)
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return if_modified_since is not None and stamp <= if_modified_since * 1000
+
+    @detail_route(methods=['get'])
+    def series(self, request, pk=None):
+        """
+        Attribute values over a date range, downsampled in the database.
+
+        ?attributes=steps,sleep&start=2015-01-01&end=2015-12-31&resolution=week
+
+        Returns one `dates` array and a values array per attribute, lined up
+        with it. Defaults to the last 30 days at day resolution. A private
+        user's series is only there for themselves.
+        """
         user = get_object_or_404(User, username=pk)
-        serializer = UserSerializer(user)
-        return Response(serializer.data)
+        if user.private and request.user != user:
+            raise Http404
+
+        names = [n for n in request.query_params.get('attributes', '').split(',') if n]
+        if not names:
+            raise ParseError("attributes is required")
+        resolution = request.query_params.get('resolution', 'day')
+        if resolution not in UserAttributeData.objects.RESOLUTIONS:
+            raise ParseError("resolution must be one of %s" % ", ".join(UserAttributeData.objects.RESOLUTIONS))
+        end = self._date_param(request, 'end', datetime.date.today())
+        start = self._date_param(request, 'start', end - datetime.timedelta(days=30))
+        if start > end:
+            raise ParseError("start must not be after end")
+
+        user_attributes = UserAttribute.objects.filter(user=user, attribute__name__in=names)
+        if request.user != user:
+            user_attributes = user_attributes.filter(private=False)
+        names_by_id = dict(user_attributes.values_list('id', 'attribute__name'))
+
+        dates, columns = UserAttributeData.objects.series(list(names_by_id), start, end, resolution)
+        return Response({
+            'resolution': resolution,
+            'start': start,
+            'end': end,
+            'dates': dates,
+            'values': dict((names_by_id[ua_id], values) for ua_id, values in columns.items()),
+        })
+
+    def _date_param(self, request, name, default):
+        value = request.query_params.get(name)
+        if not value:
+            return default
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise ParseError("%s must be a date (YYYY-MM-DD)" % name)
+        return date
+
+
+class InstrumentationView(APIView):
+    """
+    Runtime counters for the process that answers: database connection
+    pools, the request thread pool and the UserLog buffer. Staff only.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        buffer = logbuffer.get_buffer()
+        return Response({
+            'pid': os.getpid(),
+            'database_pools': pool.stats(),
+            'thread_pool': threadpool.stats(),
+            'userlog_buffer': buffer.stats() if buffer is not None else None,
+        })
@@ -0,0 +1,139 @@
+"""
+Per-user caching for UserAttributeManager views.
+
+Cached results are keyed by two version stamps: one per user, bumped when
+any of their UserAttributes or data change, and a global one bumped when
+Attributes or AttributeGroups change. Bumping a stamp makes every old key
+unreachable, so nothing needs deleting.
+
+Stamps live in core_cacheversion rather than the cache, and are bumped in
+the same transaction as the change: other processes see the new stamp
+exactly when they can see the new rows, and a reader can't cache old rows
+under it. Each bump takes a fresh value from a sequence, so a rolled back
+bump is never reused either. Results are cached in settings.ATTRIBUTE_CACHE
+(a CACHES alias), which must be shared by every process.
+
+User profiles get a modification stamp of their own, a column on the user
+row bumped in the same transaction as the change, so the API can answer
+conditional requests from one indexed lookup instead of loading the user.
+"""
+import functools
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+from django.db.models.query import QuerySet
+
+GLOBAL_VERSION_KEY = 'attributes:version'
+USER_VERSION_KEY = 'attributes:version:%s'
+
+# User fields the API's profile shows (api.serializers.UserSerializer);
+# saving only other fields leaves the stamp alone
+PROFILE_FIELDS = frozenset(['username'])
+
+
+def get_cache():
+    return caches[getattr(settings, 'ATTRIBUTE_CACHE', 'default')]
+
+
+def is_shared():
+    """
+    Whether the cache results go in is seen by other processes, so warming
+    it from one (see core.jobs.refresh_latest) helps the rest.
+    """
+    return not isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def _bump(keys):
+    # sorted, so concurrent bumps of the same keys lock them in one order
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    cursor = connection.cursor()
+    cursor.execute("""
+                   INSERT INTO core_cacheversion (key, version)
+                   VALUES %s
+                   ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version
+                   """ % ", ".join(["(%s, nextval('core_cacheversion_seq'))"] * len(keys)), keys)
+
+
+def bump_user_version(user_id):
+    _bump([USER_VERSION_KEY % user_id])
+
+
+def bump_user_versions(user_ids):
+    _bump([USER_VERSION_KEY % user_id for user_id in user_ids])
+
+
+def bump_global_version():
+    _bump([GLOBAL_VERSION_KEY])
+
+
+def versions_for(keys):
+    """
+    The version stamps stored under `keys`, 0 for any never bumped.
+    """
+    from .models import CacheVersion
+    found = dict(CacheVersion.objects.filter(key__in=keys).values_list('key', 'version'))
+    return tuple(found.get(key, 0) for key in keys)
+
+
+def versions(user_id):
+    return versions_for([GLOBAL_VERSION_KEY, USER_VERSION_KEY % user_id])
+
+
+def global_version():
+    return versions_for([GLOBAL_VERSION_KEY])[0]
+
+
+def profile_stamp(username):
+    """
+    When `username`'s profile last changed, in milliseconds since the epoch
+    (always a whole second), or None if there's no such user.
+    """
+    from .models import User
+    return User.objects.filter(username=username).values_list('profile_modified', flat=True).first()
+
+
+def bump_profile_stamp(user):
+    # Stamps are times, but always move on by at least a second, or a
+    # client could keep a stale copy; done in the database so concurrent
+    # saves can't both land on the same stamp.
+    cursor = connection.cursor()
+    cursor.execute("""
+                   UPDATE core_user
+                   SET profile_modified = GREATEST(floor(extract(epoch FROM clock_timestamp())) * 1000,
+                                                   profile_modified + 1000)
+                   WHERE id = %s
+                   RETURNING profile_modified
+                   """, [user.pk])
+    row = cursor.fetchone()
+    if row is not None:
+        user.profile_modified = row[0]
+
+
+def cached_for_user(method):
+    """
+    Cache a UserAttributeManager method's result when it's called through a
+    user's related manager (user.attributes). Querysets are stored
+    evaluated, so the cached copy iterates without touching the database.
+    """
+    @functools.wraps(method)
+    def wrapper(manager):
+        from .models import User
+        user = getattr(manager, 'instance', None)
+        if not isinstance(user, User) or user.pk is None:
+            return method(manager)
+
+        cache = get_cache()
+        key = 'attributes:%s:%s:%s:%s' % ((method.__name__, user.pk) + versions(user.pk))
+        result = cache.get(key)
+        if result is None:
+            result = method(manager)
+            if isinstance(result, QuerySet):
+                len(result)
+            cache.set(key, result, getattr(settings, 'ATTRIBUTE_CACHE_TIMEOUT', 3600))
+        return result
+    return wrapper
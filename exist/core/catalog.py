@@ -0,0 +1,120 @@
+"""
+In-process catalog of the reference tables: Attribute, AttributeGroup,
+Service and which services provide which attributes.
+
+These rarely change, so each worker loads them once into an immutable
+snapshot and swaps in a fresh one when the global attribute version (see
+core.cache) moves. That version is kept in the database, so every process
+sees a change once it's committed. Workers check it at most every
+settings.CATALOG_POLL_INTERVAL seconds; changes made in this process are
+picked up straight away.
+
+The snapshot's instances are shared between threads, so attribute(),
+group() and services_for() hand out copies of them.
+"""
+import copy
+import threading
+import time
+from types import MappingProxyType
+
+from django.conf import settings
+
+from .cache import global_version
+
+_lock = threading.Lock()
+_catalog = None
+_checked = 0.0
+
+
+def _detached(instance):
+    # A shallow copy with its own _state, which saving would change. Not
+    # copy.copy(), whose pickling support writes to the shared instance.
+    clone = instance.__class__.__new__(instance.__class__)
+    clone.__dict__.update(instance.__dict__)
+    clone._state = copy.copy(instance._state)
+    return clone
+
+
+class Catalog(object):
+
+    def __init__(self, version):
+        from .models import Attribute, AttributeGroup, Service
+
+        self.version = version
+        groups = dict((g.pk, g) for g in AttributeGroup.objects.all())
+        attributes = {}
+        self.group_cache = Attribute._meta.get_field('group').get_cache_name()
+        for attribute in Attribute.objects.all():
+            # so attribute.group doesn't go back to the database
+            setattr(attribute, self.group_cache, groups.get(attribute.group_id))
+            attributes[attribute.pk] = attribute
+        services = dict((s.pk, s) for s in Service.objects.all())
+
+        provided_by = {}
+        for service_id, attribute_id in Service.attributes.through.objects.values_list('service_id', 'attribute_id'):
+            provided_by.setdefault(attribute_id, []).append(services[service_id])
+
+        self.groups = MappingProxyType(groups)
+        self.attributes = MappingProxyType(attributes)
+        self.attributes_by_name = MappingProxyType(dict((a.name, a) for a in attributes.values()))
+        self.services = MappingProxyType(services)
+        self.provided_by = MappingProxyType(dict(
+            (attribute_id, tuple(sorted(provided, key=lambda s: s.name)))
+            for attribute_id, provided in provided_by.items()))
+
+    def attribute(self, pk):
+        attribute = _detached(self.attributes[pk])
+        setattr(attribute, self.group_cache, self.group(attribute.group_id))
+        return attribute
+
+    def group(self, pk):
+        group = self.groups.get(pk)
+        return _detached(group) if group is not None else None
+
+    def services_for(self, attribute_id, service_ids=None):
+        """
+        Services providing an attribute, by name, optionally limited to `service_ids`.
+        """
+        services = self.provided_by.get(attribute_id, ())
+        if service_ids is not None:
+            services = [s for s in services if s.pk in service_ids]
+        return [_detached(s) for s in services]
+
+
+def get_catalog():
+    global _catalog, _checked
+    catalog = _catalog
+    now = time.time()
+    if catalog is not None and now - _checked < getattr(settings, 'CATALOG_POLL_INTERVAL', 30):
+        return catalog
+
+    with _lock:
+        version = global_version()
+        if _catalog is None or _catalog.version != version:
+            _catalog = Catalog(version)
+        _checked = now
+        return _catalog
+
+
+def invalidate():
+    """
+    Drop this process's catalog so the next access reloads it.
+    """
+    global _catalog
+    _catalog = None
+
+
+def attribute(pk):
+    """
+    An Attribute from the catalog, reloading once if it's newer than the
+    snapshot we have.
+    """
+    try:
+        return get_catalog().attribute(pk)
+    except KeyError:
+        invalidate()
+    try:
+        return get_catalog().attribute(pk)
+    except KeyError:
+        from .models import Attribute
+        raise Attribute.DoesNotExist("Attribute %s isn't in the catalog" % pk)
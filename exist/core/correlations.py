@@ -0,0 +1,170 @@
+"""
+Batch correlation engine.
+
+Loads a user's daily UserAttributeData into a dates x attributes NumPy
+matrix (see core.history) and computes Pearson and Spearman coefficients
+for every attribute pair at once, instead of looping pair-by-pair over ORM
+rows.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy import stats
+
+from .history import load_history
+from .models import Attribute, UserAttribute, User
+
+
+Correlation = namedtuple('Correlation', ['attribute', 'other', 'days',
+                                         'pearson', 'pearson_p',
+                                         'spearman', 'spearman_p'])
+
+MIN_DAYS = 30
+
+
+def load_user_matrix(user):
+    """
+    Returns (attributes, matrix) for a user's active, numeric attributes.
+
+    `attributes` is a list of (name, correlation_offset, correlation_priority)
+    tuples, one per column of `matrix`. `matrix` is a float64 array with one
+    row per day between the first and last recorded value; missing days are NaN.
+    """
+    history = load_history(user, UserAttribute.objects.filter(user=user, active=True)
+                           .exclude(attribute__value_type=Attribute.STRING).order_by('id'))
+    attributes = [(a.name, a.correlation_offset, a.correlation_priority) for _, a in history.attributes]
+    return attributes, history.matrix
+
+
+def apply_offsets(matrix, offsets):
+    """
+    Shift each column by its attribute's correlation_offset, so that row t of
+    a column with offset k holds the value recorded on day t + k.
+    """
+    shifted = np.full(matrix.shape, np.nan)
+    days = matrix.shape[0]
+    for j, k in enumerate(offsets):
+        if abs(k) >= days:
+            continue
+        if k >= 0:
+            shifted[:days - k, j] = matrix[k:, j]
+        else:
+            shifted[-k:, j] = matrix[:days + k, j]
+    return shifted
+
+
+def pairwise_pearson(matrix):
+    """
+    Pearson r for every pair of columns over the days both have a value.
+
+    Returns (r, n), two square arrays. Pairs with fewer than three common
+    days or no variance get NaN.
+    """
+    present = ~np.isnan(matrix)
+    mask = present.astype(np.float64)
+    # Centering first keeps the sums of squares small for large-valued
+    # attributes like steps; correlation is unaffected by the shift.
+    totals = np.where(present, matrix, 0.0).sum(axis=0)
+    means = totals / np.maximum(mask.sum(axis=0), 1)
+    centred = np.where(present, matrix - means, 0.0)
+
+    n = mask.T.dot(mask)
+    sx = centred.T.dot(mask)
+    sxx = (centred ** 2).T.dot(mask)
+    sxy = centred.T.dot(centred)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sx.T / n
+        var_x = sxx - sx ** 2 / n
+        var_y = var_x.T
+        r = cov / np.sqrt(var_x * var_y)
+    r[(n < 3) | ~np.isfinite(r)] = np.nan
+    return np.clip(r, -1.0, 1.0), n
+
+
+def pairwise_spearman(matrix):
+    """
+    Spearman's rho for every pair of columns: Pearson r of the pair's values
+    ranked over just the days both have one (average ranks for ties).
+
+    Returns (rho, n) like pairwise_pearson. Each pair needs its own ranking,
+    so this loops over pairs rather than doing them all in one product.
+    """
+    present = ~np.isnan(matrix)
+    mask = present.astype(np.float64)
+    n = mask.T.dot(mask)
+    columns = matrix.shape[1]
+    rho = np.full((columns, columns), np.nan)
+    for i in range(columns):
+        for j in range(i, columns):
+            both = present[:, i] & present[:, j]
+            if both.sum() < 3:
+                continue
+            x = stats.rankdata(matrix[both, i])
+            y = stats.rankdata(matrix[both, j])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                value = np.corrcoef(x, y)[0, 1]
+            if np.isfinite(value):
+                rho[i, j] = rho[j, i] = value
+    return np.clip(rho, -1.0, 1.0), n
+
+
+def p_values(r, n):
+    """
+    Two-sided p-values for an array of coefficients using the t distribution.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dof = n - 2
+        t = r * np.sqrt(dof / ((1.0 - r) * (1.0 + r)))
+        p = 2 * stats.t.sf(np.abs(t), dof)
+    p[np.abs(r) == 1.0] = 0.0
+    return p
+
+
+def correlate_matrix(matrix, offsets):
+    """
+    Pearson and Spearman coefficients (with p-values) for all column pairs
+    after applying each column's day offset. Returns (r, r_p, rho, rho_p, n).
+    """
+    shifted = apply_offsets(matrix, offsets)
+    r, n = pairwise_pearson(shifted)
+    rho, _ = pairwise_spearman(shifted)
+    return r, p_values(r, n), rho, p_values(rho, n), n
+
+
+def correlations_for_user(user, min_days=MIN_DAYS):
+    """
+    All attribute pair correlations for one user with at least `min_days`
+    days in common. Within a pair, `attribute` is the one with the higher
+    correlation_priority (the one everything else follows).
+    """
+    attributes, matrix = load_user_matrix(user)
+    if len(attributes) < 2 or matrix.shape[0] < min_days:
+        return []
+
+    offsets = [offset for _, offset, _ in attributes]
+    r, r_p, rho, rho_p, n = correlate_matrix(matrix, offsets)
+
+    result = []
+    rows, cols = np.triu_indices(len(attributes), k=1)
+    for i, j in zip(rows, cols):
+        if n[i, j] < min_days or np.isnan(r[i, j]):
+            continue
+        if attributes[j][2] > attributes[i][2]:
+            i, j = j, i
+        result.append(Correlation(attributes[i][0], attributes[j][0], int(n[i, j]),
+                                  float(r[i, j]), float(r_p[i, j]),
+                                  float(rho[i, j]), float(rho_p[i, j])))
+    result.sort(key=lambda c: abs(c.pearson), reverse=True)
+    return result
+
+
+def correlate_users(users=None, min_days=MIN_DAYS):
+    """
+    Generator of (user, correlations) for every active user, or the given
+    queryset. Only one user's matrix is held in memory at a time.
+    """
+    if users is None:
+        users = User.objects.filter(is_active=True)
+    for user in users.iterator():
+        yield user, correlations_for_user(user, min_days=min_days)
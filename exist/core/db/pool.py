@@ -0,0 +1,268 @@
+"""
+A thread-safe pool of psycopg2 connections, one per process and database.
+
+The `core.db.pooled` backend checks a connection out of here when Django
+connects and puts it back when Django closes it (at the end of every
+request with CONN_MAX_AGE = 0), so requests stop paying for a new Postgres
+connection each time.
+
+Options (the database's POOL setting):
+    MIN_SIZE            connections kept open even when idle
+    MAX_SIZE            connections open at once; further checkouts wait
+    CHECKOUT_TIMEOUT    seconds to wait for one before giving up
+    MAX_LIFETIME        seconds before a connection is replaced
+    MAX_IDLE            seconds an idle connection above MIN_SIZE is kept
+    HEALTH_CHECK_AFTER  connections idle longer than this are tested with
+                        SELECT 1 on checkout (0 tests every checkout)
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+DEFAULTS = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 12,
+    'CHECKOUT_TIMEOUT': 10.0,
+    'MAX_LIFETIME': 60 * 60,
+    'MAX_IDLE': 5 * 60,
+    'HEALTH_CHECK_AFTER': 5.0,
+}
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """
+    No connection became free within the checkout timeout. An
+    OperationalError, so Django reports it as django.db.OperationalError.
+    """
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, min_size=1, max_size=12, checkout_timeout=10.0, max_lifetime=3600,
+                 max_idle=300, health_check_after=5.0, params=None):
+        self.connect = connect
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+
+        self.condition = threading.Condition()
+        # (connection, created, returned), most recently returned last
+        self.idle = deque()
+        self.created_at = {}
+        self.size = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.closed = False
+
+    def getconn(self):
+        deadline = time.time() + self.checkout_timeout
+        waited = None
+        with self.condition:
+            while True:
+                if self.idle:
+                    connection, created, returned = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("No database connection free after %.1f seconds (%d in use)"
+                                      % (self.checkout_timeout, self.size))
+                if waited is None:
+                    waited = time.time()
+                    self.waits += 1
+                self.condition.wait(remaining)
+            if waited is not None:
+                self.wait_time += time.time() - waited
+            self.checkouts += 1
+
+        if connection is not None and not self._usable(connection, created, returned):
+            self._discard(connection, reserve=True)
+            connection = None
+        if connection is None:
+            try:
+                connection = self._create()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                raise
+        return connection
+
+    def putconn(self, connection):
+        now = time.time()
+        created = self.created_at.get(id(connection), now)
+        if self.closed or connection.closed or now - created > self.max_lifetime or not self._reset(connection):
+            self._discard(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, created, now))
+            self.condition.notify()
+        self._prune()
+
+    def _create(self):
+        connection = self.connect()
+        self.created_at[id(connection)] = time.time()
+        with self.condition:
+            self.created += 1
+        return connection
+
+    def _usable(self, connection, created, returned):
+        now = time.time()
+        if connection.closed or now - created > self.max_lifetime:
+            return False
+        if now - returned < self.health_check_after:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _reset(self, connection):
+        # back to no transaction, or it isn't fit to hand out again
+        try:
+            if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return connection.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+
+    def _discard(self, connection, reserve=False):
+        """
+        Close a connection. With `reserve` its slot is kept for a
+        replacement the caller is about to open.
+        """
+        self.created_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self.condition:
+            self.discarded += 1
+            if not reserve:
+                self.size -= 1
+                self.condition.notify()
+
+    def _prune(self):
+        # close connections idle too long, oldest first, down to MIN_SIZE
+        now = time.time()
+        expired = []
+        with self.condition:
+            while self.idle and self.size - len(expired) > self.min_size and now - self.idle[0][2] > self.max_idle:
+                expired.append(self.idle.popleft()[0])
+        for connection in expired:
+            self._discard(connection)
+
+    def fill(self):
+        """
+        Open connections until MIN_SIZE are open.
+        """
+        while True:
+            with self.condition:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                connection = self._create()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                raise
+            self.putconn(connection)
+
+    def close(self):
+        """
+        Close the idle connections; ones checked out are closed as they
+        come back.
+        """
+        with self.condition:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': self.size,
+                'active': self.size - len(self.idle),
+                'idle': len(self.idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+                'created': self.created,
+                'discarded': self.discarded,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options, connect, params=None):
+    """
+    This process's pool for database `alias`, created on first use from
+    `options` (the POOL setting) and the `connect` callable. `params`
+    identifies what `connect` connects to: when it changes (eg. the test
+    runner switching NAME to the test database) the old pool is closed and
+    a new one made. Pools from a parent process are never reused after a
+    fork.
+    """
+    key = (os.getpid(), alias)
+    pool = _pools.get(key)
+    if pool is None or pool.params != params:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is not None and pool.params != params:
+                pool.close()
+                pool = None
+            if pool is None:
+                options = dict(DEFAULTS, **(options or {}))
+                pool = _pools[key] = ConnectionPool(
+                    connect, min_size=options['MIN_SIZE'], max_size=options['MAX_SIZE'],
+                    checkout_timeout=options['CHECKOUT_TIMEOUT'], max_lifetime=options['MAX_LIFETIME'],
+                    max_idle=options['MAX_IDLE'], health_check_after=options['HEALTH_CHECK_AFTER'],
+                    params=params)
+    return pool
+
+
+def close_pools(alias=None):
+    """
+    Close and forget this process's pools, or just the one for `alias`, so
+    nothing keeps a connection to the database open (eg. before the test
+    runner drops it).
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        for key in list(_pools):
+            if key[0] == pid and (alias is None or key[1] == alias):
+                _pools.pop(key).close()
+
+
+def stats():
+    """
+    Stats for this process's pools, by database alias.
+    """
+    pid = os.getpid()
+    return dict((alias, pool.stats()) for (owner, alias), pool in list(_pools.items()) if owner == pid)
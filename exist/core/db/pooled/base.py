@@ -0,0 +1,67 @@
+"""
+postgresql_psycopg2 with pooled connections (see core.db.pool).
+
+    DATABASES = {'default': {'ENGINE': 'core.db.pooled', ..., 'CONN_MAX_AGE': 0,
+                             'POOL': {'MIN_SIZE': 1, 'MAX_SIZE': 12}}}
+
+Connecting checks a connection out of the process's pool and closing puts
+it back, so keep CONN_MAX_AGE at 0: connections go back to the pool at
+the end of each request instead of staying with one thread.
+
+A pool belongs to one set of connection parameters; when they change, as
+when the test runner points NAME at the test database, the old pool is
+closed. The connection Django makes to the 'postgres' database for
+creating and dropping test databases isn't pooled.
+"""
+from django.db.backends.postgresql_psycopg2 import base
+from django.db.backends.postgresql_psycopg2.base import Database
+from django.db.backends.base.base import NO_DB_ALIAS
+
+from .. import pool
+from .creation import DatabaseCreation
+
+# the isolation level of new connections, by database alias
+isolation_levels = {}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.creation = DatabaseCreation(self)
+        # the pool the open connection came from, to go back to
+        self.pool = None
+
+    def get_pool(self, conn_params=None):
+        options = self.settings_dict['OPTIONS']
+        if conn_params is None:
+            conn_params = self.get_connection_params()
+
+        def connect():
+            connection = Database.connect(**conn_params)
+            if 'isolation_level' in options and options['isolation_level'] != connection.isolation_level:
+                connection.set_session(isolation_level=options['isolation_level'])
+            # every connection in the pool starts out with the same level;
+            # note it before autocommit changes what psycopg2 reports
+            isolation_levels.setdefault(self.alias, connection.isolation_level)
+            return connection
+
+        return pool.get_pool(self.alias, self.settings_dict.get('POOL'), connect,
+                             params=tuple(sorted(conn_params.items())))
+
+    def get_new_connection(self, conn_params):
+        if self.alias == NO_DB_ALIAS:
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+        self.pool = self.get_pool(conn_params)
+        connection = self.pool.getconn()
+        self.isolation_level = isolation_levels.get(self.alias, connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.pool is None:
+            return super(DatabaseWrapper, self)._close()
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection)
+            self.pool = None
+
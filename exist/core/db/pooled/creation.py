@@ -0,0 +1,18 @@
+from django.db.backends.postgresql_psycopg2 import creation
+
+from .. import pool
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    """
+    Closes the pool around creating and dropping the test database, since
+    Postgres won't drop a database anything is still connected to.
+    """
+
+    def _create_test_db(self, verbosity, autoclobber, keepdb=False):
+        pool.close_pools(self.connection.alias)
+        return super(DatabaseCreation, self)._create_test_db(verbosity, autoclobber, keepdb)
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        pool.close_pools(self.connection.alias)
+        return super(DatabaseCreation, self)._destroy_test_db(test_database_name, verbosity)
@@ -0,0 +1,119 @@
+"""
+Dense dates x attributes history matrices for analytics.
+
+Rows come straight off a server-side (named) cursor as plain numbers
+(column index, day number, float value) and are written into a
+preallocated array a chunk at a time, so no model instances or Decimals
+are created and only one chunk of rows is held alongside the matrix.
+"""
+import datetime
+import itertools
+from collections import namedtuple
+
+import numpy as np
+from django.db import connection, transaction
+
+from . import catalog
+from .models import Attribute, UserAttribute
+
+# Histories longer than this keep only their most recent days.
+MAX_DAYS = 366 * 10
+
+CHUNK_SIZE = 5000
+
+_cursor_names = itertools.count()
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+class History(namedtuple('History', ['start', 'attributes', 'matrix'])):
+    """
+    `matrix` has one row per day from `start`, one column per entry in
+    `attributes` (a list of (user_attribute_id, Attribute)), and NaN for
+    days without a value.
+    """
+
+    @property
+    def dates(self):
+        start = np.datetime64(self.start) if self.start is not None else np.datetime64(EPOCH)
+        return start + np.arange(self.matrix.shape[0])
+
+    def column(self, name):
+        for i, (_, attribute) in enumerate(self.attributes):
+            if attribute.name == name:
+                return self.matrix[:, i]
+        raise KeyError(name)
+
+
+def load_history(user, user_attributes=None, start=None, end=None, max_days=MAX_DAYS, dtype=np.float64):
+    """
+    A user's numeric attribute history as a History. `user_attributes`
+    narrows the columns (a queryset or list of ids); by default it's all of
+    the user's non-string attributes, in id order.
+    """
+    if user_attributes is None:
+        user_attributes = UserAttribute.objects.filter(user=user).exclude(
+            attribute__value_type=Attribute.STRING).order_by('id')
+    if hasattr(user_attributes, 'values_list'):
+        columns = list(user_attributes.values_list('id', 'attribute_id'))
+    else:
+        columns = list(UserAttribute.objects.filter(id__in=user_attributes).order_by('id')
+                       .values_list('id', 'attribute_id'))
+    attributes = [(ua_id, catalog.attribute(attribute_id)) for ua_id, attribute_id in columns]
+    if not columns:
+        return History(start, attributes, np.empty((0, 0), dtype=dtype))
+
+    ids = [ua_id for ua_id, _ in columns]
+    conditions = ["user_attribute_id = ANY(%(ids)s)", "COALESCE(float_value, int_value) IS NOT NULL"]
+    if start is not None:
+        conditions.append("time >= %(start)s")
+    if end is not None:
+        conditions.append("time <= %(end)s")
+    if max_days and start is None:
+        conditions.append("""time > (SELECT MAX(time) FROM core_userattributedata
+                                     WHERE user_attribute_id = ANY(%(ids)s)
+                                     AND (%(end)s::date IS NULL OR time <= %(end)s::date)) - %(max_days)s""")
+
+    matrix = None
+    first = None
+    for rows in server_side_chunks("""
+                                   SELECT array_position(%%(ids)s, user_attribute_id) - 1,
+                                          time - DATE '1970-01-01',
+                                          COALESCE(float_value, int_value)::float8,
+                                          MIN(time - DATE '1970-01-01') OVER (),
+                                          MAX(time - DATE '1970-01-01') OVER ()
+                                   FROM core_userattributedata
+                                   WHERE %s
+                                   """ % " AND ".join(conditions),
+                                   {'ids': ids, 'start': start, 'end': end, 'max_days': max_days}):
+        chunk = np.array(rows, dtype=np.float64)
+        if matrix is None:
+            first = int(chunk[0, 3]) if start is None else (start - EPOCH).days
+            last = int(chunk[0, 4]) if end is None else (end - EPOCH).days
+            matrix = np.full((last - first + 1, len(columns)), np.nan, dtype=dtype)
+        matrix[chunk[:, 1].astype(np.intp) - first, chunk[:, 0].astype(np.intp)] = chunk[:, 2]
+
+    if matrix is None:
+        return History(start, attributes, np.empty((0, len(columns)), dtype=dtype))
+    return History(EPOCH + datetime.timedelta(days=first), attributes, matrix)
+
+
+def server_side_chunks(sql, params, size=None):
+    """
+    The rows of a query, `size` (default CHUNK_SIZE) at a time, from a named
+    cursor so the rest stay on the server. Named cursors only live inside a
+    transaction, so this runs in one.
+    """
+    with transaction.atomic():
+        connection.ensure_connection()
+        with connection.wrap_database_errors:
+            cursor = connection.connection.cursor(name='history_%d' % next(_cursor_names))
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(size or CHUNK_SIZE)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                cursor.close()
@@ -0,0 +1,200 @@
+"""
+Batched Event ingestion.
+
+Events arrive as dicts (or JSON lines) with user, attribute, time, value and
+optional meta. They're validated and deduped a batch at a time, then written
+with one multi-row INSERT per batch that skips anything already stored for
+the same (user, attribute, time).
+"""
+import datetime
+import decimal
+import json
+import time as clock
+from collections import namedtuple, OrderedDict
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils import six
+
+from .models import Attribute, Event, User
+
+
+class BatchReport(namedtuple('BatchReport', ['received', 'inserted', 'duplicates', 'errors', 'seconds'])):
+
+    @property
+    def rate(self):
+        """
+        Events received per second.
+        """
+        return self.received / self.seconds if self.seconds else 0.0
+
+
+class EventIngester(object):
+    """
+    Keeps attribute and user lookups between batches, so a long stream only
+    queries for names and ids it hasn't seen yet.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.attributes = {}  # id or name -> (id, value_type)
+        self.users = set()
+
+    def ingest(self, events):
+        """
+        Generator of a BatchReport for every `batch_size` events consumed.
+        """
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= self.batch_size:
+                yield self.write_batch(batch)
+                batch = []
+        if batch:
+            yield self.write_batch(batch)
+
+    def resolve(self, batch):
+        attribute_keys = set()
+        user_ids = set()
+        for event in batch:
+            if not isinstance(event, dict):
+                continue
+            attribute = event.get('attribute')
+            attribute = getattr(attribute, 'pk', attribute)
+            if attribute is not None and attribute not in self.attributes:
+                attribute_keys.add(attribute)
+            user = event.get('user')
+            user = getattr(user, 'pk', user)
+            if isinstance(user, int) and user not in self.users:
+                user_ids.add(user)
+
+        ids = [k for k in attribute_keys if isinstance(k, int)]
+        names = [k for k in attribute_keys if not isinstance(k, int)]
+        if ids or names:
+            for pk, name, value_type in Attribute.objects.filter(
+                    Q(id__in=ids) | Q(name__in=names)).values_list('id', 'name', 'value_type'):
+                self.attributes[pk] = self.attributes[name] = (pk, value_type)
+        if user_ids:
+            self.users.update(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+
+    def clean(self, event):
+        """
+        Returns (key, row) ready for insert, or raises ValueError.
+        """
+        if not isinstance(event, dict):
+            raise ValueError("event must be an object")
+
+        user = event.get('user')
+        user = getattr(user, 'pk', user)
+        if user not in self.users:
+            raise ValueError("unknown user %r" % (user,))
+
+        attribute = event.get('attribute')
+        attribute = getattr(attribute, 'pk', attribute)
+        if attribute not in self.attributes:
+            raise ValueError("unknown attribute %r" % (attribute,))
+        attribute_id, value_type = self.attributes[attribute]
+
+        time = event.get('time')
+        if not isinstance(time, datetime.datetime):
+            time = parse_datetime(time) if isinstance(time, six.string_types) else None
+            if time is None:
+                raise ValueError("time must be an ISO 8601 datetime")
+        if timezone.is_naive(time):
+            time = timezone.make_aware(time, timezone.get_default_timezone())
+
+        value = event.get('value')
+        if value is not None:
+            try:
+                value = decimal.Decimal(str(value))
+            except decimal.InvalidOperation:
+                raise ValueError("value must be numeric")
+            if not value.is_finite():
+                raise ValueError("value must be finite")
+            value = self.fit_value(value)
+
+        meta = event.get('meta', {})
+        if meta is not None and not isinstance(meta, dict):
+            raise ValueError("meta must be an object")
+
+        return (user, attribute_id, time), [user, attribute_id, time, value, value_type,
+                                            Event._meta.get_field('meta').get_prep_value(meta)]
+
+    def fit_value(self, value):
+        """
+        `value` rounded the way Postgres will store it in Event.value, or
+        ValueError if it won't fit (which would fail the whole INSERT).
+        """
+        field = Event._meta.get_field('value')
+        limit = decimal.Decimal(10) ** (field.max_digits - field.decimal_places)
+        try:
+            value = value.quantize(decimal.Decimal(1).scaleb(-field.decimal_places), decimal.ROUND_HALF_UP)
+        except decimal.InvalidOperation:
+            raise ValueError("value is out of range")
+        if abs(value) >= limit:
+            raise ValueError("value is out of range")
+        return value
+
+    def write_batch(self, batch):
+        started = clock.time()
+        self.resolve(batch)
+
+        rows = OrderedDict()
+        errors = []
+        for i, event in enumerate(batch):
+            try:
+                key, row = self.clean(event)
+            except ValueError as e:
+                errors.append((i, str(e)))
+                continue
+            rows.setdefault(key, row)
+
+        inserted = 0
+        if rows:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute("""
+                               INSERT INTO core_event (created, user_id, attribute_id, time, value, value_type, meta)
+                               VALUES %s
+                               ON CONFLICT (user_id, attribute_id, time) DO NOTHING
+                               RETURNING id
+                               """ % ", ".join(["(now(), %s, %s, %s, %s, %s, %s)"] * len(rows)),
+                               [v for row in rows.values() for v in row])
+                inserted = len(cursor.fetchall())
+
+        return BatchReport(received=len(batch), inserted=inserted,
+                           duplicates=len(batch) - len(errors) - inserted,
+                           errors=errors, seconds=clock.time() - started)
+
+
+def ingest_events(events, batch_size=1000):
+    """
+    Ingest an iterable of event dicts, yielding a BatchReport per batch.
+    """
+    return EventIngester(batch_size=batch_size).ingest(events)
+
+
+def read_jsonl(lines):
+    """
+    Decode JSON lines, passing undecodable lines through as the raw string
+    so they're reported as invalid in their batch rather than stopping the stream.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line
+
+
+def ingest_jsonl(lines, batch_size=1000):
+    """
+    Ingest a file (or any iterable of lines) of JSON-encoded events.
+    """
+    return ingest_events(read_jsonl(lines), batch_size=batch_size)
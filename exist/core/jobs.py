@@ -0,0 +1,124 @@
+"""
+Background per-user recomputation, queued in core_job.
+
+Work is queued with Job.objects.enqueue(kind, users): one queued job per
+user and kind, prioritised by how recently the user was seen and whether
+they're paying, trialling or delinquent (see JobManager.PRIORITY_SQL).
+Any number of `manage.py run_jobs` processes claim jobs with
+FOR UPDATE SKIP LOCKED, and no more than MAX_RUNNING run at once across
+all of them. Failed jobs are retried with exponential backoff up to
+MAX_ATTEMPTS times.
+
+Configured by settings.JOBS.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import cache, rollups
+from .models import CorrelationStatistic, Job
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_RUNNING': 4,
+    'BATCH_SIZE': 1,
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 60,
+    'STALE_AFTER': 15 * 60,
+    'KEEP_FINISHED': 24 * 60 * 60,
+    'MAINTENANCE_INTERVAL': 60,
+}
+
+# UserAttributeManager views warmed by a `latest` job
+LATEST_VIEWS = ('high_priority', 'public_high_priority', 'active', 'by_group', 'by_group_all')
+
+
+def refresh_latest(user):
+    """
+    Fill the user's attribute caches (core.cache) so the next page view
+    doesn't have to. Only queued when settings.ATTRIBUTE_CACHE is shared
+    with the web processes; warming a worker's own memory helps nobody.
+    """
+    for name in LATEST_VIEWS:
+        getattr(user.attributes, name)()
+
+
+def rollup(user):
+    rollups.rollup_user(user)
+    # new daily values, so the cached views are stale
+    if cache.is_shared():
+        Job.objects.enqueue(Job.LATEST, [user])
+
+
+def refresh_correlations(user):
+    CorrelationStatistic.objects.rebuild_for_user(user)
+
+
+HANDLERS = {
+    Job.LATEST: refresh_latest,
+    Job.ROLLUP: rollup,
+    Job.CORRELATIONS: refresh_correlations,
+}
+
+
+def get_options():
+    return dict(DEFAULTS, **getattr(settings, 'JOBS', {}))
+
+
+class Worker(object):
+
+    def __init__(self, options=None):
+        self.options = options or get_options()
+        self.maintained = 0
+        self.done = 0
+        self.failed = 0
+
+    def run_job(self, job):
+        try:
+            HANDLERS[job.kind](job.user)
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            retry = None
+            if job.attempts < self.options['MAX_ATTEMPTS']:
+                retry = self.options['RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            Job.objects.finish(job, error="%s: %s" % (type(e).__name__, e), retry_after=retry)
+            self.failed += 1
+        else:
+            Job.objects.finish(job)
+            self.done += 1
+
+    def run_once(self):
+        """
+        Claim and run one batch. Returns how many jobs ran.
+        """
+        if time.time() - self.maintained > self.options['MAINTENANCE_INTERVAL']:
+            self.maintain()
+        jobs = Job.objects.claim(self.options['BATCH_SIZE'], self.options['MAX_RUNNING'])
+        for job in jobs:
+            self.run_job(job)
+        return len(jobs)
+
+    def maintain(self):
+        # even if it fails, wait for the next interval before trying again
+        self.maintained = time.time()
+        requeued = Job.objects.requeue_stale(self.options['STALE_AFTER'], self.options['MAX_ATTEMPTS'])
+        if requeued:
+            logger.warning("Requeued %d stale jobs", requeued)
+        Job.objects.purge(self.options['KEEP_FINISHED'])
+
+    def run_forever(self):
+        while True:
+            try:
+                ran = self.run_once()
+            except Exception:
+                # eg. the database going away; keep the worker alive
+                logger.exception("Job worker iteration failed")
+                ran = 0
+            finally:
+                close_old_connections()
+            if not ran:
+                time.sleep(self.options['POLL_INTERVAL'])
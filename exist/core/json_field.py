@@ -3,6 +3,7 @@ import decimal
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import F, Func, Value
 from django.db.models.lookups import BuiltinLookup, Transform
 from django.db.backends.postgresql_psycopg2.schema import DatabaseSchemaEditor
 from django.db.backends.postgresql_psycopg2.introspection import DatabaseIntrospection
@@ -16,10 +17,113 @@ register_json(oid=3802, array_oid=3807)
 # However, it may be that we want to use specific decoding on
 # the json object... which if we wanted to do it on a per-field
 # basis, we'd need to not have run that line.
+# Fields that are lazy or fast_float get around that by selecting their
+# column as text and decoding it themselves, see JSONField.select_format.
 
 DatabaseIntrospection.data_types_reverse[3802]="core.json_field.JSONField"
 
 
+class LazyJSON(object):
+    """
+    A JSON document that isn't decoded until something looks inside it.
+    Behaves like the decoded value for item access, iteration, comparison
+    and attribute lookups (eg. .get(), .items()); `value` is the decoded
+    value itself. Saving one that was never looked at writes `raw` back
+    without re-encoding it.
+    """
+    __slots__ = ('raw', '_decode_kwargs', '_value')
+
+    _UNDECODED = object()
+
+    def __init__(self, raw, decode_kwargs=None):
+        self.raw = raw
+        self._decode_kwargs = decode_kwargs or {}
+        self._value = self._UNDECODED
+
+    @property
+    def decoded(self):
+        return self._value is not self._UNDECODED
+
+    @property
+    def value(self):
+        if self._value is self._UNDECODED:
+            self._value = json.loads(self.raw, **self._decode_kwargs)
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'raw':
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __setitem__(self, key, value):
+        self.value[key] = value
+
+    def __delitem__(self, key):
+        del self.value[key]
+
+    def __contains__(self, key):
+        return key in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __bool__(self):
+        return bool(self.value)
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        if not self.decoded:
+            return '<LazyJSON %s>' % self.raw
+        return repr(self.value)
+
+    def __reduce__(self):
+        return (_identity, (self.value,))
+
+
+def _identity(value):
+    return value
+
+
+class LazyJSONDescriptor(object):
+    """
+    The attribute of a lazy JSONField. A model instance holds the LazyJSON
+    it was loaded with until the attribute is first read, which decodes it
+    and keeps the decoded value instead; so callers only ever see a plain
+    dict, list or None. Saving an instance whose value was never read
+    writes the stored text back as it was (see JSONField.pre_save).
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.field.attname]
+        if isinstance(value, LazyJSON):
+            value = instance.__dict__[self.field.attname] = value.value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
 class JSONField(models.Field):
     description = 'JSON Field'
 
@@ -27,9 +131,19 @@ class JSONField(models.Field):
         self.decode_kwargs = kwargs.pop('decode_kwargs', {
             'parse_float': decimal.Decimal
         })
+        # lazy: only decode a loaded value when the attribute is first read
+        # (values() and values_list() hand back the LazyJSON itself)
+        self.lazy = kwargs.pop('lazy', False)
+        # fast_float: decode floats as float rather than decode_kwargs' parse_float
+        self.fast_float = kwargs.pop('fast_float', False)
         self.encode_kwargs = kwargs.pop('encode_kwargs', {
             'cls': DjangoJSONEncoder,
         })
+        # db_index=True with db_index_options: a dict or list of dicts with
+        #   path: "key" or "key__subkey" (default the whole document)
+        #   only_contains: GIN index with jsonb_path_ops, for @> only
+        #   type: text, int, float, bool, date or datetime; a btree index on
+        #         the path cast like meta__path__as_<type> does
         db_index=kwargs.get("db_index")
         db_index_options = kwargs.pop("db_index_options",{})
         if db_index:
@@ -41,6 +155,18 @@ class JSONField(models.Field):
     def get_internal_type(self):
         return 'JSONField'
 
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(JSONField, self).contribute_to_class(cls, name, **kwargs)
+        if self.lazy:
+            setattr(cls, self.attname, LazyJSONDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        if self.lazy and self.attname in model_instance.__dict__:
+            # a value that was never read is still the LazyJSON it was loaded
+            # as, and get_prep_value writes its text back without decoding it
+            return model_instance.__dict__[self.attname]
+        return super(JSONField, self).pre_save(model_instance, add)
+
     def db_type(self, connection):
         return 'jsonb'
 
@@ -52,8 +178,38 @@ class JSONField(models.Field):
             if not self.null and self.blank:
                 return ""
             return None
+        if isinstance(value, LazyJSON):
+            if not value.decoded:
+                return value.raw
+            value = value.value
         return json.dumps(value, **self.encode_kwargs)
 
+    @property
+    def decodes_text(self):
+        """
+        Whether this field decodes its own values instead of leaving it to
+        psycopg2's global jsonb handling.
+        """
+        return self.lazy or self.fast_float
+
+    def get_decode_kwargs(self):
+        kwargs = dict(self.decode_kwargs)
+        if self.fast_float:
+            kwargs.pop('parse_float', None)
+        return kwargs
+
+    def select_format(self, compiler, sql, params):
+        if self.decodes_text:
+            return '(%s)::text' % sql, params
+        return super(JSONField, self).select_format(compiler, sql, params)
+
+    def from_db_value(self, value, expression, connection, context):
+        if not self.decodes_text or not isinstance(value, six.string_types):
+            return value
+        if self.lazy:
+            return LazyJSON(value, self.get_decode_kwargs())
+        return json.loads(value, **self.get_decode_kwargs())
+
     def get_prep_lookup(self, lookup_type, value, prepared=False):
         if lookup_type == 'has_key':
             # Need to ensure we have a string, as no other
@@ -84,6 +240,10 @@ class JSONField(models.Field):
             decode_kwargs=self.decode_kwargs,
             encode_kwargs=self.encode_kwargs
         )
+        if self.lazy:
+            kwargs["lazy"]=True
+        if self.fast_float:
+            kwargs["fast_float"]=True
         if hasattr(self,"db_index_options"):
             if self.db_index_options:
                 kwargs["db_index_options"]=self.db_index_options
@@ -113,6 +273,14 @@ class JSONField(models.Field):
         return GetTransform(name)
 
 DatabaseSchemaEditor.create_jsonb_index_sql="CREATE INDEX %(name)s ON %(table)s USING GIN ({path}{ops_cls})%(extra)s"
+DatabaseSchemaEditor.create_jsonb_typed_index_sql="CREATE INDEX %(name)s ON %(table)s (({expression}))%(extra)s"
+
+
+def jsonb_index_suffix(editor,option):
+    paths=option.get("path","")
+    if option.get("type"):
+        return editor._digest(paths,option["type"])
+    return editor._digest(paths) if paths else ""
 
 
 def create_jsonb_index_sql(editor,model,field):
@@ -122,6 +290,21 @@ def create_jsonb_index_sql(editor,model,field):
     sqls=[]
     for option in options:
         paths=option.get("path","")
+        if option.get("type"):
+            # A btree index on the same expression the as_<type> transform
+            # produces, so filters and ordering on meta__key__as_<type> can use it.
+            if not paths:
+                raise ValueError("Typed JSON indexes need a path")
+            try:
+                transform=AS_TRANSFORMS[option["type"]]
+            except KeyError:
+                raise ValueError("Unknown JSON index type %r, expected one of %s" % (
+                    option["type"], ", ".join(sorted(AS_TRANSFORMS))))
+            path_elements=paths.split("__")
+            path="%(columns)s"+"".join("->'%s'" % element for element in path_elements)
+            sql=editor.create_jsonb_typed_index_sql.format(expression=transform.cast_sql(AsTransform.as_text(path)))
+            sqls.append(editor._create_index_sql(model,[field],sql=sql,suffix=jsonb_index_suffix(editor,option)))
+            continue
         if not paths:
             path="%(columns)s"
         else:
@@ -130,7 +313,7 @@ def create_jsonb_index_sql(editor,model,field):
 
         ops_cls=" jsonb_path_ops" if option.get("only_contains") else ""
         sql=editor.create_jsonb_index_sql.format(path=path,ops_cls=ops_cls)
-        sqls.append(editor._create_index_sql(model,[field],sql=sql,suffix=(editor._digest(paths) if paths else "")))
+        sqls.append(editor._create_index_sql(model,[field],sql=sql,suffix=jsonb_index_suffix(editor,option)))
     return sqls
 
 DatabaseSchemaEditor._create_jsonb_index_sql=create_jsonb_index_sql
@@ -162,7 +345,7 @@ def _alter_field(editor, model, old_field, new_field, old_type, new_type,
                     all_indexes=editor._constraint_names(model, index=True)
 
                     for index_info in with_path_index:
-                        path_hash=editor._digest(index_info["path"])
+                        path_hash=jsonb_index_suffix(editor,index_info)
                         for i,index in enumerate(all_indexes):
                             if index.endswith(path_hash):
                                 index_names.append(all_indexes.pop(i))
@@ -254,6 +437,10 @@ class ArrayLenTransform(Transform):
 JSONField.register_lookup(ArrayLenTransform)
 
 
+# as_<type> transforms by type name, for typed indexes (see create_jsonb_index_sql).
+AS_TRANSFORMS = {}
+
+
 class TransformMeta(type(Transform)):
     def __init__(cls, *args):
         super(TransformMeta, cls).__init__(*args)
@@ -261,20 +448,31 @@ class TransformMeta(type(Transform)):
 
         if cls.__name__ != "AsTransform":
             JSONField.register_lookup(cls)
+            AS_TRANSFORMS[cls.lookup_type or cls.type] = cls
 
 
-class AsTransform(Transform):
-    __metaclass__ = TransformMeta
-
+class AsTransform(six.with_metaclass(TransformMeta, Transform)):
     type = None
     lookup_type = None
     field_type = None
+    # Casts from text to date and timestamp aren't IMMUTABLE, so they can't be
+    # indexed; those types go through the wrapper functions from migration 0010.
+    function = None
+
+    @staticmethod
+    def as_text(lhs):
+        splited = lhs.split("->")
+        return "->>".join(["->".join(splited[:-1]), splited[-1]])
+
+    @classmethod
+    def cast_sql(cls, lhs):
+        if cls.function:
+            return "%s(%s)" % (cls.function, lhs)
+        return "CAST(%s as %s)" % (lhs, cls.type)
 
     def as_sql(self, qn, connection):
         lhs, params = qn.compile(self.lhs)
-        splited = lhs.split("->")
-        lhs = "->>".join(["->".join(splited[:-1]), splited[-1]])
-        return "CAST(%s as %s)" % (lhs, self.type), params
+        return self.cast_sql(self.as_text(lhs)), params
 
     @property
     def output_field(self):
@@ -306,19 +504,21 @@ class JsonAsBool(AsTransform):
 class JsonAsDate(AsTransform):
     type = "date"
     field_type = models.DateField
+    function = "json_field_date"
 
 
 class JsonAsDatetime(AsTransform):
+    type = "timestamptz"
     lookup_type = "datetime"
     field_type = models.DateTimeField
 
-    @property
-    def type(self):
+    @classmethod
+    def cast_sql(cls, lhs):
         from django.conf import settings
         if settings.USE_TZ:
-            return "timestamptz"
+            return "json_field_timestamptz(%s)" % lhs
         else:
-            return "timestamp"
+            return "json_field_timestamp(%s)" % lhs
 
 
 class Get(Transform):
@@ -393,3 +593,160 @@ def manager_select_json(manager, *args, **kwargs):
     return manager.all().select_json(*args, **kwargs)
 
 models.manager.BaseManager.select_json = manager_select_json
+
+
+class JsonPath(Func):
+    """
+    A key (or key__subkey path) of a JSONField cast to one of the as_<type>
+    types, as an expression. It compiles to the same SQL as the
+    meta__key__as_<type> transform, so typed indexes on the path apply.
+    """
+    def __init__(self, field, path, type="text", **extra):
+        if type not in AS_TRANSFORMS:
+            raise ValueError("Unknown JSON type %r, expected one of %s" % (type, ", ".join(sorted(AS_TRANSFORMS))))
+        self.path = path.split("__") if isinstance(path, six.string_types) else list(path)
+        self.cast = AS_TRANSFORMS[type]
+        super(JsonPath, self).__init__(F(field) if isinstance(field, six.string_types) else field,
+                                       output_field=self.cast.field_type(), **extra)
+
+    @classmethod
+    def parse(cls, lookup):
+        """
+        JsonPath("meta__a__b__as_int") is JsonPath("meta", "a__b", "int");
+        without an as_<type> suffix the value is text.
+        """
+        elements = lookup.split("__")
+        type = "text"
+        if elements[-1].startswith("as_") and elements[-1][3:] in AS_TRANSFORMS:
+            type = elements.pop()[3:]
+        if len(elements) < 2:
+            raise ValueError("%r doesn't name a path inside a JSON field" % lookup)
+        return cls(elements[0], elements[1:], type)
+
+    @property
+    def name(self):
+        return "_".join(self.path)
+
+    def as_sql(self, compiler, connection):
+        lhs, params = compiler.compile(self.source_expressions[0])
+        keys = ["'%s'" % key.replace("'", "''").replace("%", "%%") for key in self.path]
+        path = "->".join([lhs] + keys[:-1]) + "->>" + keys[-1]
+        return self.cast.cast_sql(path), params
+
+
+class DateTrunc(Func):
+    """
+    date_trunc(kind, field), optionally in a given time zone (the result is
+    then a local, naive datetime).
+    """
+    KINDS = ("minute", "hour", "day", "week", "month", "quarter", "year")
+
+    def __init__(self, kind, field, tzname=None, **extra):
+        if kind not in self.KINDS:
+            raise ValueError("Can't truncate to %r, expected one of %s" % (kind, ", ".join(self.KINDS)))
+        expressions = [Value(kind), F(field) if isinstance(field, six.string_types) else field]
+        if tzname is not None:
+            expressions.append(Value(tzname))
+        super(DateTrunc, self).__init__(*expressions, output_field=models.DateTimeField(), **extra)
+
+    def as_sql(self, compiler, connection):
+        if len(self.source_expressions) == 3:
+            sqls, params = [], []
+            for expression in self.source_expressions:
+                sql, expression_params = compiler.compile(expression)
+                sqls.append(sql)
+                params.extend(expression_params)
+            return "date_trunc(%s, %s AT TIME ZONE %s)" % tuple(sqls), params
+        return super(DateTrunc, self).as_sql(compiler, connection, function="date_trunc")
+
+
+JSON_AGGREGATES = {
+    "sum": models.Sum,
+    "avg": models.Avg,
+    "min": models.Min,
+    "max": models.Max,
+    "count": models.Count,
+}
+
+
+def json_values(query, *args, **kwargs):
+    """
+    values() of typed JSON paths, computed in the database:
+
+        Event.objects.json_values("time", "meta__steps__as_int", place="meta__location__name")
+
+    Plain field names pass through; JSON paths are named after their keys
+    (steps) unless given as keyword arguments.
+    """
+    annotations = {}
+    names = []
+    for lookup in args:
+        if lookup.split("__", 1)[0] in _json_field_names(query.model) and "__" in lookup:
+            path = JsonPath.parse(lookup)
+            annotations[path.name] = path
+            names.append(path.name)
+        else:
+            names.append(lookup)
+    for name, lookup in kwargs.items():
+        annotations[name] = JsonPath.parse(lookup) if isinstance(lookup, six.string_types) else lookup
+        names.append(name)
+    return query.annotate(**annotations).values(*names)
+
+models.QuerySet.json_values = json_values
+
+
+def json_aggregate(query, group_by=(), tzname=None, **aggregates):
+    """
+    Aggregate typed JSON paths in the database, one row per group:
+
+        Event.objects.filter(user=user).json_aggregate(
+            group_by=["time__week", "attribute"],
+            steps=("sum", "meta__steps__as_int"),
+            days=("count", "meta__steps__as_int"))
+
+    group_by takes field names, or a date field with __<kind> to group by
+    date_trunc (minute ... year), in `tzname` if given; those groups are
+    named field_kind (time_week). Rows are values() dicts in group order.
+    """
+    truncated = {}
+    names = []
+    for lookup in group_by:
+        field, _, kind = lookup.rpartition("__")
+        if field and kind in DateTrunc.KINDS:
+            name = "%s_%s" % (field.replace("__", "_"), kind)
+            truncated[name] = DateTrunc(kind, field, tzname)
+            names.append(name)
+        else:
+            names.append(lookup)
+
+    annotations = {}
+    for name, (function, lookup) in aggregates.items():
+        try:
+            aggregate = JSON_AGGREGATES[function]
+        except KeyError:
+            raise ValueError("Unknown aggregate %r, expected one of %s" % (function, ", ".join(sorted(JSON_AGGREGATES))))
+        annotations[name] = aggregate(JsonPath.parse(lookup) if isinstance(lookup, six.string_types) else lookup)
+
+    if truncated:
+        query = query.annotate(**truncated)
+    if names:
+        return query.values(*names).annotate(**annotations).order_by(*names)
+    return query.aggregate(**annotations)
+
+models.QuerySet.json_aggregate = json_aggregate
+
+
+def _json_field_names(model):
+    return set(field.name for field in model._meta.concrete_fields if isinstance(field, JSONField))
+
+
+def manager_json_values(manager, *args, **kwargs):
+    return manager.all().json_values(*args, **kwargs)
+
+models.manager.BaseManager.json_values = manager_json_values
+
+
+def manager_json_aggregate(manager, *args, **kwargs):
+    return manager.all().json_aggregate(*args, **kwargs)
+
+models.manager.BaseManager.json_aggregate = manager_json_aggregate
@@ -0,0 +1,183 @@
+"""
+Write-behind buffering for UserLog.
+
+UserLog.objects.record() appends to a per-process buffer instead of
+inserting on the request path. A background thread flushes it with one
+multi-row INSERT when it reaches FLUSH_SIZE logs or FLUSH_INTERVAL seconds
+have passed, and again when the process shuts down: at interpreter exit,
+and on a Pulsar worker's `stopping` event, which exist.wsgi binds with
+flush_on_stop() as the worker loads the application.
+
+The buffer holds at most MAX_SIZE logs. When it's full, POLICY decides:
+    'drop'         discard the new log
+    'drop_oldest'  discard the oldest buffered log
+    'flush'        the recording thread flushes synchronously (backpressure)
+
+Configured by settings.USERLOG_BUFFER.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection, close_old_connections, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MAX_SIZE': 10000,
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 5.0,
+    'POLICY': 'drop',
+}
+
+
+class UserLogBuffer(object):
+
+    def __init__(self, max_size=10000, flush_size=500, flush_interval=5.0, policy='drop'):
+        if policy not in ('drop', 'drop_oldest', 'flush'):
+            raise ValueError("Unknown UserLog buffer policy %r" % policy)
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.logs = deque()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.dropped = 0
+        self.flushed = 0
+        self._pid = None
+
+    def append(self, user_id, page, action, args=None):
+        """
+        Buffer a log. Returns False if it was dropped.
+        """
+        self._start()
+        log = (user_id, timezone.now(), page, action, args)
+        with self.lock:
+            full = len(self.logs) >= self.max_size
+            if full and self.policy == 'drop':
+                self.dropped += 1
+                return False
+            if full and self.policy == 'drop_oldest':
+                self.logs.popleft()
+                self.dropped += 1
+                full = False
+            if not full:
+                self.logs.append(log)
+                if len(self.logs) >= self.flush_size:
+                    self.wakeup.set()
+                return True
+        # backpressure: make room ourselves, then try again
+        self.flush()
+        return self.append(user_id, page, action, args)
+
+    def _take(self):
+        with self.lock:
+            count = min(len(self.logs), self.flush_size)
+            return [self.logs.popleft() for _ in range(count)]
+
+    def flush(self):
+        """
+        Write everything buffered so far, a batch at a time.
+        """
+        with self.flush_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    return
+                try:
+                    write_logs(batch)
+                    self.flushed += len(batch)
+                except Exception:
+                    self.dropped += len(batch)
+                    logger.exception("Dropped %d buffered user logs", len(batch))
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+            # this thread keeps its own connection; don't let it go stale
+            close_old_connections()
+
+    def _start(self):
+        # started lazily, and again in each process forked after it started
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.logs.clear()
+            thread = threading.Thread(target=self._run, name='userlog-buffer')
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.flush)
+
+    def stats(self):
+        return {'buffered': len(self.logs), 'flushed': self.flushed, 'dropped': self.dropped}
+
+
+def write_logs(logs):
+    """
+    Insert (user_id, created, page, action, args) tuples in one statement
+    and add them to the daily counts.
+    """
+    from .models import UserLog, UserLogDay
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("""
+                       INSERT INTO core_userlog (user_id, created, page, action, args)
+                       VALUES %s
+                       """ % ", ".join(["(%s, %s, %s, %s, %s)"] * len(logs)),
+                       [v for log in logs for v in log])
+        UserLogDay.objects.record(UserLog(user_id=user_id, created=created, page=page, action=action)
+                                  for user_id, created, page, action, _ in logs)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def flush_on_stop():
+    """
+    Flush the buffer when the current Pulsar actor stops. This has to be
+    called on the actor's own thread, as pulse loads the WSGI application:
+    requests, and so the first append(), run on executor threads, which
+    have no actor. Returns whether there was an actor to bind to.
+    """
+    buffer = get_buffer()
+    if buffer is None:
+        return False
+    try:
+        from pulsar import get_actor
+    except ImportError:
+        return False
+    actor = get_actor()
+    if actor is None:
+        return False
+    actor.bind_event('stopping', lambda actor, **kw: buffer.flush())
+    return True
+
+
+def get_buffer():
+    """
+    This process's buffer, or None if buffering is turned off.
+    """
+    global _buffer
+    options = dict(DEFAULTS, **getattr(settings, 'USERLOG_BUFFER', {}))
+    if not options['ENABLED']:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = UserLogBuffer(max_size=options['MAX_SIZE'], flush_size=options['FLUSH_SIZE'],
+                                        flush_interval=options['FLUSH_INTERVAL'], policy=options['POLICY'])
+    return _buffer
@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from core.ingest import ingest_jsonl
+
+
+class Command(BaseCommand):
+    help = "Ingest events from a JSON lines file (or stdin), reporting throughput per batch."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        lines = sys.stdin if path == '-' else open(path)
+        totals = [0, 0, 0, 0]
+        try:
+            for n, report in enumerate(ingest_jsonl(lines, batch_size=options['batch_size']), 1):
+                self.stdout.write("batch %d: %d received, %d inserted, %d duplicate, %d invalid "
+                                  "in %.3fs (%.0f/s)" % (n, report.received, report.inserted,
+                                                         report.duplicates, len(report.errors),
+                                                         report.seconds, report.rate))
+                for index, error in report.errors[:10]:
+                    self.stderr.write("  event %d: %s" % (index, error))
+                totals[0] += report.received
+                totals[1] += report.inserted
+                totals[2] += report.duplicates
+                totals[3] += len(report.errors)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        self.stdout.write("%d received, %d inserted, %d duplicate, %d invalid" % tuple(totals))
@@ -0,0 +1,30 @@
+import pulsar
+from django.core.management.base import CommandError
+from pulsar.apps.pulse.management.commands import pulse
+from pulsar.apps.wsgi import WSGIServer
+
+from exist.threadpool import Wsgi
+
+
+class Command(pulse.Command):
+    """
+    pulsar's pulse, serving exist.threadpool.Wsgi so requests are queued
+    for the executor by its monitor. core comes before pulsar.apps.pulse in
+    INSTALLED_APPS so this is the pulse command that runs; handle() is
+    pulsar 1.0.3's with the callable swapped.
+    """
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('pulse --help for usage')
+        app_name = options.get('pulse_app_name')
+        callable = Wsgi()
+        if options.pop('dryrun', False) is True:  # used for testing
+            return callable
+        cfg = pulsar.Config(apps=['socket', 'pulse'],
+                            server_software=pulsar.SERVER_SOFTWARE,
+                            **options)
+        server = WSGIServer(callable=callable, name=app_name, cfg=cfg,
+                            parse_console=False)
+        callable.cfg = server.cfg
+        server.start()
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from core.models import User
+from core.rollups import rollup_all, rollup_user
+
+
+class Command(BaseCommand):
+    help = "Roll up new events into daily attribute values."
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*')
+
+    def handle(self, *args, **options):
+        if options['usernames']:
+            inserted = updated = 0
+            for user in User.objects.filter(username__in=options['usernames']):
+                i, u = rollup_user(user)
+                inserted, updated = inserted + i, updated + u
+        else:
+            inserted, updated = rollup_all()
+        self.stdout.write("%d days inserted, %d updated" % (inserted, updated))
@@ -0,0 +1,40 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.jobs import Worker
+from core.models import Job, User
+
+
+class Command(BaseCommand):
+    help = "Run queued per-user jobs, or queue some with --enqueue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enqueue', choices=[kind for kind, _ in Job.KINDS],
+                            help="Queue this kind of job instead of running jobs.")
+        parser.add_argument('--seen-within', type=int, default=None, metavar='DAYS',
+                            help="With --enqueue, only users seen in the last DAYS days.")
+        parser.add_argument('--once', action='store_true',
+                            help="Run one batch and exit.")
+        parser.add_argument('usernames', nargs='*')
+
+    def handle(self, *args, **options):
+        if options['enqueue']:
+            users = User.objects.filter(is_active=True)
+            if options['usernames']:
+                users = users.filter(username__in=options['usernames'])
+            if options['seen_within'] is not None:
+                since = timezone.now() - datetime.timedelta(days=options['seen_within'])
+                users = users.filter(last_seen_activity__gte=since)
+            queued, coalesced = Job.objects.enqueue(options['enqueue'], users)
+            self.stdout.write("%d jobs queued, %d already waiting" % (queued, coalesced))
+            return
+        if options['usernames']:
+            raise CommandError("usernames only apply with --enqueue")
+
+        worker = Worker()
+        if options['once']:
+            self.stdout.write("%d jobs run" % worker.run_once())
+        else:
+            worker.run_forever()
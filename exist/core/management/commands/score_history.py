@@ -0,0 +1,44 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils.dateparse import parse_date
+
+from core.models import ScoreHistory
+
+
+def compute_day(day):
+    try:
+        return day, ScoreHistory.objects.compute_day(day)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = "Compute daily scores for every user, for a day or a range of days."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help="First day (YYYY-MM-DD), default today.")
+        parser.add_argument('--end', help="Last day (YYYY-MM-DD), default --start.")
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Days computed at once, each on its own connection.")
+
+    def handle(self, *args, **options):
+        start = self.date(options['start']) or datetime.date.today()
+        end = self.date(options['end']) or start
+        if start > end:
+            raise CommandError("--start must not be after --end")
+        days = [start + datetime.timedelta(days=n) for n in range((end - start).days + 1)]
+
+        with ThreadPoolExecutor(max(1, options['workers'])) as executor:
+            for day, users in executor.map(compute_day, days):
+                self.stdout.write("%s: %d users" % (day, users))
+
+    def date(self, value):
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise CommandError("%r isn't a date (YYYY-MM-DD)" % value)
+        return date
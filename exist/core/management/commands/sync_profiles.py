@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Profile
+from core.sync import SyncEngine
+
+
+class Command(BaseCommand):
+    help = "Fetch new data for profiles from their services, many at once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--service', action='append', default=[],
+                            help="Only this service's profiles (by slug); may be repeated.")
+        parser.add_argument('--threads', type=int, default=8,
+                            help="Threads for requests and database writes.")
+        parser.add_argument('usernames', nargs='*')
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.all()
+        if options['service']:
+            profiles = profiles.filter(service__slug__in=options['service'])
+        if options['usernames']:
+            profiles = profiles.filter(user__username__in=options['usernames'])
+
+        results = SyncEngine(threads=options['threads']).run(profiles)
+        failed = [result for result in results if result.error is not None]
+        self.stdout.write("%d profiles synced, %d failed: %d pages, %d new events, %d rejected" % (
+            len(results) - len(failed), len(failed),
+            sum(result.pages for result in results), sum(result.events for result in results),
+            sum(len(result.rejected) for result in results)))
+        for result in failed[:20]:
+            self.stderr.write("  profile %s: %s" % (result.profile_id, result.error))
@@ -0,0 +1,19 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from core.models import UserLogDay
+
+
+class Command(BaseCommand):
+    help = "Recount the daily UserLog counts for the last few days, eg. from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2,
+                            help="Days to recount, counting back from today.")
+
+    def handle(self, *args, **options):
+        today = datetime.date.today()
+        start = today - datetime.timedelta(days=options['days'] - 1)
+        UserLogDay.objects.rebuild(start, today)
+        self.stdout.write("recounted %s to %s" % (start, today))
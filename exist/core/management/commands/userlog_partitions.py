@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.partitions import is_partitioned, maintain
+
+
+class Command(BaseCommand):
+    help = "Create upcoming monthly UserLog partitions and archive ones past the retention window."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3,
+                            help="Months of partitions to create in advance.")
+        parser.add_argument('--retain', type=int, default=settings.USERLOG_RETENTION_MONTHS,
+                            help="Months of logs to keep in the database.")
+        parser.add_argument('--archive-dir', default=settings.USERLOG_ARCHIVE_DIR)
+        parser.add_argument('--no-archive', action='store_true',
+                            help="Only create partitions.")
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            self.stdout.write("core_userlog isn't partitioned (it needs Postgres 11), nothing to do")
+            return
+        directory = None if options['no_archive'] else options['archive_dir']
+        created, archived, default_archive = maintain(ahead=options['ahead'], retain=options['retain'],
+                                                      directory=directory)
+        for month in created:
+            self.stdout.write("created partition for %s" % month.strftime('%Y-%m'))
+        for month in archived:
+            self.stdout.write("archived partition for %s" % month.strftime('%Y-%m'))
+        if default_archive is not None:
+            self.stdout.write("archived old rows of the default partition to %s" % default_archive)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_auto_20150921_1606'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CorrelationStatistic',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('n', models.IntegerField(default=0)),
+                ('sum_x', models.DecimalField(max_digits=40, decimal_places=8, default=0)),
+                ('sum_y', models.DecimalField(max_digits=40, decimal_places=8, default=0)),
+                ('sum_xy', models.DecimalField(max_digits=40, decimal_places=8, default=0)),
+                ('sum_xx', models.DecimalField(max_digits=40, decimal_places=8, default=0)),
+                ('sum_yy', models.DecimalField(max_digits=40, decimal_places=8, default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('attribute', models.ForeignKey(related_name='+', to='core.UserAttribute')),
+                ('other', models.ForeignKey(related_name='+', to='core.UserAttribute')),
+                ('user', models.ForeignKey(related_name='correlation_statistics', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='correlationstatistic',
+            unique_together=set([('attribute', 'other')]),
+        ),
+    ]
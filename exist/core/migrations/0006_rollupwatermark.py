@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_correlationstatistic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('user', models.OneToOneField(related_name='rollup_watermark', serialize=False, primary_key=True, to=settings.AUTH_USER_MODEL)),
+                ('rolled_up', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
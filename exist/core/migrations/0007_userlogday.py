@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_rollupwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserLogDay',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField(db_index=True)),
+                ('page', models.CharField(max_length=128)),
+                ('action', models.CharField(max_length=128)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(related_name='log_days', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-day'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='userlogday',
+            unique_together=set([('user', 'day', 'page', 'action')]),
+        ),
+        # count up the existing logs
+        migrations.RunSQL(
+            [("""
+             INSERT INTO core_userlogday (user_id, day, page, action, count)
+             SELECT user_id, (created AT TIME ZONE %s)::date AS day, page, action, COUNT(*)
+             FROM core_userlog
+             GROUP BY user_id, day, page, action
+             """, [settings.TIME_ZONE])],
+            "DELETE FROM core_userlogday",
+        ),
+    ]
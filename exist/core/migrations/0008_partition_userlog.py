@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Rebuilds core_userlog as a table range partitioned by month on `created`.
+# Declarative partitioning needs Postgres 11 or later; on anything older
+# the table is left as it is, and core.partitions does nothing.
+#
+# The primary key has to include the partition key, so in the database it
+# becomes (id, created); ids still come from the same sequence, so `id`
+# stays unique and Django's state keeps it as the primary key. Don't
+# AlterField `id` or `created` without raw SQL. The other indexes are
+# recreated under the names Django gave them, so later migrations find
+# them, and `created` gets an index of its own.
+#
+# Partitions are created here for every month with logs up to three months
+# ahead, and after that by `manage.py userlog_partitions`.
+PARTITION = [
+    """
+    ALTER TABLE core_userlog RENAME TO core_userlog_old
+    """,
+    """
+    ALTER INDEX core_userlog_pkey RENAME TO core_userlog_old_pkey
+    """,
+    """
+    CREATE TABLE core_userlog (
+        id integer NOT NULL DEFAULT nextval('core_userlog_id_seq'),
+        user_id integer NOT NULL REFERENCES core_user (id) DEFERRABLE INITIALLY DEFERRED,
+        created timestamp with time zone NOT NULL,
+        page varchar(128) NOT NULL,
+        action varchar(128) NOT NULL,
+        args text NULL,
+        PRIMARY KEY (id, created)
+    ) PARTITION BY RANGE (created)
+    """,
+    """
+    ALTER SEQUENCE core_userlog_id_seq OWNED BY core_userlog.id
+    """,
+    """
+    CREATE TABLE core_userlog_default PARTITION OF core_userlog DEFAULT
+    """,
+    """
+    DO $$
+    DECLARE
+        month date := date_trunc('month', COALESCE((SELECT MIN(created) FROM core_userlog_old), now()) AT TIME ZONE 'UTC');
+        last date := date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 months';
+    BEGIN
+        WHILE month <= last LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF core_userlog FOR VALUES FROM (%L) TO (%L)',
+                           'core_userlog_p' || to_char(month, 'YYYYMM'),
+                           month::timestamp AT TIME ZONE 'UTC',
+                           (month + interval '1 month')::timestamp AT TIME ZONE 'UTC');
+            month := month + interval '1 month';
+        END LOOP;
+    END $$
+    """,
+    """
+    INSERT INTO core_userlog SELECT id, user_id, created, page, action, args FROM core_userlog_old
+    """,
+    """
+    DROP TABLE core_userlog_old
+    """,
+]
+
+UNPARTITION = [
+    """
+    CREATE TABLE core_userlog_new (
+        id integer NOT NULL DEFAULT nextval('core_userlog_id_seq') PRIMARY KEY,
+        user_id integer NOT NULL REFERENCES core_user (id) DEFERRABLE INITIALLY DEFERRED,
+        created timestamp with time zone NOT NULL,
+        page varchar(128) NOT NULL,
+        action varchar(128) NOT NULL,
+        args text NULL
+    )
+    """,
+    """
+    INSERT INTO core_userlog_new SELECT id, user_id, created, page, action, args FROM core_userlog
+    """,
+    """
+    ALTER SEQUENCE core_userlog_id_seq OWNED BY core_userlog_new.id
+    """,
+    """
+    DROP TABLE core_userlog
+    """,
+    """
+    ALTER TABLE core_userlog_new RENAME TO core_userlog
+    """,
+    """
+    ALTER INDEX core_userlog_new_pkey RENAME TO core_userlog_pkey
+    """,
+]
+
+
+
+
+def indexes(cursor, table):
+    """
+    (name, definition) of each of a table's indexes but its primary key.
+    """
+    cursor.execute("""
+                   SELECT c.relname, pg_get_indexdef(i.indexrelid)
+                   FROM pg_index i
+                   JOIN pg_class c ON c.oid = i.indexrelid
+                   WHERE i.indrelid = %s::regclass AND NOT i.indisprimary
+                   """, [table])
+    # a partitioned table's indexes are shown as ON ONLY the parent
+    return [(name, definition.replace(' ON ONLY ', ' ON ')) for name, definition in cursor.fetchall()]
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE relname = 'core_userlog'")
+    return cursor.fetchone()[0]
+
+
+def rebuild(schema_editor, statements):
+    # drop the indexes first, so their names are free for the new table
+    cursor = schema_editor.connection.cursor()
+    saved = indexes(cursor, 'core_userlog')
+    for name, _ in saved:
+        schema_editor.execute("DROP INDEX %s" % schema_editor.quote_name(name))
+    for sql in statements:
+        schema_editor.execute(sql)
+    for _, definition in saved:
+        schema_editor.execute(definition)
+
+
+def created_index(apps, schema_editor):
+    UserLog = apps.get_model('core', 'UserLog')
+    return schema_editor._create_index_sql(UserLog, [UserLog._meta.get_field('created')])
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.pg_version >= 110000:
+        rebuild(schema_editor, PARTITION)
+    schema_editor.execute(created_index(apps, schema_editor))
+
+
+def unpartition(apps, schema_editor):
+    UserLog = apps.get_model('core', 'UserLog')
+    schema_editor.execute("DROP INDEX %s" % schema_editor.quote_name(
+        schema_editor._create_index_name(UserLog, ['created'])))
+    if is_partitioned(schema_editor.connection.cursor()):
+        rebuild(schema_editor, UNPARTITION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_userlogday'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(partition, unpartition),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='userlog',
+                    name='created',
+                    field=models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.core.serializers.json
+import decimal
+import core.json_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_partition_userlog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='event',
+            name='meta',
+            field=core.json_field.JSONField(encode_kwargs={'cls': django.core.serializers.json.DjangoJSONEncoder}, default={}, null=True, lazy=True, decode_kwargs={'parse_float': decimal.Decimal}),
+        ),
+    ]
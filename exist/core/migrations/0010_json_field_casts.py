@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Casting text to a date or timestamp depends on the DateStyle and TimeZone
+# settings, so Postgres won't index those casts. JsonAsDate and
+# JsonAsDatetime call these wrappers instead, which are declared IMMUTABLE
+# so that typed JSON indexes can use them. That holds as long as the values
+# are stored in ISO 8601 and timestamps carry an offset, which is what
+# DjangoJSONEncoder writes.
+FUNCTIONS = [
+    """
+    CREATE OR REPLACE FUNCTION json_field_date(text) RETURNS date
+    AS $$ SELECT $1::date $$ LANGUAGE sql IMMUTABLE STRICT
+    """,
+    """
+    CREATE OR REPLACE FUNCTION json_field_timestamptz(text) RETURNS timestamptz
+    AS $$ SELECT $1::timestamptz $$ LANGUAGE sql IMMUTABLE STRICT
+    """,
+    """
+    CREATE OR REPLACE FUNCTION json_field_timestamp(text) RETURNS timestamp
+    AS $$ SELECT $1::timestamp $$ LANGUAGE sql IMMUTABLE STRICT
+    """,
+]
+
+DROP_FUNCTIONS = [
+    "DROP FUNCTION IF EXISTS json_field_date(text)",
+    "DROP FUNCTION IF EXISTS json_field_timestamptz(text)",
+    "DROP FUNCTION IF EXISTS json_field_timestamp(text)",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_event_meta_lazy'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FUNCTIONS, DROP_FUNCTIONS),
+    ]
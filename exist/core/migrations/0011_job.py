@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_json_field_casts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=20, choices=[('latest', 'Latest values'), ('rollup', 'Daily rollup'), ('correlations', 'Correlations')])),
+                ('priority', models.IntegerField(default=0)),
+                ('state', models.CharField(default='queued', max_length=10, choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')])),
+                ('attempts', models.SmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True, blank=True)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('user', models.ForeignKey(related_name='jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        # one queued job per user and kind (JobManager.enqueue coalesces on
+        # this), and the order jobs are claimed in
+        migrations.RunSQL(
+            [
+                """
+                CREATE UNIQUE INDEX core_job_queued_uniq ON core_job (user_id, kind)
+                WHERE state = 'queued'
+                """,
+                """
+                CREATE INDEX core_job_queued_order ON core_job (priority DESC, run_after)
+                WHERE state = 'queued'
+                """,
+                """
+                CREATE INDEX core_job_running ON core_job (started)
+                WHERE state = 'running'
+                """,
+            ],
+            [
+                "DROP INDEX core_job_queued_uniq",
+                "DROP INDEX core_job_queued_order",
+                "DROP INDEX core_job_running",
+            ],
+        ),
+    ]
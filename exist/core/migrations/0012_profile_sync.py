@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='sync_cursor',
+            field=models.TextField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='last_synced',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_profile_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoreHistory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('score', models.FloatField()),
+                ('user', models.ForeignKey(related_name='score_history', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-day'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='scorehistory',
+            unique_together=set([('user', 'day')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='scorehistory',
+            index_together=set([('day', 'score')]),
+        ),
+    ]
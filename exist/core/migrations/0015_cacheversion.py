@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_rollupwatermark_recent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheVersion',
+            fields=[
+                ('key', models.CharField(max_length=100, serialize=False, primary_key=True)),
+                ('version', models.BigIntegerField()),
+            ],
+        ),
+        # bumps take their values from here, so no value is ever handed out twice
+        migrations.RunSQL("CREATE SEQUENCE core_cacheversion_seq",
+                          "DROP SEQUENCE core_cacheversion_seq"),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_cacheversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='profile_modified',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        # existing profiles count as changed now, which can only make a
+        # client refetch
+        migrations.RunSQL("UPDATE core_user SET profile_modified = floor(extract(epoch FROM now())) * 1000",
+                          migrations.RunSQL.noop),
+    ]
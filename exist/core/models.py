@@ -1,11 +1,16 @@
-from django.db import models
+from django.db import models, connection, transaction
 from .json_field import JSONField
+from .cache import cached_for_user
+from . import catalog, logbuffer, services
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core import validators
 from django.utils.datastructures import SortedDict
+from django.dispatch import Signal
+from django.utils import timezone
+from collections import OrderedDict
 from django.contrib import admin
-import datetime, re, hashlib, math
+import datetime, re, hashlib, math, decimal
 
 
 class User(AbstractUser):
@@ -25,6 +30,8 @@ class User(AbstractUser):
     weekly_email = models.BooleanField(default=True)
     delinquent = models.BooleanField(default=False)
     trial = models.BooleanField(default=True)
+    # when the API profile last changed, see core.cache.profile_stamp
+    profile_modified = models.BigIntegerField(default=0, editable=False)
     
     def is_authenticated(self):
         if self.is_active:
@@ -33,11 +40,11 @@ class User(AbstractUser):
     
     @property
     def attribute_types(self):
-        return [a.attribute for a in self.attributes.all().prefetch_related()]
+        return [catalog.attribute(pk) for pk in self.attributes.values_list('attribute_id', flat=True)]
     
     def auth_hash(self,fieldname):
         return hashlib.sha1("[%s]/%s::%s" % (settings.SECRET_KEY,self.id,fieldname)).hexdigest()
-    
+
     class Meta:
         ordering = ['username']
         unique_together=(('email',),)
@@ -65,6 +72,27 @@ class Attribute(models.Model):
         (TIMEOFDAY_MIDDAY,'Time of day (min from midday)'),
         )
     
+    # SQL aggregate used to combine several values of a type into one,
+    # eg. a day's events or a week of daily values
+    AGGREGATES = {
+        INTEGER: 'SUM',
+        FLOAT: 'AVG',
+        PERIOD: 'SUM',
+        TIMEOFDAY_MIDNIGHT: 'AVG',
+        PERCENTAGE: 'AVG',
+        TIMEOFDAY_MIDDAY: 'AVG',
+        }
+    
+    @classmethod
+    def aggregate_sql(cls, type_column, value_column):
+        """
+        A CASE over value types picking each type's aggregate, for use in a
+        query grouped by `type_column`.
+        """
+        return "CASE %s %s END" % (type_column, " ".join(
+            "WHEN %d THEN %s(%s)" % (value_type, aggregate, value_column)
+            for value_type, aggregate in sorted(cls.AGGREGATES.items())))
+    
     name = models.CharField(max_length=40)
     label = models.CharField(max_length=40)
     priority = models.IntegerField(default=2)
@@ -96,7 +124,26 @@ class AttributeGroup(models.Model):
         ordering = ['priority','label']
     
 
-class UserAttributeManager(models.Manager):
+class UserAttributeQuerySet(models.QuerySet):
+
+    # the latest row's value_type and value columns as one text array, so
+    # each attribute costs a single index lookup
+    LATEST_SQL = """
+                 SELECT ARRAY[d.value_type::text, d.int_value::text, d.float_value::text, d.string_value]
+                 FROM core_userattributedata d
+                 WHERE d.user_attribute_id = core_userattribute.id
+                 ORDER BY d.time DESC LIMIT 1
+                 """
+
+    def with_latest_values(self):
+        """
+        Fetch each attribute's most recent value in the same query, so
+        UserAttribute.value doesn't cost a query per attribute.
+        """
+        return self.extra(select={'latest_data': self.LATEST_SQL})
+
+
+class UserAttributeManager(models.Manager.from_queryset(UserAttributeQuerySet)):
     use_for_related_fields = True
     
     def score(self):
@@ -104,55 +151,43 @@ class UserAttributeManager(models.Manager):
         scores = [att.value for att in atts if att.value is not None]
         return sum(scores)
     
+    @cached_for_user
     def high_priority(self):
-        if not getattr(self,'_high_priority',None):
-            self._high_priority = self.get_query_set().filter(
-                attribute__priority__lte=9,active=True).exclude(
-                attribute__value_type=Attribute.STRING).order_by('attribute__group__priority','attribute__priority').prefetch_related()
-        
-        return self._high_priority
+        return self.get_queryset().filter(
+            attribute__priority__lte=9,active=True).exclude(
+            attribute__value_type=Attribute.STRING).order_by('attribute__group__priority','attribute__priority').with_latest_values()
     
+    @cached_for_user
     def public_high_priority(self):
-        qs = self.high_priority().filter(private=False)
-        return qs
+        return self.get_queryset().filter(
+            attribute__priority__lte=9,active=True,private=False).exclude(
+            attribute__value_type=Attribute.STRING).order_by('attribute__group__priority','attribute__priority').with_latest_values()
     
+    @cached_for_user
     def active(self):
-        if not getattr(self,'_active',None):
-            self._active = self.get_query_set().filter(active=True).prefetch_related()
-        
-        return self._active
-    
+        return self.get_queryset().filter(active=True).with_latest_values()
     
+    @cached_for_user
     def by_name(self):    
-        if not getattr(self,'_attributes',None):
-            result = self.get_query_set().filter(active=True).select_related()
-            self._attributes = dict([(a.attribute.name, a) for a in result])
-        
-        return self._attributes
+        result = self.get_queryset().filter(active=True).with_latest_values()
+        return dict([(a.name, a) for a in result])
     
+    @cached_for_user
     def public_by_name(self):    
-        if not getattr(self,'_public_attributes',None):
-            result = self.get_query_set().filter(active=True,private=False).select_related()
-            self._public_attributes = dict([(a.attribute.name, a) for a in result])
-        
-        return self._public_attributes
+        result = self.get_queryset().filter(active=True,private=False).with_latest_values()
+        return dict([(a.name, a) for a in result])
     
-    def by_group(self):
-        # get all attributes
-        # find which have groups
-        # return a dict of attribute groups
-        
-        result = self.get_query_set().filter(active=True).order_by('attribute__priority').prefetch_related()
-        used_groups = [g.attribute.group.id for g in result if g.attribute.group is not None]
-        
-        _groups = AttributeGroup.objects.filter(id__in=used_groups).order_by('priority','name')
-        grouped = SortedDict([(g.name,{'priority':g.priority,'label':g.label,'attributes':[]}) for g in _groups])
+    def _grouped(self, result):
+        # groups come from the catalog, so there's no query for them
+        groups = dict((att.group.name, att.group) for att in result if att.group is not None)
+        grouped = SortedDict([(g.name,{'priority':g.priority,'label':g.label,'attributes':[]})
+                              for g in sorted(groups.values(), key=lambda g: (g.priority, g.name))])
         
         ungrouped = {'attributes':[]}
         
         for att in result:
-            if att.attribute.group is not None:
-                grouped[att.attribute.group.name]['attributes'].insert(att.priority,att)
+            if att.group is not None:
+                grouped[att.group.name]['attributes'].insert(att.priority,att)
             else:
                 ungrouped['attributes'].append(att)
         
@@ -160,29 +195,21 @@ class UserAttributeManager(models.Manager):
             grouped.update({'ungrouped':ungrouped})
         return grouped
     
-    def by_group_all(self):
-        # this one includes inactive
+    @cached_for_user
+    def by_group(self):
         # get all attributes
         # find which have groups
         # return a dict of attribute groups
         
-        result = self.get_query_set().order_by('attribute__priority').prefetch_related()
-        used_groups = [g.attribute.group.id for g in result if g.attribute.group is not None]
-        
-        _groups = AttributeGroup.objects.filter(id__in=used_groups).order_by('priority','name')
-        grouped = SortedDict([(g.name,{'priority':g.priority,'label':g.label,'attributes':[]}) for g in _groups])
-        
-        ungrouped = {'attributes':[]}
-        
-        for att in result:
-            if att.attribute.group is not None:
-                grouped[att.attribute.group.name]['attributes'].insert(att.priority,att)
-            else:
-                ungrouped['attributes'].append(att)
+        result = self.get_queryset().filter(active=True).order_by('attribute__priority').with_latest_values()
+        return self._grouped(result)
+    
+    @cached_for_user
+    def by_group_all(self):
+        # this one includes inactive
         
-        if len(ungrouped['attributes']) > 0:
-            grouped.update({'ungrouped':ungrouped})
-        return grouped    
+        result = self.get_queryset().order_by('attribute__priority').with_latest_values()
+        return self._grouped(result)
 
     
 class UserAttribute(models.Model):
@@ -194,56 +221,180 @@ class UserAttribute(models.Model):
     private = models.BooleanField(default=False,verbose_name='Private')
 
     def __str__(self):
-        return "%s for %s" % (self.attribute.label, self.user.username)
+        return "%s for %s" % (self.label, self.user.username)
+
+    # Attribute details resolve through the in-process catalog (core.catalog)
+    # rather than the attribute foreign key, so they never cost a query.
+
+    @property
+    def catalog_attribute(self):
+        return catalog.attribute(self.attribute_id)
 
     @property
     def label(self):
-        return self.attribute.label
+        return self.catalog_attribute.label
     
     @property
     def name(self):
-        return self.attribute.name
+        return self.catalog_attribute.name
     
     @property
     def priority(self):
-        return self.attribute.priority
+        return self.catalog_attribute.priority
     
     @property
     def value_type(self):
-        return self.attribute.value_type
+        return self.catalog_attribute.value_type
     
     @property
     def value_type_description(self):
-        return Attribute.VALUE_TYPES[self.attribute.value_type][1]
+        return Attribute.VALUE_TYPES[self.value_type][1]
     
     @property
     def value(self):
-        data = self.data.all()
-        if data.count() > 0:
-            data = data[0]
-            return data.value
+        if hasattr(self, 'latest_data'):
+            # fetched by UserAttributeQuerySet.with_latest_values()
+            if self.latest_data is None:
+                return None
+            field = UserAttributeData.VALUE_FIELDS.get(int(self.latest_data[0]))
+            if field is None:
+                return None
+            value = self.latest_data[1 + ('int_value', 'float_value', 'string_value').index(field)]
+            return UserAttributeData._meta.get_field(field).to_python(value)
+        data = list(self.data.all()[:1])
+        if data:
+            return data[0].value
         return None
     
     @property
     def group(self):
-        
-        if self.attribute.group is not None:
-            return self.attribute.group
-        else:
-            return None
+        return catalog.get_catalog().group(self.catalog_attribute.group_id)
     
     @property
     def available_services(self):
         if not getattr(self,'_available_services',None):
-        
-            self._available_services = Service.objects.filter(id__in=[profile.service.id for profile in self.user.profiles.all()],
-                                                              attributes=self.attribute).order_by('name')
+            service_ids = set(Profile.objects.filter(user=self.user_id).values_list('service_id', flat=True))
+            self._available_services = catalog.get_catalog().services_for(self.attribute_id, service_ids)
         return self._available_services
     
     class Meta:
         ordering = ['attribute__group__priority','attribute__priority','attribute__name']
 
 
+data_bulk_upserted = Signal(providing_args=['user_ids'])
+
+
+class UserAttributeDataManager(models.Manager):
+
+    def bulk_upsert(self, rows, batch_size=1000):
+        """
+        Write (user_attribute, date, value) tuples without instantiating models,
+        routing each value to int_value, float_value or string_value by the
+        attribute's value_type. `user_attribute` may be an instance or an id.
+        Existing rows for the same (user_attribute, date) are overwritten;
+        later tuples win over earlier ones for the same key.
+
+        Returns (inserted, updated). Rows whose value didn't change count
+        as neither. Model signals aren't sent, `data_bulk_upserted` is.
+        Raises ValueError, writing nothing, if a user_attribute doesn't exist.
+        """
+        inserted = updated = 0
+        value_types = {}
+        users = set()
+        batch = OrderedDict()
+
+        def flush():
+            missing = set(ua_id for ua_id, _ in batch) - set(value_types)
+            if missing:
+                for ua_id, value_type, user_id in UserAttribute.objects.filter(id__in=missing).values_list(
+                        'id', 'attribute__value_type', 'user_id'):
+                    value_types[ua_id] = (value_type, user_id)
+                unknown = missing - set(value_types)
+                if unknown:
+                    raise ValueError("No UserAttribute with id %s" % ", ".join(str(i) for i in sorted(unknown)))
+            params = []
+            for (ua_id, time), value in batch.items():
+                value_type, user_id = value_types[ua_id]
+                users.add(user_id)
+                field = UserAttributeData.VALUE_FIELDS[value_type]
+                params.extend([ua_id, time, value_type] +
+                              [value if f == field else None for f in ('int_value', 'float_value', 'string_value')])
+            cursor = connection.cursor()
+            cursor.execute("""
+                           INSERT INTO core_userattributedata
+                               (created, user_attribute_id, time, value_type, int_value, float_value, string_value)
+                           VALUES %s
+                           ON CONFLICT (user_attribute_id, time) DO UPDATE SET
+                               value_type = EXCLUDED.value_type,
+                               int_value = EXCLUDED.int_value,
+                               float_value = EXCLUDED.float_value,
+                               string_value = EXCLUDED.string_value
+                           WHERE (core_userattributedata.value_type, core_userattributedata.int_value,
+                                  core_userattributedata.float_value, core_userattributedata.string_value)
+                                 IS DISTINCT FROM
+                                 (EXCLUDED.value_type, EXCLUDED.int_value, EXCLUDED.float_value, EXCLUDED.string_value)
+                           RETURNING (xmax = 0)
+                           """ % ", ".join(["(now(), %s, %s, %s, %s, %s, %s)"] * len(batch)), params)
+            result = [r[0] for r in cursor.fetchall()]
+            batch.clear()
+            return result.count(True), result.count(False)
+
+        with transaction.atomic():
+            for user_attribute, time, value in rows:
+                ua_id = getattr(user_attribute, 'pk', user_attribute)
+                batch.pop((ua_id, time), None)
+                batch[(ua_id, time)] = value
+                if len(batch) >= batch_size:
+                    i, u = flush()
+                    inserted, updated = inserted + i, updated + u
+            if batch:
+                i, u = flush()
+                inserted, updated = inserted + i, updated + u
+
+        if users:
+            data_bulk_upserted.send(sender=UserAttributeData, user_ids=users)
+        return inserted, updated
+
+    RESOLUTIONS = ('day', 'week', 'month', 'year')
+
+    def series(self, user_attributes, start, end, resolution='day'):
+        """
+        Values for some UserAttributes between two dates (inclusive), downsampled
+        in the database to one point per day, week, month or year using each
+        attribute's aggregate. Returns (dates, {user_attribute_id: values}),
+        columns lined up with `dates` and None where an attribute has no data.
+        """
+        if resolution not in self.RESOLUTIONS:
+            raise ValueError("resolution must be one of %s" % ", ".join(self.RESOLUTIONS))
+        ids = [getattr(ua, 'pk', ua) for ua in user_attributes]
+        if not ids:
+            return [], {}
+
+        cursor = connection.cursor()
+        cursor.execute("""
+                       SELECT d.user_attribute_id, date_trunc(%%s, d.time)::date AS bucket, %s
+                       FROM core_userattributedata d
+                       JOIN core_userattribute ua ON ua.id = d.user_attribute_id
+                       JOIN core_attribute a ON a.id = ua.attribute_id
+                       WHERE d.user_attribute_id IN (%s) AND d.time >= %%s AND d.time <= %%s
+                       AND a.value_type != %%s
+                       GROUP BY d.user_attribute_id, a.value_type, bucket
+                       ORDER BY bucket
+                       """ % (Attribute.aggregate_sql('a.value_type', 'COALESCE(d.float_value, d.int_value)'),
+                               ", ".join(["%s"] * len(ids))),
+                       [resolution] + ids + [start, end, Attribute.STRING])
+
+        dates = []
+        columns = dict((ua_id, []) for ua_id in ids)
+        for ua_id, bucket, value in cursor.fetchall():
+            if not dates or dates[-1] != bucket:
+                dates.append(bucket)
+                for column in columns.values():
+                    column.append(None)
+            columns[ua_id][-1] = float(value) if value is not None else None
+        return dates, columns
+
+
 class UserAttributeData(models.Model):
     user_attribute = models.ForeignKey('UserAttribute',related_name='data')
     created = models.DateTimeField(auto_now_add=True)
@@ -252,42 +403,41 @@ class UserAttributeData(models.Model):
     int_value = models.IntegerField(null=True, blank=True)
     string_value = models.CharField(null=True,max_length=250, blank=True)
     float_value = models.DecimalField(max_digits=16,decimal_places=4, null=True, blank=True)
+    objects = UserAttributeDataManager()
+
+    # which column holds the value for each Attribute value_type
+    VALUE_FIELDS = {
+        Attribute.INTEGER: 'int_value',
+        Attribute.FLOAT: 'float_value',
+        Attribute.STRING: 'string_value',
+        Attribute.PERIOD: 'int_value',
+        Attribute.TIMEOFDAY_MIDNIGHT: 'int_value',
+        Attribute.PERCENTAGE: 'float_value',
+        Attribute.TIMEOFDAY_MIDDAY: 'int_value',
+    }
     
     @property
     def value(self):
         """
         Return the appropriate value type.
         """
-        if self.value_type == 0:
-            return self.int_value
-        if self.value_type == 1:
-            return self.float_value
-        if self.value_type == 2:
-            return self.string_value
-        if self.value_type == 3:
-            return self.int_value
-        if self.value_type == 4:
-            return self.int_value
-        if self.value_type == 5:
-            return self.float_value
-        if self.value_type == 6:
-            return self.int_value
+        field = self.VALUE_FIELDS.get(self.value_type)
+        if field is not None:
+            return getattr(self, field)
         
     def set_value(self,value):
-        if self.value_type == 0:
-            self.int_value = value
-        if self.value_type == 1:
-            self.float_value = value
-        if self.value_type == 2:
-            self.string_value = value
-        if self.value_type == 3:
-            self.int_value = value
-        if self.value_type == 4:
-            self.int_value = value
-        if self.value_type == 5:
-            self.float_value = value
-        if self.value_type == 6:
-            self.int_value = value
+        field = self.VALUE_FIELDS.get(self.value_type)
+        if field is not None:
+            setattr(self, field, value)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(UserAttributeData, cls).from_db(db, field_names, values)
+        # remember what's stored so a later save or delete can retract it
+        # from the correlation statistics
+        if not instance.get_deferred_fields():
+            instance._stored_value = instance.value
+        return instance
 
     def __str__(self):
         return "%s: %s: %s" % (self.user_attribute.user.username, self.user_attribute.attribute.label, unicode(self.value))
@@ -297,6 +447,149 @@ class UserAttributeData(models.Model):
         unique_together=('user_attribute','time')
 
 
+class CorrelationStatisticManager(models.Manager):
+
+    FOUR_PLACES = decimal.Decimal('0.0001')
+
+    def _decimal(self, value):
+        if value is None:
+            return None
+        if isinstance(value, float):
+            value = str(value)
+        # match what a DecimalField(decimal_places=4) will actually store,
+        # so retracting later subtracts exactly what was added
+        return decimal.Decimal(value).quantize(self.FOUR_PLACES)
+
+    def record_change(self, user_attribute_id, time, old, new):
+        """
+        Update the sums for every pair involving this user attribute after its
+        value on `time` changed from `old` to `new` (either may be None).
+        String attributes take no part, and their values are left alone.
+        """
+        if old == new:
+            return
+
+        attributes = dict((ua_id, (user_id, offset)) for ua_id, user_id, offset in
+                          UserAttribute.objects.filter(user__attributes=user_attribute_id)
+                          .exclude(attribute__value_type=Attribute.STRING)
+                          .values_list('id', 'user_id', 'attribute__correlation_offset'))
+        if user_attribute_id not in attributes:
+            return
+        user_id, offset = attributes.pop(user_attribute_id)
+        old, new = self._decimal(old), self._decimal(new)
+        if old == new:
+            return
+
+        # the other attribute's day that lines up with this one
+        aligned = dict((ua_id, time - datetime.timedelta(days=offset - other_offset))
+                       for ua_id, (_, other_offset) in attributes.items())
+        if not aligned:
+            return
+        others = UserAttributeData.objects.filter(
+            user_attribute__in=list(aligned), time__in=set(aligned.values())).order_by().values_list(
+            'user_attribute_id', 'time', 'int_value', 'float_value')
+
+        dn = (new is not None) - (old is not None)
+        dx = (new or 0) - (old or 0)
+        dxx = (new or 0) ** 2 - (old or 0) ** 2
+
+        rows = []
+        for other_id, other_time, int_value, float_value in others:
+            y = self._decimal(int_value if float_value is None else float_value)
+            if y is None or aligned[other_id] != other_time:
+                continue
+            if user_attribute_id < other_id:
+                rows.append((user_id, user_attribute_id, other_id, dn, dx, dn * y, dx * y, dxx, dn * y * y))
+            else:
+                rows.append((user_id, other_id, user_attribute_id, dn, dn * y, dx, dx * y, dn * y * y, dxx))
+        if not rows:
+            return
+
+        cursor = connection.cursor()
+        cursor.execute("""
+                       INSERT INTO core_correlationstatistic
+                           (user_id, attribute_id, other_id, n, sum_x, sum_y, sum_xy, sum_xx, sum_yy, updated)
+                       VALUES %s
+                       ON CONFLICT (attribute_id, other_id) DO UPDATE SET
+                           n = core_correlationstatistic.n + EXCLUDED.n,
+                           sum_x = core_correlationstatistic.sum_x + EXCLUDED.sum_x,
+                           sum_y = core_correlationstatistic.sum_y + EXCLUDED.sum_y,
+                           sum_xy = core_correlationstatistic.sum_xy + EXCLUDED.sum_xy,
+                           sum_xx = core_correlationstatistic.sum_xx + EXCLUDED.sum_xx,
+                           sum_yy = core_correlationstatistic.sum_yy + EXCLUDED.sum_yy,
+                           updated = EXCLUDED.updated
+                       """ % ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, now())"] * len(rows)),
+                       [v for row in rows for v in row])
+
+    def rebuild_for_user(self, user):
+        """
+        Recompute a user's sums from scratch in one set-based pass, eg. after
+        an Attribute's correlation_offset changes or after bulk writes.
+        """
+        user_id = getattr(user, 'pk', user)
+        with transaction.atomic():
+            self.filter(user=user_id).delete()
+            cursor = connection.cursor()
+            cursor.execute("""
+                           INSERT INTO core_correlationstatistic
+                               (user_id, attribute_id, other_id, n, sum_x, sum_y, sum_xy, sum_xx, sum_yy, updated)
+                           SELECT ua.user_id, ua.id, ub.id, COUNT(*),
+                                  SUM(x.v), SUM(y.v), SUM(x.v * y.v), SUM(x.v * x.v), SUM(y.v * y.v), now()
+                           FROM core_userattribute ua
+                           JOIN core_attribute aa ON aa.id = ua.attribute_id
+                           JOIN core_userattribute ub ON ub.user_id = ua.user_id AND ub.id > ua.id
+                           JOIN core_attribute ab ON ab.id = ub.attribute_id
+                           JOIN (SELECT user_attribute_id, time, COALESCE(float_value, int_value) AS v
+                                 FROM core_userattributedata) x ON x.user_attribute_id = ua.id
+                           JOIN (SELECT user_attribute_id, time, COALESCE(float_value, int_value) AS v
+                                 FROM core_userattributedata) y ON y.user_attribute_id = ub.id
+                                AND y.time = x.time - aa.correlation_offset + ab.correlation_offset
+                           WHERE ua.user_id = %s
+                           AND aa.value_type != %s AND ab.value_type != %s
+                           AND x.v IS NOT NULL AND y.v IS NOT NULL
+                           GROUP BY ua.user_id, ua.id, ub.id
+                           """, [user_id, Attribute.STRING, Attribute.STRING])
+
+    def for_user(self, user, min_days=30):
+        return self.filter(user=user, n__gte=min_days).select_related('attribute__attribute',
+                                                                      'other__attribute')
+
+
+class CorrelationStatistic(models.Model):
+    """
+    Running sums for one pair of a user's attributes, lined up by their
+    correlation offsets, so Pearson's r can be read off without a rescan.
+    `attribute` always has the lower id of the pair.
+    """
+    user = models.ForeignKey('User',related_name='correlation_statistics')
+    attribute = models.ForeignKey('UserAttribute',related_name='+')
+    other = models.ForeignKey('UserAttribute',related_name='+')
+    n = models.IntegerField(default=0)
+    sum_x = models.DecimalField(max_digits=40,decimal_places=8,default=0)
+    sum_y = models.DecimalField(max_digits=40,decimal_places=8,default=0)
+    sum_xy = models.DecimalField(max_digits=40,decimal_places=8,default=0)
+    sum_xx = models.DecimalField(max_digits=40,decimal_places=8,default=0)
+    sum_yy = models.DecimalField(max_digits=40,decimal_places=8,default=0)
+    updated = models.DateTimeField(auto_now=True)
+    objects = CorrelationStatisticManager()
+
+    @property
+    def pearson(self):
+        if self.n < 3:
+            return None
+        var_x = self.n * self.sum_xx - self.sum_x ** 2
+        var_y = self.n * self.sum_yy - self.sum_y ** 2
+        if var_x <= 0 or var_y <= 0:
+            return None
+        return float(self.n * self.sum_xy - self.sum_x * self.sum_y) / math.sqrt(float(var_x) * float(var_y))
+
+    def __str__(self):
+        return "%s / %s: %s" % (self.attribute.label, self.other.label, self.pearson)
+
+    class Meta:
+        unique_together = (('attribute','other'),)
+
+
 
 
 class Service(models.Model):
@@ -332,6 +625,16 @@ class Service(models.Model):
         return p
 
 
+class ProfileQuerySet(models.QuerySet):
+
+    def with_concrete(self):
+        """
+        Fetch each profile's service and concrete profile in the same query,
+        so Profile.concrete doesn't cost a query per profile.
+        """
+        return self.select_related('service', *services.profile_accessors())
+
+
 class Profile(models.Model):
     """
     A relationship between a user and a service.
@@ -342,6 +645,9 @@ class Profile(models.Model):
     service = models.ForeignKey('Service',related_name='users')
     created = models.DateTimeField(auto_now_add=True)
     enabled = models.BooleanField(default=True)
+    sync_cursor = models.TextField(null=True,blank=True) #where the next sync starts, see core.sync
+    last_synced = models.DateTimeField(null=True,blank=True)
+    objects = models.Manager.from_queryset(ProfileQuerySet)()
 
     def __str__(self):
         return "%s on %s" % (self.user.username, self.service.name)
@@ -352,18 +658,11 @@ class Profile(models.Model):
         
     @property
     def concrete_model(self):
-        try:
-            return self._service_model
-        except:
-            slug = self.service.slug
-            mod = __import__('services.%s.models' % slug,
-                             fromlist=['%sProfile' % (slug.title())])
-            self._service_model = getattr(mod,'%sProfile' % (slug.title()))
-        return self._service_model
+        return services.get_model(self.service.slug)
     
     @property
     def concrete(self):
-        return getattr(self,'%sprofile' % (self.service.slug))
+        return getattr(self,self.concrete_model._meta.model_name)
     
     @staticmethod
     def type_sort(profile):
@@ -374,11 +673,11 @@ class Profile(models.Model):
 class Event(models.Model):
     user = models.ForeignKey('User',related_name='events')
     attribute = models.ForeignKey('Attribute',related_name='events')
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(auto_now_add=True,db_index=True)
     time = models.DateTimeField()
     value = models.DecimalField(null=True,blank=True,max_digits=16,decimal_places=4)
     value_type = models.SmallIntegerField()
-    meta = JSONField(null=True, default={})
+    meta = JSONField(null=True, default={}, lazy=True)
     
     def __str__(self):
         return "[%s] %s: %s" % (self.created.strftime("%Y-%m-%d %H:%M:%S"), self.user.username, self.attribute.name)
@@ -387,7 +686,41 @@ class Event(models.Model):
         unique_together = (("user","attribute","time"),)
 
 
+class RollupWatermark(models.Model):
+    """
+    How far through a user's events (by Event.created) the daily rollup has got:
+    every event up to `rolled_up`, and `recent` events after it.
+    """
+    user = models.OneToOneField('User',primary_key=True,related_name='rollup_watermark')
+    rolled_up = models.DateTimeField()
+    recent = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "%s: %s" % (self.user.username, self.rolled_up)
+
+
 class UserLogManager(models.Manager):
+    """
+    Activity reports. These read the daily UserLogDay counts rather than
+    scanning core_userlog, so they're cheap over any period; page/action
+    popularity is counted per day and doesn't break down by args.
+    """
+    
+    def record(self, user, page, action, args=None):
+        """
+        Log a page view or action. With settings.USERLOG_BUFFER enabled this
+        only buffers it (see core.logbuffer) and returns None; otherwise the
+        log is saved and returned.
+        """
+        buffer = logbuffer.get_buffer()
+        if buffer is not None:
+            buffer.append(getattr(user, 'pk', user), page, action, args)
+            return None
+        return self.create(user_id=getattr(user, 'pk', user), page=page, action=action, args=args)
+    
+    def _period(self, days_ago_start, days_ago_end):
+        today = datetime.date.today()
+        return today - datetime.timedelta(days=days_ago_start), today - datetime.timedelta(days=days_ago_end)
     
     def most_active_in_period(self, days_ago_start, days_ago_end=0, limit=20):
         """
@@ -395,76 +728,86 @@ class UserLogManager(models.Manager):
         Leaving the end delta empty uses today's date.
         """
         
-        date_start = datetime.date.today() - datetime.timedelta(days=days_ago_start)
-        date_end = datetime.date.today() + datetime.timedelta(days=1) - datetime.timedelta(days=days_ago_end)
+        date_start, date_end = self._period(days_ago_start, days_ago_end)
         
         return User.objects.raw("""
-                                 SELECT core_user.*, COUNT(core_userlog.id) AS log_count
-                                 FROM core_userlog
-                                 RIGHT JOIN (core_user) ON (core_userlog.user_id = core_user.id)
-                                 WHERE core_userlog.created >= %s AND core_userlog.created <= %s
-                                 GROUP BY core_userlog.user_id
+                                 SELECT core_user.*, SUM(core_userlogday.count) AS log_count
+                                 FROM core_userlogday
+                                 JOIN core_user ON (core_userlogday.user_id = core_user.id)
+                                 WHERE core_userlogday.day >= %s AND core_userlogday.day <= %s
+                                 GROUP BY core_user.id
                                  ORDER BY log_count DESC
-                                 LIMIT 0, %s
+                                 LIMIT %s
                                  """,[date_start, date_end, limit])
     
     def most_active_days(self, days_ago_start, days_ago_end=0, limit=20):
         """
         Ranking of users by number of days they've made logs in period
         """
-        date_start = datetime.date.today() - datetime.timedelta(days=days_ago_start)
-        date_end = datetime.date.today() + datetime.timedelta(days=1) - datetime.timedelta(days=days_ago_end)
+        date_start, date_end = self._period(days_ago_start, days_ago_end)
         
         return User.objects.raw("""
-                                 SELECT core_user.*, COUNT(DISTINCT DATE(core_userlog.created)) AS log_count
-                                 FROM core_user
-                                 RIGHT JOIN (core_userlog) ON ( core_userlog.user_id = core_user.id )
-                                 WHERE core_userlog.created >= %s AND core_userlog.created <= %s
+                                 SELECT core_user.*, COUNT(DISTINCT core_userlogday.day) AS log_count
+                                 FROM core_userlogday
+                                 JOIN core_user ON (core_userlogday.user_id = core_user.id)
+                                 WHERE core_userlogday.day >= %s AND core_userlogday.day <= %s
                                  GROUP BY core_user.id
                                  ORDER BY log_count DESC
-                                 LIMIT 0, %s
+                                 LIMIT %s
                                  """, [date_start, date_end, limit])
         
     
     def most_popular_in_period(self, days_ago_start, days_ago_end=0, limit=20):
         """
-        Ranking of page/action combos by popularity
+        Ranking of page/action combos by popularity, as the latest UserLog
+        of each with its log_count annotated.
         """
-        date_start = datetime.date.today() - datetime.timedelta(days=days_ago_start)
-        date_end = datetime.date.today() - datetime.timedelta(days=days_ago_end)
+        date_start, date_end = self._period(days_ago_start, days_ago_end)
         
         return self.raw("""
-                        SELECT core_userlog.*, COUNT(*) AS log_count FROM core_userlog
-                        WHERE core_userlog.created >= %s AND core_userlog.created <= %s
-                        GROUP BY core_userlog.page, core_userlog.action, core_userlog.args
-                        ORDER BY log_count DESC
-                        LIMIT 0, %s
-                        """,[date_start, date_end, limit])
+                        SELECT core_userlog.*, top.log_count
+                        FROM (
+                            SELECT page, action, SUM(count) AS log_count
+                            FROM core_userlogday
+                            WHERE day >= %(start)s AND day <= %(end)s
+                            GROUP BY page, action
+                            ORDER BY log_count DESC
+                            LIMIT %(limit)s
+                        ) top
+                        JOIN LATERAL (
+                            SELECT * FROM core_userlog
+                            WHERE page = top.page AND action = top.action
+                            AND created >= %(start)s::timestamp AT TIME ZONE %(tz)s
+                            AND created < (%(end)s::date + 1)::timestamp AT TIME ZONE %(tz)s
+                            ORDER BY created DESC
+                            LIMIT 1
+                        ) core_userlog ON true
+                        ORDER BY top.log_count DESC
+                        """, {'start': date_start, 'end': date_end, 'limit': limit, 'tz': settings.TIME_ZONE})
     
     
     def viewed_delete_in_period(self, days_ago_start, days_ago_end=0):
         """
         All users with an `account_delete.view` log in period.
         """
-        date_start = datetime.date.today() - datetime.timedelta(days=days_ago_start)
-        date_end = datetime.date.today() + datetime.timedelta(days=1) - datetime.timedelta(days=days_ago_end)
+        date_start, date_end = self._period(days_ago_start, days_ago_end)
         
         return User.objects.raw("""
-                                 SELECT core_user.*, core_userlog.created AS log_date
-                                 FROM core_userlog
-                                 RIGHT JOIN (core_user) ON (core_userlog.user_id = core_user.id)
-                                 WHERE core_userlog.created >= %s AND core_userlog.created <= %s
-                                 AND core_userlog.page = 'account_delete'
-                                 AND core_userlog.action = 'view'
-                                 AND core_user.is_active = 1
-                                 GROUP BY core_userlog.user_id
-                                 ORDER BY created DESC
+                                 SELECT core_user.*, MAX(core_userlogday.day) AS log_date
+                                 FROM core_userlogday
+                                 JOIN core_user ON (core_userlogday.user_id = core_user.id)
+                                 WHERE core_userlogday.day >= %s AND core_userlogday.day <= %s
+                                 AND core_userlogday.page = 'account_delete'
+                                 AND core_userlogday.action = 'view'
+                                 AND core_user.is_active
+                                 GROUP BY core_user.id
+                                 ORDER BY log_date DESC
                                  """,[date_start, date_end])
 
 
 class UserLog(models.Model):
     user =          models.ForeignKey(User,related_name='logs')
-    created =       models.DateTimeField(auto_now_add=True)
+    created =       models.DateTimeField(auto_now_add=True, db_index=True)
     page =          models.CharField(max_length=128, db_index=True)
     action =        models.CharField(max_length=128)
     args =          models.TextField(null=True,blank=True)
@@ -477,3 +820,368 @@ class UserLog(models.Model):
         ordering = ['-created']
 
     
+
+
+class UserLogDayManager(models.Manager):
+    
+    def record(self, logs):
+        """
+        Add UserLogs (or anything with user_id, created, page and action)
+        to the daily counts, in one statement.
+        """
+        counts = {}
+        for log in logs:
+            key = (log.user_id, timezone.localtime(log.created).date(), log.page, log.action)
+            counts[key] = counts.get(key, 0) + 1
+        if not counts:
+            return
+        
+        cursor = connection.cursor()
+        cursor.execute("""
+                       INSERT INTO core_userlogday (user_id, day, page, action, count)
+                       VALUES %s
+                       ON CONFLICT (user_id, day, page, action)
+                       DO UPDATE SET count = core_userlogday.count + EXCLUDED.count
+                       """ % ", ".join(["(%s, %s, %s, %s, %s)"] * len(counts)),
+                       [v for key, count in counts.items() for v in key + (count,)])
+    
+    def rebuild(self, date_start, date_end):
+        """
+        Recount the days between two dates (inclusive) from core_userlog.
+        """
+        with transaction.atomic():
+            self.filter(day__gte=date_start, day__lte=date_end).delete()
+            cursor = connection.cursor()
+            cursor.execute("""
+                           INSERT INTO core_userlogday (user_id, day, page, action, count)
+                           SELECT user_id, (created AT TIME ZONE %(tz)s)::date AS day, page, action, COUNT(*)
+                           FROM core_userlog
+                           WHERE created >= %(start)s::timestamp AT TIME ZONE %(tz)s
+                           AND created < (%(end)s::date + 1)::timestamp AT TIME ZONE %(tz)s
+                           GROUP BY user_id, day, page, action
+                           """, {'tz': settings.TIME_ZONE, 'start': date_start, 'end': date_end})
+
+
+class UserLogDay(models.Model):
+    """
+    How many times a user logged each page/action on a day (in TIME_ZONE),
+    for UserLogManager's reports. Buffered logs (core.logbuffer) are counted
+    as they're flushed; `manage.py userlog_days` recounts recent days from
+    core_userlog to take in logs saved any other way.
+    """
+    user = models.ForeignKey(User,related_name='log_days')
+    day = models.DateField(db_index=True)
+    page = models.CharField(max_length=128)
+    action = models.CharField(max_length=128)
+    count = models.IntegerField(default=0)
+    objects = UserLogDayManager()
+    
+    def __str__(self):
+        return "%s: %s.%s on %s" % (self.user.username, self.page, self.action, self.day)
+    
+    class Meta:
+        ordering = ['-day']
+        unique_together = (('user','day','page','action'),)
+
+
+class JobManager(models.Manager):
+    """
+    A Postgres-backed queue of per-user recomputation jobs (see core.jobs).
+    There's at most one queued job per user and kind: queueing another
+    just raises its priority and brings it forward.
+    """
+
+    # Higher runs first. Delinquent users go last; paying users before
+    # trials; and up to a week's worth of points for having been seen
+    # recently, an hour at a time.
+    PRIORITY_SQL = """
+        CASE WHEN core_user.delinquent THEN 0 ELSE
+            CASE WHEN core_user.trial THEN 50 ELSE 100 END
+            + GREATEST(0, 168 - FLOOR(EXTRACT(EPOCH FROM now() - COALESCE(core_user.last_seen_activity,
+                                                                        now() - interval '1 year')) / 3600))::int
+        END
+    """
+
+    # Serialises claiming, so the running-job count can't be overshot.
+    CLAIM_LOCK = 0x6a6f6273
+
+    # Queues the jobs a `requeue` CTE returns again, once per user and
+    # kind, as new rows. A job already queued for the same user and kind,
+    # even by a concurrent enqueue(), wins rather than breaking
+    # core_job_queued_uniq.
+    REQUEUE_SQL = """
+        INSERT INTO core_job (user_id, kind, priority, state, attempts, run_after, created, error)
+        SELECT DISTINCT ON (user_id, kind) user_id, kind, priority, 'queued', attempts,
+               now() + %(delay)s * interval '1 second', now(), %(error)s
+        FROM requeue
+        ORDER BY user_id, kind, priority DESC
+        ON CONFLICT (user_id, kind) WHERE state = 'queued' DO NOTHING
+    """
+
+    def enqueue(self, kind, users, delay=0):
+        """
+        Queue `kind` for `users` (instances, ids or a queryset), to run no
+        sooner than `delay` seconds from now. Returns (queued, coalesced)
+        counts.
+        """
+        if hasattr(users, 'values_list'):
+            user_ids = list(users.values_list('id', flat=True))
+        else:
+            user_ids = [getattr(user, 'pk', user) for user in users]
+        if not user_ids:
+            return 0, 0
+        cursor = connection.cursor()
+        cursor.execute("""
+                       INSERT INTO core_job (user_id, kind, priority, state, attempts, run_after, created)
+                       SELECT core_user.id, %%(kind)s, %s, 'queued', 0,
+                              now() + %%(delay)s * interval '1 second', now()
+                       FROM core_user
+                       WHERE core_user.id = ANY(%%(ids)s)
+                       ON CONFLICT (user_id, kind) WHERE state = 'queued' DO UPDATE
+                       SET priority = GREATEST(core_job.priority, EXCLUDED.priority),
+                           run_after = LEAST(core_job.run_after, EXCLUDED.run_after)
+                       RETURNING xmax = 0
+                       """ % self.PRIORITY_SQL, {'kind': kind, 'delay': delay, 'ids': user_ids})
+        created = [row[0] for row in cursor.fetchall()]
+        return created.count(True), created.count(False)
+
+    def claim(self, limit, max_running):
+        """
+        Mark up to `limit` due jobs as running, highest priority first,
+        keeping no more than `max_running` running across all workers.
+        Returns the claimed jobs.
+        """
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [self.CLAIM_LOCK])
+            cursor.execute("""
+                           WITH next AS (
+                               SELECT id FROM core_job
+                               WHERE state = 'queued' AND run_after <= now()
+                               ORDER BY priority DESC, run_after
+                               LIMIT LEAST(%(limit)s, GREATEST(0, %(max_running)s -
+                                   (SELECT COUNT(*) FROM core_job WHERE state = 'running')))
+                               FOR UPDATE SKIP LOCKED
+                           )
+                           UPDATE core_job
+                           SET state = 'running', started = now(), attempts = attempts + 1
+                           FROM next
+                           WHERE core_job.id = next.id
+                           RETURNING core_job.id
+                           """, {'limit': limit, 'max_running': max_running})
+            ids = [row[0] for row in cursor.fetchall()]
+        return list(self.filter(id__in=ids).select_related('user').order_by('-priority'))
+
+    def finish(self, job, error=None, retry_after=None):
+        """
+        Mark a claimed job done, or failed with `error`. A failed job with
+        `retry_after` (seconds) is queued again as a new job, unless one
+        for the same user and kind is already waiting.
+        """
+        cursor = connection.cursor()
+        if error is not None and retry_after is not None:
+            cursor.execute("""
+                           WITH requeue AS (
+                               UPDATE core_job SET state = 'failed', error = %(error)s, finished = now()
+                               WHERE id = %(id)s
+                               RETURNING user_id, kind, priority, attempts
+                           )
+                           """ + self.REQUEUE_SQL, {'id': job.id, 'error': error, 'delay': retry_after})
+            return
+        cursor.execute("UPDATE core_job SET state = %s, error = %s, finished = now() WHERE id = %s",
+                       [Job.FAILED if error is not None else Job.DONE, error or '', job.id])
+
+    def requeue_stale(self, older_than, max_attempts):
+        """
+        Fail jobs that have been running for more than `older_than` seconds
+        (their worker died) and queue each user and kind among them again,
+        unless it's already queued or has had `max_attempts` attempts, as
+        with any failure. Returns how many were queued.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+                       WITH stale AS (
+                           UPDATE core_job SET state = 'failed', error = %(error)s, finished = now()
+                           WHERE state = 'running' AND started < now() - %(older_than)s * interval '1 second'
+                           RETURNING user_id, kind, priority, attempts
+                       ), requeue AS (
+                           SELECT * FROM stale WHERE attempts < %(max_attempts)s
+                       )
+                       """ + self.REQUEUE_SQL, {'older_than': older_than, 'max_attempts': max_attempts,
+                                                'error': 'stale', 'delay': 0})
+        return cursor.rowcount
+
+    def purge(self, older_than):
+        """
+        Delete finished jobs older than `older_than` seconds.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+                       DELETE FROM core_job
+                       WHERE state IN ('done', 'failed') AND finished < now() - %s * interval '1 second'
+                       """, [older_than])
+        return cursor.rowcount
+
+
+class Job(models.Model):
+    """
+    Per-user recomputation work, see JobManager and core.jobs.
+    """
+    LATEST = 'latest'
+    ROLLUP = 'rollup'
+    CORRELATIONS = 'correlations'
+    KINDS = (
+        (LATEST, 'Latest values'),
+        (ROLLUP, 'Daily rollup'),
+        (CORRELATIONS, 'Correlations'),
+    )
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    user = models.ForeignKey(User,related_name='jobs')
+    kind = models.CharField(max_length=20,choices=KINDS)
+    priority = models.IntegerField(default=0)
+    state = models.CharField(max_length=10,choices=STATES,default=QUEUED)
+    attempts = models.SmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True,blank=True)
+    finished = models.DateTimeField(null=True,blank=True)
+    error = models.TextField(blank=True)
+    objects = JobManager()
+
+    def __str__(self):
+        return "%s for %s (%s)" % (self.kind, self.user.username, self.state)
+
+
+class ScoreHistoryManager(models.Manager):
+    """
+    Daily scores for every user, as UserAttributeManager.score() would have
+    given them at the end of each day: the sum of the latest values (up to
+    that day) of their active, high-priority numeric attributes.
+    """
+
+    def compute_day(self, day):
+        """
+        Write every user's score for `day`, and drop that day's scores for
+        users who no longer have one, in one statement. Returns how many
+        users got a score.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+                       WITH scores AS (
+                           SELECT ua.user_id, COALESCE(SUM(latest.value), 0) AS score
+                           FROM core_userattribute ua
+                           JOIN core_attribute a ON a.id = ua.attribute_id
+                           JOIN LATERAL (
+                               SELECT COALESCE(d.float_value, d.int_value) AS value
+                               FROM core_userattributedata d
+                               WHERE d.user_attribute_id = ua.id AND d.time <= %(day)s
+                               ORDER BY d.time DESC
+                               LIMIT 1
+                           ) latest ON true
+                           WHERE ua.active AND a.priority <= 9 AND a.value_type <> %(string)s
+                           GROUP BY ua.user_id
+                       ), written AS (
+                           INSERT INTO core_scorehistory (user_id, day, score)
+                           SELECT user_id, %(day)s, score FROM scores
+                           ON CONFLICT (user_id, day) DO UPDATE SET score = EXCLUDED.score
+                           RETURNING 1
+                       ), removed AS (
+                           DELETE FROM core_scorehistory h
+                           WHERE h.day = %(day)s
+                           AND NOT EXISTS (SELECT 1 FROM scores WHERE scores.user_id = h.user_id)
+                           RETURNING 1
+                       )
+                       SELECT (SELECT COUNT(*) FROM written), (SELECT COUNT(*) FROM removed)
+                       """, {'day': day, 'string': Attribute.STRING})
+        return cursor.fetchone()[0]
+
+    def leaderboard(self, day, limit=10, offset=0, public_only=True):
+        """
+        The top scores on `day` as dicts of rank, username and score (ties
+        share a rank). `public_only` leaves out private profiles, without
+        changing anyone's rank.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+                       SELECT ranked.rank, core_user.username, ranked.score
+                       FROM (
+                           SELECT user_id, score, RANK() OVER (ORDER BY score DESC) AS rank
+                           FROM core_scorehistory
+                           WHERE day = %(day)s
+                       ) ranked
+                       JOIN core_user ON core_user.id = ranked.user_id
+                       WHERE NOT %(public_only)s OR NOT core_user.private
+                       ORDER BY ranked.rank, core_user.username
+                       LIMIT %(limit)s OFFSET %(offset)s
+                       """, {'day': day, 'limit': limit, 'offset': offset, 'public_only': public_only})
+        return [{'rank': rank, 'username': username, 'score': score}
+                for rank, username, score in cursor.fetchall()]
+
+    def percentile(self, user, day):
+        """
+        The percentage of users who scored lower than `user` on `day`, or
+        None if they have no score that day.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+                       SELECT COUNT(*) FILTER (WHERE s.score < me.score), COUNT(*)
+                       FROM core_scorehistory s,
+                            (SELECT score FROM core_scorehistory WHERE user_id = %(user)s AND day = %(day)s) me
+                       WHERE s.day = %(day)s
+                       """, {'user': getattr(user, 'pk', user), 'day': day})
+        lower, total = cursor.fetchone()
+        if not total:
+            return None
+        return 100.0 * lower / total
+
+    def distribution(self, day, fractions=(0.1, 0.25, 0.5, 0.75, 0.9)):
+        """
+        Scores at each of `fractions` of the population on `day`, as an
+        OrderedDict of fraction -> score; empty if nobody has a score.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+                       SELECT percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY score)
+                       FROM core_scorehistory
+                       WHERE day = %s
+                       """, [list(fractions), day])
+        scores = cursor.fetchone()[0]
+        return OrderedDict(zip(fractions, scores or []))
+
+
+class ScoreHistory(models.Model):
+    """
+    A user's score at the end of a day, see ScoreHistoryManager.
+    """
+    user = models.ForeignKey(User,related_name='score_history')
+    day = models.DateField()
+    score = models.FloatField()
+    objects = ScoreHistoryManager()
+
+    def __str__(self):
+        return "%s on %s: %s" % (self.user.username, self.day, self.score)
+
+    class Meta:
+        ordering = ['-day']
+        unique_together = (('user','day'),)
+        index_together = (('day','score'),)
+
+
+class CacheVersion(models.Model):
+    """
+    A version stamp for cached results, see core.cache.
+    """
+    key = models.CharField(max_length=100,primary_key=True)
+    version = models.BigIntegerField()
+
+    def __str__(self):
+        return "%s: %s" % (self.key, self.version)
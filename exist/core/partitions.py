@@ -0,0 +1,162 @@
+"""
+Monthly partitions for core_userlog.
+
+core_userlog is range partitioned on `created` (migration 0008), one
+partition per calendar month (UTC) named core_userlog_pYYYYMM, plus
+core_userlog_default for anything outside them. Queries filtering on
+`created` only touch the partitions they need. On Postgres older than 11
+the table isn't partitioned, and none of this does anything.
+
+Partitions older than the retention window are written to gzipped CSV
+files and dropped, and so are rows that old in the default partition; the
+daily counts in UserLogDay are kept, so activity reports still cover
+archived months.
+"""
+import datetime
+import gzip
+import os
+import re
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+TABLE = 'core_userlog'
+DEFAULT_PARTITION = 'core_userlog_default'
+PARTITION_NAME = re.compile(r'^core_userlog_p(\d{4})(\d{2})$')
+
+
+def month_start(date, months=0):
+    """
+    The first of the month `months` after (or before) `date`'s.
+    """
+    index = date.year * 12 + date.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return 'core_userlog_p%04d%02d' % (month.year, month.month)
+
+
+def is_partitioned():
+    cursor = connection.cursor()
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE relname = %s", [TABLE])
+    return cursor.fetchone()[0]
+
+
+def partitions():
+    """
+    Months with a partition, oldest first.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+                   SELECT child.relname
+                   FROM pg_inherits
+                   JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                   JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                   WHERE parent.relname = %s
+                   """, [TABLE])
+    months = []
+    for name, in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(datetime.date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def create_partition(month):
+    """
+    Add the partition for `month`, moving in any of its rows that landed in
+    the default partition. Returns False if it already exists.
+    """
+    month = month_start(month)
+    if month in partitions():
+        return False
+    name = partition_name(month)
+    lower, upper = '%s 00:00+00' % month, '%s 00:00+00' % month_start(month, 1)
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" % (name, TABLE))
+        cursor.execute("""
+                       WITH moved AS (
+                           DELETE FROM %s WHERE created >= %%s AND created < %%s RETURNING *
+                       )
+                       INSERT INTO %s SELECT * FROM moved
+                       """ % (DEFAULT_PARTITION, name), [lower, upper])
+        cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)" % (TABLE, name),
+                       [lower, upper])
+    return True
+
+
+def archive_partition(month, directory):
+    """
+    Write a month's logs to <directory>/core_userlog_pYYYYMM.csv.gz, then
+    detach and drop the partition. Returns the archive's path.
+    """
+    name = partition_name(month)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '%s.csv.gz' % name)
+    partial = path + '.partial'
+
+    cursor = connection.cursor()
+    with gzip.open(partial, 'wt', encoding='utf-8') as archive:
+        cursor.cursor.copy_expert("COPY %s TO STDOUT WITH CSV HEADER" % name, archive)
+    os.rename(partial, path)
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (TABLE, name))
+        cursor.execute("DROP TABLE %s" % name)
+    return path
+
+
+def archive_default(before, directory):
+    """
+    Move rows of the default partition created before `before` (a date) to
+    <directory>/core_userlog_default_YYYYMMDDHHMMSS.csv.gz. Returns the
+    archive's path, or None if there were none.
+    """
+    lower = '%s 00:00+00' % before
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '%s_%s.csv.gz' % (DEFAULT_PARTITION, timezone.now().strftime('%Y%m%d%H%M%S')))
+    partial = path + '.partial'
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM %s WHERE created < %%s)" % DEFAULT_PARTITION, [lower])
+        if not cursor.fetchone()[0]:
+            return None
+        # deleted by the same statement that writes them out, so nothing
+        # arriving meanwhile is lost; a failed write rolls the delete back
+        sql = cursor.cursor.mogrify("COPY (DELETE FROM %s WHERE created < %%s RETURNING *) TO STDOUT WITH CSV HEADER"
+                                    % DEFAULT_PARTITION, [lower])
+        with gzip.open(partial, 'wt', encoding='utf-8') as archive:
+            cursor.cursor.copy_expert(sql.decode('utf-8'), archive)
+    os.rename(partial, path)
+    return path
+
+
+def maintain(ahead=3, retain=13, directory=None, today=None):
+    """
+    Make sure partitions exist from this month to `ahead` months out, and
+    archive the logs from more than `retain` months ago (when a directory
+    is given). Returns (created, archived, default_archive): lists of months
+    whose partition was created or archived, and the path of the default
+    partition's archive or None.
+    """
+    if not is_partitioned():
+        return [], [], None
+    today = today or datetime.date.today()
+    created = [month_start(today, n) for n in range(ahead + 1)
+               if create_partition(month_start(today, n))]
+    archived = []
+    default_archive = None
+    if directory is not None:
+        cutoff = month_start(today, -retain)
+        for month in partitions():
+            if month < cutoff:
+                archive_partition(month, directory)
+                archived.append(month)
+        default_archive = archive_default(cutoff, directory)
+    return created, archived, default_archive
@@ -0,0 +1,183 @@
+"""
+Event to daily UserAttributeData rollups.
+
+Events are bucketed into days in the owning user's timezone and combined
+with the aggregate for their attribute's value_type (Attribute.AGGREGATES).
+Only days that received events since the user's watermark are recomputed,
+and each of those days is recomputed from all of its events, so running a
+rollup twice is harmless. A recomputed day with no values left loses its
+UserAttributeData row.
+
+Events committed slightly out of order of their `created` stamp would be
+missed by a strict watermark, so the watermark only moves up to OVERLAP
+before each rollup, and remembers how many events after that it has
+already seen. A user needs rolling up again once that count changes.
+"""
+import datetime
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Attribute, RollupWatermark, User, UserAttribute, UserAttributeData
+
+# How long after its `created` stamp an event can take to commit.
+OVERLAP = datetime.timedelta(minutes=5)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def user_timezone(user):
+    try:
+        return pytz.timezone(user.timezone).zone
+    except (pytz.UnknownTimeZoneError, AttributeError):
+        return settings.TIME_ZONE
+
+
+def rollup_user(user):
+    """
+    Recompute the days touched by a user's events since the last rollup.
+    Returns (inserted, updated) UserAttributeData counts; emptied days
+    that are deleted count as neither.
+    """
+    if not isinstance(user, User):
+        user = User.objects.get(pk=user)
+    tz = user_timezone(user)
+    upper = timezone.now()
+    try:
+        since = user.rollup_watermark.rolled_up
+    except RollupWatermark.DoesNotExist:
+        since = EPOCH
+    settled = max(since, upper - OVERLAP)
+
+    # the days and the count of events after `settled` come from one
+    # statement, so they see the same events
+    cursor = connection.cursor()
+    cursor.execute("""
+                   WITH recent AS (
+                       SELECT COUNT(*) AS n
+                       FROM core_event
+                       WHERE user_id = %%(user)s AND created > %%(settled)s AND created <= %%(upper)s
+                   ), touched AS (
+                       SELECT DISTINCT attribute_id, (time AT TIME ZONE %%(tz)s)::date AS day
+                       FROM core_event
+                       WHERE user_id = %%(user)s AND created > %%(since)s AND created <= %%(upper)s
+                   ), days AS (
+                       SELECT e.attribute_id, a.value_type, t.day, %s AS value
+                       FROM core_event e
+                       JOIN touched t ON t.attribute_id = e.attribute_id
+                            AND (e.time AT TIME ZONE %%(tz)s)::date = t.day
+                       JOIN core_attribute a ON a.id = e.attribute_id
+                       WHERE e.user_id = %%(user)s
+                       AND e.time >= (SELECT MIN(day) FROM touched)::timestamp AT TIME ZONE %%(tz)s
+                       AND a.value_type != %%(string)s
+                       GROUP BY e.attribute_id, a.value_type, t.day
+                   )
+                   SELECT recent.n, days.attribute_id, days.value_type, days.day, days.value
+                   FROM recent LEFT JOIN days ON true
+                   """ % Attribute.aggregate_sql('a.value_type', 'e.value'),
+                   {'tz': tz, 'user': user.pk, 'since': since, 'settled': settled, 'upper': upper,
+                    'string': Attribute.STRING})
+    result = cursor.fetchall()
+    recent = result[0][0]
+    days = [row[1:] for row in result if row[1] is not None]
+
+    with transaction.atomic():
+        # a touched day whose events are all null now has no value
+        user_attributes = user_attributes_for(user, set(row[0] for row in days if row[3] is not None))
+        rows = []
+        emptied = {}
+        for attribute_id, value_type, day, value in days:
+            if value is None:
+                emptied.setdefault(attribute_id, []).append(day)
+                continue
+            if UserAttributeData.VALUE_FIELDS[value_type] == 'int_value':
+                value = int(round(value))
+            rows.append((user_attributes[attribute_id], day, value))
+        result = UserAttributeData.objects.bulk_upsert(rows) if rows else (0, 0)
+        if emptied:
+            q = Q()
+            for attribute_id, empty_days in emptied.items():
+                q |= Q(user_attribute__attribute=attribute_id, time__in=empty_days)
+            # deleted one at a time, so the correlation sums follow
+            UserAttributeData.objects.filter(q, user_attribute__user=user).delete()
+        RollupWatermark.objects.update_or_create(user=user, defaults={'rolled_up': settled, 'recent': recent})
+    return result
+
+
+def user_attributes_for(user, attribute_ids):
+    """
+    attribute id -> UserAttribute id, creating any the user doesn't have yet.
+    """
+    found = {}
+    for ua_id, attribute_id in UserAttribute.objects.filter(
+            user=user, attribute__in=attribute_ids).order_by('id').values_list('id', 'attribute_id'):
+        found.setdefault(attribute_id, ua_id)
+    for attribute in Attribute.objects.filter(id__in=attribute_ids - set(found)):
+        found[attribute.pk] = UserAttribute.objects.create(user=user, attribute=attribute,
+                                                           private=attribute.private_default).pk
+    return found
+
+
+# Per watermarked user, how many events there are since their watermark
+# (`since_mark`) and since %(settled)s (`after`). Only events since the
+# oldest watermark are read, through the index on `created`.
+EVENT_COUNTS_SQL = """
+    SELECT e.user_id, COUNT(*) AS since_mark, COUNT(*) FILTER (WHERE e.created > %(settled)s) AS after
+    FROM core_event e
+    JOIN core_rollupwatermark w ON w.user_id = e.user_id
+    WHERE e.created > (SELECT MIN(rolled_up) FROM core_rollupwatermark)
+    AND e.created > w.rolled_up
+    GROUP BY e.user_id
+"""
+
+
+def users_to_rollup():
+    """
+    Ids of users with events their last rollup didn't see, plus those who
+    have events but have never been rolled up.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+                   WITH counts AS (%s)
+                   SELECT counts.user_id
+                   FROM counts
+                   JOIN core_rollupwatermark w ON w.user_id = counts.user_id
+                   WHERE counts.since_mark <> w.recent
+                   UNION
+                   SELECT w.user_id
+                   FROM core_rollupwatermark w
+                   WHERE w.recent > 0 AND NOT EXISTS (SELECT 1 FROM counts WHERE counts.user_id = w.user_id)
+                   UNION
+                   SELECT u.id
+                   FROM core_user u
+                   WHERE NOT EXISTS (SELECT 1 FROM core_rollupwatermark w WHERE w.user_id = u.id)
+                   AND EXISTS (SELECT 1 FROM core_event e WHERE e.user_id = u.id)
+                   """ % EVENT_COUNTS_SQL, {'settled': EPOCH})
+    return [row[0] for row in cursor.fetchall()]
+
+
+def rollup_all():
+    """
+    Roll up every user with new events. Returns total (inserted, updated).
+    """
+    settled = timezone.now() - OVERLAP
+    inserted = updated = 0
+    for user in User.objects.filter(id__in=users_to_rollup()).iterator():
+        i, u = rollup_user(user)
+        inserted, updated = inserted + i, updated + u
+    # everyone else had nothing new, so their watermarks can move up too;
+    # that keeps the oldest one, which bounds users_to_rollup(), recent
+    cursor = connection.cursor()
+    cursor.execute("""
+                   WITH counts AS (%s)
+                   UPDATE core_rollupwatermark w
+                   SET rolled_up = %%(settled)s, recent = COALESCE(counts.after, 0)
+                   FROM core_rollupwatermark old
+                   LEFT JOIN counts ON counts.user_id = old.user_id
+                   WHERE w.user_id = old.user_id AND w.rolled_up < %%(settled)s
+                   AND COALESCE(counts.since_mark, 0) = w.recent
+                   """ % EVENT_COUNTS_SQL, {'settled': settled})
+    return inserted, updated
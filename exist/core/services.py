@@ -0,0 +1,75 @@
+"""
+Registry of service plugins: which concrete Profile model each Service
+slug uses.
+
+Plugins live in the top-level `services` package, one subpackage per slug
+with a Profile subclass in its models module, and are installed as apps
+(`services.<slug>` in INSTALLED_APPS) so their tables exist.
+autodiscover() runs once from CoreConfig.ready() and registers the models
+of installed plugins only; a subpackage that isn't installed has no table
+to load profiles from. register() also takes a dotted path, imported when
+it's first looked up.
+"""
+import importlib
+import threading
+
+_registry = {}  # slug -> model class, or 'module.Class' until imported
+_lock = threading.Lock()
+
+
+def register(slug, model):
+    """
+    Use `model` (a Profile subclass, or its dotted path) for `slug`.
+    """
+    _registry[slug] = model
+
+
+def get_model(slug):
+    """
+    The concrete Profile model for `slug`. Raises LookupError if there's no
+    such plugin.
+    """
+    try:
+        model = _registry[slug]
+    except KeyError:
+        raise LookupError("No service plugin for %r" % slug)
+    if isinstance(model, str):
+        with _lock:
+            model = _registry[slug]
+            if isinstance(model, str):
+                module, name = model.rsplit('.', 1)
+                model = _registry[slug] = getattr(importlib.import_module(module), name)
+    return model
+
+
+def slugs():
+    return sorted(_registry)
+
+
+def profile_accessors():
+    """
+    Reverse one-to-one names from Profile to each loaded concrete model,
+    for select_related().
+    """
+    from .models import Profile
+    accessors = []
+    for model in list(_registry.values()):
+        if isinstance(model, str) or model._meta.proxy:
+            continue
+        for parent, link in model._meta.parents.items():
+            if parent is Profile and link is not None:
+                accessors.append(link.related_query_name())
+    return sorted(accessors)
+
+
+def autodiscover():
+    from django.apps import apps
+    from .models import Profile
+
+    for app_config in apps.get_app_configs():
+        if not app_config.name.startswith('services.'):
+            continue
+        slug = app_config.name.split('.', 1)[1]
+        for model in app_config.get_models():
+            if issubclass(model, Profile) and model is not Profile:
+                register(slug, model)
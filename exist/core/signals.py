@@ -0,0 +1,67 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import (Attribute, AttributeGroup, Service, User, UserAttribute, UserAttributeData,
+                     CorrelationStatistic, Job, data_bulk_upserted)
+from .cache import (PROFILE_FIELDS, bump_user_version, bump_user_versions, bump_global_version,
+                    bump_profile_stamp)
+from . import catalog
+
+
+@receiver(post_save, sender=UserAttributeData)
+def data_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old = None if created else getattr(instance, '_stored_value', None)
+    if not created and not hasattr(instance, '_stored_value'):
+        # saved without having been loaded first, so we don't know what
+        # was there before; fall back to a full rebuild for this user
+        CorrelationStatistic.objects.rebuild_for_user(instance.user_attribute.user_id)
+    else:
+        CorrelationStatistic.objects.record_change(instance.user_attribute_id, instance.time,
+                                                   old, instance.value)
+    instance._stored_value = instance.value
+    bump_user_version(instance.user_attribute.user_id)
+
+
+@receiver(post_delete, sender=UserAttributeData)
+def data_deleted(sender, instance, **kwargs):
+    if hasattr(instance, '_stored_value'):
+        CorrelationStatistic.objects.record_change(instance.user_attribute_id, instance.time,
+                                                   instance._stored_value, None)
+    else:
+        CorrelationStatistic.objects.rebuild_for_user(instance.user_attribute.user_id)
+    bump_user_version(instance.user_attribute.user_id)
+
+
+@receiver(data_bulk_upserted)
+def data_bulk_upserted_handler(sender, user_ids, **kwargs):
+    # rebuilding is a full pass over the user's data, so leave it to core.jobs
+    Job.objects.enqueue(Job.CORRELATIONS, user_ids)
+    bump_user_versions(user_ids)
+
+
+@receiver(post_save, sender=UserAttribute)
+@receiver(post_delete, sender=UserAttribute)
+def user_attribute_changed(sender, instance, **kwargs):
+    bump_user_version(instance.user_id)
+
+
+@receiver(post_save, sender=Attribute)
+@receiver(post_delete, sender=Attribute)
+@receiver(post_save, sender=AttributeGroup)
+@receiver(post_delete, sender=AttributeGroup)
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+@receiver(m2m_changed, sender=Service.attributes.through)
+def catalog_changed(sender, **kwargs):
+    # other workers notice the new version when they next poll;
+    # this one reloads on next access
+    bump_global_version()
+    catalog.invalidate()
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and PROFILE_FIELDS.isdisjoint(update_fields)):
+        return
+    bump_profile_stamp(instance)
@@ -0,0 +1,284 @@
+"""
+Fetching data from external services for many Profiles at once.
+
+A service's concrete Profile model takes part by implementing:
+
+    sync_request(cursor)
+        The next request to make, as a SyncRequest, or None when there's
+        nothing to fetch. `cursor` is the profile's sync_cursor (None on
+        the first sync). A relative url is joined to the service's
+        BASE_URL.
+    sync_parse(data, cursor)
+        Turn the decoded JSON response into (events, next_cursor, more):
+        event dicts as core.ingest takes them, the cursor to store, and
+        whether to fetch another page straight away.
+
+SyncEngine runs every profile's pages as coroutines on one event loop.
+Requests to a service are capped at CONCURRENCY in flight and RATE per
+second (a token bucket allowing BURST at once). Failed requests that are
+worth retrying (connection errors, 429 and 5xx) back off exponentially
+with jitter. Each page's events and the new cursor are saved together, on
+the executor, so an interrupted sync resumes where it stopped. Events the
+ingester rejects are logged and listed in the SyncResult; the cursor still
+moves past them, as fetching the page again would only return them again.
+
+Configured by settings.SYNC; a service's entry in SYNC['SERVICES'] (by
+slug) overrides SYNC['DEFAULT'].
+"""
+import asyncio
+import json
+import logging
+import random
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .ingest import EventIngester
+from .models import Job, Profile
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'CONCURRENCY': 4,
+    'RATE': 5.0,
+    'BURST': 10,
+    'BASE_URL': None,
+    'TIMEOUT': 30.0,
+    'RETRIES': 4,
+    'BACKOFF': 1.0,
+    'MAX_BACKOFF': 60.0,
+    'MAX_PAGES': 100,
+}
+
+ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+
+
+class SyncRequest(namedtuple('SyncRequest', ['url', 'params', 'headers'])):
+    def __new__(cls, url, params=None, headers=None):
+        return super(SyncRequest, cls).__new__(cls, url, params or {}, headers or {})
+
+
+class SyncError(Exception):
+
+    def __init__(self, message, status=None, retryable=False, retry_after=None):
+        super(SyncError, self).__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+# rejected: (cursor the page was fetched from, index in the page, message)
+SyncResult = namedtuple('SyncResult', ['profile_id', 'pages', 'events', 'rejected', 'error'])
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens a second, holding at most `burst`.
+    """
+
+    def __init__(self, rate, burst, loop=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.loop = loop or asyncio.get_event_loop()
+        self.tokens = self.burst
+        self.updated = self.loop.time()
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @asyncio.coroutine
+    def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            yield from asyncio.sleep((1 - self.tokens) / self.rate, loop=self.loop)
+
+
+class ServiceLimiter(object):
+
+    def __init__(self, concurrency, rate, burst, loop=None):
+        self.semaphore = asyncio.Semaphore(concurrency, loop=loop)
+        self.bucket = TokenBucket(rate, burst, loop=loop)
+
+
+class HTTPClient(object):
+    """
+    JSON GETs with urllib, run on an executor so the loop never blocks.
+    """
+
+    def __init__(self, executor, loop=None, timeout=30.0):
+        self.executor = executor
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+
+    @asyncio.coroutine
+    def get_json(self, request, timeout=None):
+        return (yield from self.loop.run_in_executor(self.executor, self._get_json, request,
+                                                     timeout or self.timeout))
+
+    def _get_json(self, request, timeout):
+        url = request.url
+        if request.params:
+            url += ('&' if '?' in url else '?') + urllib.parse.urlencode(request.params)
+        headers = dict({'Accept': 'application/json'}, **request.headers)
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                        timeout=timeout) as response:
+                body = response.read()
+        except urllib.error.HTTPError as e:
+            retry_after = e.headers.get('Retry-After') if e.headers else None
+            raise SyncError("%s returned %d" % (request.url, e.code), status=e.code,
+                            retryable=e.code == 429 or e.code >= 500,
+                            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        except (urllib.error.URLError, OSError) as e:
+            raise SyncError("%s failed: %s" % (request.url, e), retryable=True)
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise SyncError("%s didn't return JSON" % request.url)
+
+
+def service_options(slug):
+    options = getattr(settings, 'SYNC', {})
+    return dict(DEFAULTS, **dict(options.get('DEFAULT', {}), **options.get('SERVICES', {}).get(slug, {})))
+
+
+class SyncEngine(object):
+
+    def __init__(self, loop=None, executor=None, client=None, threads=8):
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor or ThreadPoolExecutor(threads)
+        self.client = client or HTTPClient(self.executor, loop=self.loop)
+        self.limiters = {}
+
+    def limiter(self, slug):
+        if slug not in self.limiters:
+            options = service_options(slug)
+            self.limiters[slug] = ServiceLimiter(options['CONCURRENCY'], options['RATE'], options['BURST'],
+                                                 loop=self.loop)
+        return self.limiters[slug]
+
+    @asyncio.coroutine
+    def run_in_executor(self, function, *args):
+        return (yield from self.loop.run_in_executor(self.executor, self._in_thread, function, args))
+
+    def _in_thread(self, function, args):
+        try:
+            return function(*args)
+        finally:
+            close_old_connections()
+
+    @asyncio.coroutine
+    def fetch(self, slug, request):
+        """
+        The decoded response to `request`, retrying with jittered backoff.
+        """
+        options = service_options(slug)
+        if options['BASE_URL'] and '://' not in request.url:
+            request = request._replace(url=urllib.parse.urljoin(options['BASE_URL'], request.url))
+        limiter = self.limiter(slug)
+        attempt = 0
+        while True:
+            with (yield from limiter.semaphore):
+                yield from limiter.bucket.acquire()
+                try:
+                    return (yield from self.client.get_json(request, options['TIMEOUT']))
+                except SyncError as e:
+                    if not e.retryable or attempt >= options['RETRIES']:
+                        raise
+                    delay = e.retry_after
+            if delay is None:
+                # "full jitter": anywhere up to the exponential backoff
+                delay = random.uniform(0, min(options['MAX_BACKOFF'], options['BACKOFF'] * 2 ** attempt))
+            attempt += 1
+            logger.info("Retrying %s in %.1fs (attempt %d)", request.url, delay, attempt)
+            yield from asyncio.sleep(delay, loop=self.loop)
+
+    @asyncio.coroutine
+    def sync_profile(self, profile, concrete):
+        slug = profile.service.slug
+        options = service_options(slug)
+        ingester = EventIngester()
+        cursor = profile.sync_cursor
+        pages = events = 0
+        rejected = []
+        try:
+            while pages < options['MAX_PAGES']:
+                request = concrete.sync_request(cursor)
+                if request is None:
+                    break
+                data = yield from self.fetch(slug, request)
+                found, next_cursor, more = concrete.sync_parse(data, cursor)
+                inserted, errors = yield from self.run_in_executor(save_page, profile, ingester, found, next_cursor)
+                if errors:
+                    logger.warning("Sync of profile %s rejected %d events from cursor %r: %s",
+                                   profile.pk, len(errors), cursor, "; ".join(e for _, e in errors[:5]))
+                    rejected.extend((cursor, i, e) for i, e in errors)
+                events += inserted
+                cursor = next_cursor
+                pages += 1
+                if not more:
+                    break
+            yield from self.run_in_executor(mark_synced, profile, events)
+        except Exception as e:
+            logger.warning("Sync of profile %s failed: %s", profile.pk, e)
+            return SyncResult(profile.pk, pages, events, rejected, e)
+        return SyncResult(profile.pk, pages, events, rejected, None)
+
+    @asyncio.coroutine
+    def sync(self, profiles):
+        """
+        Sync `profiles` (a Profile queryset) concurrently; a SyncResult
+        for each.
+        """
+        pairs = yield from self.run_in_executor(load_profiles, profiles)
+        tasks = [ensure_future(self.sync_profile(profile, concrete), loop=self.loop) for profile, concrete in pairs]
+        if not tasks:
+            return []
+        return (yield from asyncio.gather(*tasks, loop=self.loop))
+
+    def run(self, profiles):
+        return self.loop.run_until_complete(self.sync(profiles))
+
+
+def load_profiles(profiles):
+    """
+    (profile, concrete profile) pairs for the enabled profiles whose
+    service can sync.
+    """
+    pairs = []
+    for profile in profiles.filter(enabled=True).with_concrete().select_related('user'):
+        concrete = profile.concrete
+        if hasattr(concrete, 'sync_request') and hasattr(concrete, 'sync_parse'):
+            pairs.append((profile, concrete))
+    return pairs
+
+
+def save_page(profile, ingester, events, cursor):
+    """
+    Write a page of events and move the profile's cursor past it, together.
+    Returns how many new events were written and the (index, message) of
+    each event the ingester rejected.
+    """
+    with transaction.atomic():
+        report = ingester.write_batch(list(events)) if events else None
+        Profile.objects.filter(pk=profile.pk).update(sync_cursor=cursor)
+    profile.sync_cursor = cursor
+    return (report.inserted, report.errors) if report is not None else (0, [])
+
+
+def mark_synced(profile, events):
+    profile.last_synced = timezone.now()
+    Profile.objects.filter(pk=profile.pk).update(last_synced=profile.last_synced)
+    if events:
+        Job.objects.enqueue(Job.ROLLUP, [profile.user_id])
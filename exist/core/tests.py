@@ -5,7 +5,44 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import asyncio
+import datetime
+import decimal
+import importlib
+import json
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import numpy as np
+from scipy import stats
+
+from exist import threadpool
+
+from .correlations import correlate_matrix, apply_offsets
+from .db import pool as db_pool
+from .db.pool import ConnectionPool, PoolTimeout
+from .ingest import EventIngester, ingest_jsonl
+from .jobs import Worker, get_options
+from .sync import SyncEngine, SyncError, SyncRequest
+from . import cache, catalog, history, jobs, logbuffer, partitions, rollups, services
+from .json_field import AS_TRANSFORMS, DateTrunc, JSONField, JsonAsInteger, JsonPath, LazyJSON
+from .logbuffer import UserLogBuffer, write_logs
+from .models import (Attribute, AttributeGroup, CorrelationStatistic, Event, Job, Profile, RollupWatermark,
+                     ScoreHistory, Service, User, UserAttribute, UserAttributeData, UserLog, UserLogDay)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +51,1146 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class CorrelationMatrixTest(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.matrix = rng.normal(size=(120, 3)) * [1, 1000, 5]
+        self.matrix[:, 2] = self.matrix[:, 0] * 3 + rng.normal(size=120)
+        self.matrix[rng.rand(120, 3) < 0.2] = np.nan
+
+    def test_matches_scipy_on_common_days(self):
+        r, r_p, rho, rho_p, n = correlate_matrix(self.matrix, [0, 0, 0])
+        both = ~np.isnan(self.matrix[:, 0]) & ~np.isnan(self.matrix[:, 2])
+        expected_r, expected_p = stats.pearsonr(self.matrix[both, 0], self.matrix[both, 2])
+        self.assertEqual(n[0, 2], both.sum())
+        self.assertAlmostEqual(r[0, 2], expected_r)
+        self.assertAlmostEqual(r_p[0, 2], expected_p)
+        self.assertAlmostEqual(r[0, 2], r[2, 0])
+
+    def test_spearman_ranks_common_days(self):
+        r, r_p, rho, rho_p, n = correlate_matrix(self.matrix, [0, 0, 0])
+        for i, j in [(0, 1), (0, 2), (1, 2)]:
+            both = ~np.isnan(self.matrix[:, i]) & ~np.isnan(self.matrix[:, j])
+            expected_rho, expected_p = stats.spearmanr(self.matrix[both, i], self.matrix[both, j])
+            self.assertAlmostEqual(rho[i, j], expected_rho)
+            self.assertAlmostEqual(rho[j, i], expected_rho)
+            self.assertAlmostEqual(rho_p[i, j], expected_p)
+
+    def test_offsets_shift_columns(self):
+        shifted = apply_offsets(self.matrix, [1, 0, -2])
+        np.testing.assert_array_equal(shifted[:-1, 0], self.matrix[1:, 0])
+        np.testing.assert_array_equal(shifted[2:, 2], self.matrix[:-2, 2])
+        self.assertTrue(np.isnan(shifted[-1, 0]))
+
+
+class CorrelationStatisticTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='tester')
+        self.day = datetime.date(2015, 6, 1)
+
+    def user_attribute(self, name, value_type):
+        attribute = Attribute.objects.create(name=name, label=name, value_type=value_type)
+        return UserAttribute.objects.create(user=self.user, attribute=attribute)
+
+    def add(self, user_attribute, value):
+        data = UserAttributeData(user_attribute=user_attribute, time=self.day,
+                                 value_type=user_attribute.attribute.value_type)
+        data.set_value(value)
+        data.save()
+        return data
+
+    def test_string_values_are_ignored(self):
+        mood = self.user_attribute('mood_note', Attribute.STRING)
+        self.user_attribute('steps', Attribute.INTEGER)
+        data = self.add(mood, 'fine')
+        data.string_value = 'better'
+        data.save()
+        data.delete()
+        self.assertFalse(CorrelationStatistic.objects.exists())
+
+    def test_retracting_leaves_zero_sums(self):
+        weight = self.user_attribute('weight', Attribute.FLOAT)
+        steps = self.user_attribute('steps', Attribute.INTEGER)
+        self.add(steps, 8000)
+        data = self.add(weight, 71.23456)
+        stat = CorrelationStatistic.objects.get()
+        self.assertEqual(stat.n, 1)
+        self.assertEqual(stat.sum_x * stat.sum_y, stat.sum_xy)
+
+        # retract through a fresh load too, which sees the rounded value
+        UserAttributeData.objects.get(pk=data.pk).delete()
+        stat = CorrelationStatistic.objects.get()
+        self.assertEqual(stat.n, 0)
+        for field in ('sum_x', 'sum_y', 'sum_xy', 'sum_xx', 'sum_yy'):
+            self.assertEqual(getattr(stat, field), 0, field)
+
+
+class LazyJSONTest(SimpleTestCase):
+    def test_decodes_on_first_access(self):
+        value = LazyJSON('{"a": 1.5, "b": [1, 2]}', {'parse_float': decimal.Decimal})
+        self.assertFalse(value.decoded)
+        self.assertEqual(value['a'], decimal.Decimal('1.5'))
+        self.assertTrue(value.decoded)
+        self.assertEqual(value, {'a': decimal.Decimal('1.5'), 'b': [1, 2]})
+        self.assertEqual(value.get('c', 3), 3)
+
+    def test_untouched_value_saves_raw_text(self):
+        field = JSONField(lazy=True)
+        raw = '{"b": 1, "a": 2.50}'
+        self.assertEqual(field.get_prep_value(LazyJSON(raw)), raw)
+
+    def test_changed_value_is_reencoded(self):
+        field = JSONField(lazy=True)
+        value = LazyJSON('{"a": 1}')
+        value['b'] = 2
+        self.assertEqual(json.loads(field.get_prep_value(value)), {'a': 1, 'b': 2})
+
+    def test_model_attribute_decodes_on_first_read(self):
+        field = Event._meta.get_field('meta')
+        raw = '{"source": "watch"}'
+        event = Event(meta=LazyJSON(raw))
+        self.assertEqual(field.pre_save(event, False), raw)
+        self.assertEqual(event.meta, {'source': 'watch'})
+        self.assertIsInstance(event.meta, dict)
+        self.assertEqual(json.dumps(event.meta), raw)
+        self.assertEqual(field.pre_save(event, False), {'source': 'watch'})
+        self.assertIsNone(Event(meta=LazyJSON('null')).meta)
+        self.assertIsNone(Event(meta=None).meta)
+
+    def test_fast_float(self):
+        field = JSONField(fast_float=True)
+        value = field.from_db_value('{"a": 1.5}', None, None, {})
+        self.assertIsInstance(value['a'], float)
+        self.assertIsInstance(JSONField(lazy=True).from_db_value('{"a": 1.5}', None, None, {}), LazyJSON)
+        self.assertEqual(JSONField().from_db_value({'a': 1}, None, None, {}), {'a': 1})
+
+
+class JsonPathTest(SimpleTestCase):
+    def test_parse(self):
+        path = JsonPath.parse("meta__sleep__start__as_int")
+        self.assertEqual(path.path, ["sleep", "start"])
+        self.assertIs(path.cast, JsonAsInteger)
+        self.assertEqual(path.name, "sleep_start")
+        self.assertEqual(JsonPath.parse("meta__place").cast.type, "text")
+
+    def test_rejects_unknown_types(self):
+        self.assertRaises(ValueError, JsonPath, "meta", "steps", "money")
+        self.assertRaises(ValueError, JsonPath.parse, "meta")
+        self.assertRaises(ValueError, DateTrunc, "fortnight", "time")
+
+
+def compact(sql):
+    # the same expression whether it's qualified with the table or not
+    return re.sub(r"\s+", "", sql).replace('"core_event".', "")
+
+
+class JsonIndexSQLTest(SimpleTestCase):
+    PATHS = [("sleep__start", "int"), ("day", "date"), ("at", "datetime")]
+
+    def index_sql(self, options):
+        field = JSONField(db_index=True, db_index_options=options)
+        field.set_attributes_from_name("meta")
+        return connection.SchemaEditorClass(connection)._create_jsonb_index_sql(Event, field)
+
+    def expression_sql(self, path, type):
+        query = Event.objects.all().query
+        sql, params = JsonPath("meta", path, type).resolve_expression(query).as_sql(
+            query.get_compiler(connection=connection), connection)
+        return sql
+
+    def test_index_sql(self):
+        typed, gin = self.index_sql([{"path": "sleep__start", "type": "int"}, {"only_contains": True}])
+        self.assertEqual(typed.split(" ON ", 1)[1],
+                         """"core_event" ((CAST("meta"->'sleep'->>'start' as integer)))""")
+        self.assertEqual(gin.split(" ON ", 1)[1], '"core_event" USING GIN ("meta" jsonb_path_ops)')
+
+    def test_expression_sql(self):
+        self.assertEqual(self.expression_sql("sleep__start", "int"),
+                         """CAST("core_event"."meta"->'sleep'->>'start' as integer)""")
+        self.assertEqual(self.expression_sql("day", "date"), """json_field_date("core_event"."meta"->>'day')""")
+        self.assertEqual(self.expression_sql("it's", "text"), """CAST("core_event"."meta"->>'it''s' as text)""")
+
+    def test_indexes_match_queries(self):
+        for use_tz in (True, False):
+            with self.settings(USE_TZ=use_tz):
+                indexes = self.index_sql([{"path": path, "type": type} for path, type in self.PATHS])
+                for (path, type), index in zip(self.PATHS, indexes):
+                    expression = compact(self.expression_sql(path, type))
+                    self.assertEqual(compact(index.split(" ON ", 1)[1]), '"core_event"((%s))' % expression)
+                    lookup = "meta__%s__as_%s" % (path, type)
+                    self.assertIn(expression, compact(str(Event.objects.filter(**{lookup: None}).query)))
+
+    def test_cast_functions_are_migrated(self):
+        migration = importlib.import_module("core.migrations.0010_json_field_casts")
+        created = " ".join(migration.FUNCTIONS)
+        for use_tz in (True, False):
+            with self.settings(USE_TZ=use_tz):
+                for transform in AS_TRANSFORMS.values():
+                    function = re.match(r"(\w+)\(", transform.cast_sql("x"))
+                    if function and function.group(1) != "CAST":
+                        self.assertIn("FUNCTION %s(text)" % function.group(1), created)
+
+
+class FakeConnection(object):
+    closed = 0
+
+    def get_transaction_status(self):
+        return 0
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def test_reuses_returned_connections(self):
+        pool = ConnectionPool(FakeConnection, max_size=2)
+        first = pool.getconn()
+        pool.putconn(first)
+        self.assertIs(pool.getconn(), first)
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_checkout_times_out_when_exhausted(self):
+        pool = ConnectionPool(FakeConnection, max_size=1, checkout_timeout=0.01)
+        pool.getconn()
+        self.assertRaises(PoolTimeout, pool.getconn)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_replaces_old_connections(self):
+        pool = ConnectionPool(FakeConnection, max_size=1, max_lifetime=0)
+        first = pool.getconn()
+        pool.putconn(first)
+        self.assertTrue(first.closed)
+        self.assertIsNot(pool.getconn(), first)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_closed_pool_closes_returned_connections(self):
+        pool = ConnectionPool(FakeConnection, max_size=2)
+        idle, out = pool.getconn(), pool.getconn()
+        pool.putconn(idle)
+        pool.close()
+        self.assertTrue(idle.closed)
+        pool.putconn(out)
+        self.assertTrue(out.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_new_params_replace_the_pool(self):
+        self.addCleanup(db_pool.close_pools, 'pool-test')
+        first = db_pool.get_pool('pool-test', {}, FakeConnection, params=(('dbname', 'exist'),))
+        connection = first.getconn()
+        first.putconn(connection)
+        self.assertIs(db_pool.get_pool('pool-test', {}, FakeConnection, params=(('dbname', 'exist'),)), first)
+        second = db_pool.get_pool('pool-test', {}, FakeConnection, params=(('dbname', 'test_exist'),))
+        self.assertIsNot(second, first)
+        self.assertTrue(connection.closed)
+
+        db_pool.close_pools('pool-test')
+        self.assertNotIn('pool-test', db_pool.stats())
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    A local stand-in for a service: fails the first request with a 503,
+    then echoes the query string back as JSON.
+    """
+    requests = 0
+
+    def do_GET(self):
+        StandInHandler.requests += 1
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if StandInHandler.requests == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({'path': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SyncFetchTest(SimpleTestCase):
+    def setUp(self):
+        StandInHandler.requests = 0
+        self.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.loop = asyncio.new_event_loop()
+        self.engine = SyncEngine(loop=self.loop, threads=2)
+        self.settings = override_settings(SYNC={'SERVICES': {'standin': {
+            'BASE_URL': 'http://127.0.0.1:%d/' % self.server.server_port,
+            'BACKOFF': 0.01, 'RETRIES': 2, 'RATE': 100, 'BURST': 5}}})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        self.loop.close()
+
+    def test_retries_server_errors(self):
+        data = self.loop.run_until_complete(self.engine.fetch('standin', SyncRequest('steps', {'since': '2015-01-01'})))
+        self.assertEqual(data, {'path': '/steps?since=2015-01-01'})
+        self.assertEqual(StandInHandler.requests, 2)
+
+    def test_client_errors_are_not_retried(self):
+        StandInHandler.requests = 1
+        with self.assertRaises(SyncError) as raised:
+            self.loop.run_until_complete(self.engine.fetch('standin', SyncRequest('missing')))
+        self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(StandInHandler.requests, 2)
+
+
+class StandInProfile(Profile):
+    """
+    A service plugin syncing from StandInHandler: page n (from ?page=n) has
+    one event on June n, and page 2 has a bad one too. The tests using it
+    create its table.
+    """
+    class Meta:
+        app_label = 'core'
+
+    def sync_request(self, cursor):
+        return SyncRequest('events', {'page': int(cursor or 0) + 1})
+
+    def sync_parse(self, data, cursor):
+        page = int(urllib.parse.parse_qs(urllib.parse.urlsplit(data['path']).query)['page'][0])
+        events = [{'user': self.user_id, 'attribute': 'steps', 'time': '2015-06-%02dT12:00:00Z' % page,
+                   'value': page}]
+        if page == 2:
+            events.append({'user': self.user_id, 'attribute': 'steps', 'time': 'soon'})
+        return events, str(page), page < 4
+
+
+class InlineExecutor(Executor):
+    """
+    Runs everything on the calling thread, so the engine's database writes
+    happen inside the test's transaction.
+    """
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class SyncEngineTest(TestCase):
+    def setUp(self):
+        with connection.schema_editor() as editor:
+            editor.create_model(StandInProfile)
+        services.register('standin', StandInProfile)
+        self.addCleanup(services._registry.pop, 'standin', None)
+
+        StandInHandler.requests = 0
+        self.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.loop = asyncio.new_event_loop()
+        self.engine = SyncEngine(loop=self.loop, executor=InlineExecutor())
+        self.settings = override_settings(SYNC={'SERVICES': {'standin': {
+            'BASE_URL': 'http://127.0.0.1:%d/' % self.server.server_port,
+            'BACKOFF': 0.01, 'RETRIES': 2, 'RATE': 100, 'BURST': 5, 'MAX_PAGES': 2}}})
+        self.settings.enable()
+
+        self.user = User.objects.create(username='syncer', email='syncer@example.com')
+        Attribute.objects.create(name='steps', label='Steps', value_type=Attribute.INTEGER)
+        service = Service.objects.create(name='Stand-in', slug='standin')
+        self.profile = StandInProfile.objects.create(user=self.user, service=service)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        self.loop.close()
+
+    def sync(self):
+        # closing connections would end the test's transaction
+        with mock.patch('core.sync.close_old_connections'):
+            return self.loop.run_until_complete(self.engine.sync(Profile.objects.all()))
+
+    def test_syncs_and_resumes(self):
+        [result] = self.sync()
+        self.assertIsNone(result.error)
+        self.assertEqual((result.pages, result.events), (2, 2))
+        self.assertEqual(result.rejected, [('1', 1, 'time must be an ISO 8601 datetime')])
+        profile = Profile.objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.sync_cursor, '2')
+        self.assertIsNotNone(profile.last_synced)
+        self.assertEqual(list(Event.objects.order_by('time').values_list('value', flat=True)), [1, 2])
+        self.assertTrue(Job.objects.filter(user=self.user, kind=Job.ROLLUP, state=Job.QUEUED).exists())
+
+        # picks up from page 3, and page 4 is the last
+        [result] = self.sync()
+        self.assertEqual((result.pages, result.events, result.rejected), (2, 2, []))
+        self.assertEqual(Profile.objects.get(pk=self.profile.pk).sync_cursor, '4')
+        self.assertEqual(list(Event.objects.order_by('time').values_list('value', flat=True)), [1, 2, 3, 4])
+
+    def test_with_concrete_loads_plugins_in_one_query(self):
+        self.assertEqual(services.profile_accessors(), ['standinprofile'])
+        with self.assertNumQueries(1):
+            [profile] = Profile.objects.with_concrete()
+            self.assertEqual(profile.concrete, self.profile)
+            self.assertIsInstance(profile.concrete, StandInProfile)
+
+    def test_failed_profiles_keep_their_cursor(self):
+        Profile.objects.filter(pk=self.profile.pk).update(sync_cursor='x')
+        [result] = self.sync()
+        self.assertIsInstance(result.error, ValueError)
+        self.assertEqual(result.pages, 0)
+        profile = Profile.objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.sync_cursor, 'x')
+        self.assertIsNone(profile.last_synced)
+
+
+class ServiceRegistryTest(SimpleTestCase):
+    def tearDown(self):
+        services._registry.pop('example', None)
+
+    def test_imports_plugins_on_first_lookup(self):
+        services.register('example', 'collections.OrderedDict')
+        self.assertEqual(services._registry['example'], 'collections.OrderedDict')
+        self.assertIs(services.get_model('example'), OrderedDict)
+        self.assertIs(services._registry['example'], OrderedDict)
+
+    def test_unknown_slug(self):
+        self.assertRaises(LookupError, services.get_model, 'example')
+
+    def test_autodiscover_registers_installed_plugins(self):
+        installed = mock.Mock(get_models=mock.Mock(return_value=[Service, StandInProfile]))
+        installed.name = 'services.example'
+        other = mock.Mock(get_models=mock.Mock(return_value=[StandInProfile]))
+        other.name = 'example'
+        with mock.patch('django.apps.apps.get_app_configs', return_value=[installed, other]), \
+                mock.patch.dict(services._registry, clear=True):
+            services.autodiscover()
+            self.assertEqual(services._registry, {'example': StandInProfile})
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username='user%d' % i, email='user%d@example.com' % i)
+                      for i in range(3)]
+
+    def test_enqueue_coalesces(self):
+        self.assertEqual(Job.objects.enqueue(Job.ROLLUP, self.users), (3, 0))
+        self.assertEqual(Job.objects.enqueue(Job.ROLLUP, self.users[:1]), (0, 1))
+        self.assertEqual(Job.objects.enqueue(Job.LATEST, self.users[:1]), (1, 0))
+        self.assertEqual(Job.objects.filter(state=Job.QUEUED).count(), 4)
+
+    def test_claim_respects_max_running(self):
+        Job.objects.enqueue(Job.ROLLUP, self.users)
+        self.assertEqual(len(Job.objects.claim(10, 2)), 2)
+        self.assertEqual(Job.objects.claim(10, 2), [])
+        self.assertEqual(Job.objects.filter(state=Job.RUNNING).count(), 2)
+
+    def test_failures_retry_with_backoff(self):
+        worker = Worker(dict(get_options(), MAX_ATTEMPTS=2, RETRY_DELAY=60))
+        Job.objects.enqueue(Job.ROLLUP, self.users[:1])
+        with mock.patch.dict(jobs.HANDLERS, {Job.ROLLUP: mock.Mock(side_effect=ValueError('boom'))}):
+            worker.run_job(Job.objects.claim(1, 1)[0])
+            retry = Job.objects.get(state=Job.QUEUED)
+            self.assertEqual(retry.attempts, 1)
+            self.assertEqual(retry.error, 'ValueError: boom')
+            # claims see the time the test's transaction started
+            self.assertGreater(retry.run_after, timezone.now() + datetime.timedelta(seconds=50))
+            self.assertEqual(Job.objects.claim(1, 1), [])
+
+            Job.objects.filter(pk=retry.pk).update(run_after=timezone.now() - datetime.timedelta(hours=1))
+            worker.run_job(Job.objects.claim(1, 1)[0])
+        self.assertFalse(Job.objects.filter(state=Job.QUEUED).exists())
+        self.assertEqual(Job.objects.filter(state=Job.FAILED).count(), 2)
+        self.assertEqual(worker.failed, 2)
+
+    def test_retry_defers_to_a_queued_job(self):
+        Job.objects.enqueue(Job.ROLLUP, self.users[:1])
+        job = Job.objects.claim(1, 1)[0]
+        Job.objects.enqueue(Job.ROLLUP, self.users[:1])
+        Job.objects.finish(job, error='boom', retry_after=60)
+        self.assertEqual(Job.objects.filter(state=Job.QUEUED).count(), 1)
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.FAILED)
+
+    def test_requeues_stale_jobs_once_per_user_and_kind(self):
+        started = timezone.now() - datetime.timedelta(hours=1)
+        for user in self.users[:2]:
+            Job.objects.create(user=user, kind=Job.ROLLUP, state=Job.RUNNING, started=started)
+        Job.objects.create(user=self.users[0], kind=Job.ROLLUP, state=Job.RUNNING, started=started)
+        Job.objects.create(user=self.users[2], kind=Job.ROLLUP, state=Job.RUNNING, started=timezone.now())
+        Job.objects.enqueue(Job.ROLLUP, self.users[1:2])
+
+        self.assertEqual(Job.objects.requeue_stale(60, 3), 1)
+        self.assertEqual(sorted(Job.objects.filter(state=Job.QUEUED).values_list('user_id', flat=True)),
+                         [self.users[0].pk, self.users[1].pk])
+        self.assertEqual(Job.objects.filter(state=Job.FAILED, error='stale').count(), 3)
+        self.assertEqual(Job.objects.filter(state=Job.RUNNING).count(), 1)
+
+    def test_stale_jobs_stop_at_max_attempts(self):
+        started = timezone.now() - datetime.timedelta(hours=1)
+        for user, attempts in zip(self.users, (1, 2, 3)):
+            Job.objects.create(user=user, kind=Job.ROLLUP, state=Job.RUNNING, started=started, attempts=attempts)
+        worker = Worker(dict(get_options(), STALE_AFTER=60, MAX_ATTEMPTS=3))
+        worker.maintain()
+        self.assertEqual(sorted(Job.objects.filter(state=Job.QUEUED).values_list('attempts', flat=True)), [1, 2])
+        self.assertEqual(Job.objects.filter(state=Job.FAILED).count(), 3)
+
+    def test_latest_needs_a_shared_cache(self):
+        with mock.patch('core.rollups.rollup_user'):
+            with override_settings(ATTRIBUTE_CACHE='default'):
+                jobs.rollup(self.users[0])
+            self.assertFalse(Job.objects.filter(kind=Job.LATEST).exists())
+            with override_settings(ATTRIBUTE_CACHE='shared'):
+                jobs.rollup(self.users[0])
+            self.assertTrue(Job.objects.filter(kind=Job.LATEST, user=self.users[0]).exists())
+
+    @override_settings(ATTRIBUTE_CACHE='shared')
+    def test_refresh_latest_warms_the_shared_cache(self):
+        user = self.users[0]
+        jobs.refresh_latest(user)
+        # only the version stamps are read
+        with self.assertNumQueries(1):
+            user.attributes.active()
+
+    def test_worker_survives_errors(self):
+        worker = Worker(dict(get_options(), POLL_INTERVAL=0))
+        # closing connections would end the test's transaction
+        with mock.patch('core.jobs.close_old_connections'), \
+                mock.patch.object(worker, 'run_once', side_effect=[DatabaseError('gone'), KeyboardInterrupt]):
+            self.assertRaises(KeyboardInterrupt, worker.run_forever)
+            self.assertEqual(worker.run_once.call_count, 2)
+
+
+class RollupTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='roller', email='roller@example.com', timezone='UTC')
+        self.steps = Attribute.objects.create(name='steps', label='Steps', value_type=Attribute.INTEGER)
+        self.noon = datetime.datetime(2015, 6, 1, 12, tzinfo=timezone.utc)
+
+    def event(self, user, hours, value):
+        return Event.objects.create(user=user, attribute=self.steps, value_type=Attribute.INTEGER,
+                                    time=self.noon + datetime.timedelta(hours=hours), value=value)
+
+    def test_rolls_up_days(self):
+        self.event(self.user, 0, 3)
+        self.event(self.user, 1, 4)
+        self.event(self.user, 24, 5)
+        self.assertEqual(rollups.rollup_user(self.user), (2, 0))
+        self.assertEqual(list(UserAttributeData.objects.order_by('time').values_list('time', 'int_value')),
+                         [(datetime.date(2015, 6, 1), 7), (datetime.date(2015, 6, 2), 5)])
+        self.assertEqual(rollups.rollup_user(self.user), (0, 0))
+
+    def test_days_without_values_are_cleared(self):
+        first = self.event(self.user, 0, 3)
+        self.event(self.user, 24, 5)
+        rollups.rollup_user(self.user)
+
+        Event.objects.filter(pk=first.pk).update(value=None, created=timezone.now())
+        rollups.rollup_user(self.user)
+        self.assertEqual(list(UserAttributeData.objects.values_list('time', 'int_value')),
+                         [(datetime.date(2015, 6, 2), 5)])
+
+    def test_floats_average(self):
+        weight = Attribute.objects.create(name='weight', label='Weight', value_type=Attribute.FLOAT)
+        for hours, value in ((0, 70), (1, 72)):
+            Event.objects.create(user=self.user, attribute=weight, value_type=Attribute.FLOAT,
+                                 time=self.noon + datetime.timedelta(hours=hours), value=value)
+        rollups.rollup_user(self.user)
+        self.assertEqual(UserAttributeData.objects.get().float_value, 71)
+
+    def test_users_to_rollup(self):
+        quiet = User.objects.create(username='quiet', email='quiet@example.com')
+        fresh = User.objects.create(username='fresh', email='fresh@example.com')
+        self.event(self.user, 0, 3)
+        self.event(fresh, 0, 1)
+        rollups.rollup_user(self.user)
+        hour_ago = timezone.now() - datetime.timedelta(hours=1)
+        RollupWatermark.objects.create(user=quiet, rolled_up=hour_ago)
+        self.assertEqual(rollups.users_to_rollup(), [fresh.pk])
+
+        self.event(self.user, 2, 4)
+        self.assertEqual(sorted(rollups.users_to_rollup()), [self.user.pk, fresh.pk])
+
+        rollups.rollup_all()
+        self.assertEqual(rollups.users_to_rollup(), [])
+        self.assertGreater(RollupWatermark.objects.get(user=quiet).rolled_up, hour_ago)
+
+    def test_late_events_are_rolled_up(self):
+        self.event(self.user, 0, 3)
+        rollups.rollup_user(self.user)
+        # committed after the rollup, but stamped a moment before it
+        self.event(self.user, 1, 4)
+        Event.objects.filter(value=4).update(created=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(rollups.users_to_rollup(), [self.user.pk])
+        rollups.rollup_user(self.user)
+        self.assertEqual(UserAttributeData.objects.get().int_value, 7)
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='historian', email='historian@example.com')
+        self.steps = self.user_attribute('steps', Attribute.INTEGER)
+        self.weight = self.user_attribute('weight', Attribute.FLOAT)
+        self.user_attribute('note', Attribute.STRING)
+        self.day = datetime.date(2015, 6, 1)
+        for offset, steps in ((0, 100), (1, 200), (4, 400)):
+            self.add(self.steps, offset, int_value=steps)
+        self.add(self.weight, 1, float_value=decimal.Decimal('70.5'))
+
+    def user_attribute(self, name, value_type):
+        attribute = Attribute.objects.create(name=name, label=name, value_type=value_type)
+        return UserAttribute.objects.create(user=self.user, attribute=attribute)
+
+    def add(self, user_attribute, offset, **value):
+        UserAttributeData.objects.create(user_attribute=user_attribute, value_type=user_attribute.attribute.value_type,
+                                         time=self.day + datetime.timedelta(days=offset), **value)
+
+    def test_loads_a_dense_matrix_in_chunks(self):
+        with mock.patch.object(history, 'CHUNK_SIZE', 2):
+            loaded = history.load_history(self.user)
+        self.assertEqual(loaded.start, self.day)
+        self.assertEqual([attribute.name for _, attribute in loaded.attributes], ['steps', 'weight'])
+        np.testing.assert_array_equal(loaded.column('steps'), [100, 200, np.nan, np.nan, 400])
+        np.testing.assert_array_equal(loaded.column('weight'), [np.nan, 70.5, np.nan, np.nan, np.nan])
+        self.assertEqual(loaded.dates[-1], np.datetime64(self.day + datetime.timedelta(days=4)))
+
+    def test_windows(self):
+        loaded = history.load_history(self.user, start=self.day + datetime.timedelta(days=1),
+                                      end=self.day + datetime.timedelta(days=2))
+        np.testing.assert_array_equal(loaded.matrix, [[200, 70.5], [np.nan, np.nan]])
+
+        # only the last two days count, and the matrix starts at the first value in them
+        loaded = history.load_history(self.user, [self.steps.pk], max_days=2)
+        self.assertEqual(loaded.start, self.day + datetime.timedelta(days=4))
+        np.testing.assert_array_equal(loaded.matrix, [[400]])
+
+    def test_no_data(self):
+        UserAttributeData.objects.all().delete()
+        self.assertEqual(history.load_history(self.user).matrix.shape, (0, 2))
+
+
+class LatestValuesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='latest', email='latest@example.com')
+        self.day = datetime.date(2015, 6, 1)
+
+    def user_attribute(self, name, value_type, *values):
+        attribute = Attribute.objects.create(name=name, label=name, value_type=value_type)
+        user_attribute = UserAttribute.objects.create(user=self.user, attribute=attribute)
+        for offset, value in enumerate(values):
+            data = UserAttributeData(user_attribute=user_attribute, value_type=value_type,
+                                     time=self.day + datetime.timedelta(days=offset))
+            data.set_value(value)
+            data.save()
+        return user_attribute
+
+    def test_values_in_one_query(self):
+        self.user_attribute('steps', Attribute.INTEGER, 100, 200)
+        self.user_attribute('weight', Attribute.FLOAT, decimal.Decimal('70.5'))
+        self.user_attribute('mood', Attribute.STRING, 'fine', 'good')
+        self.user_attribute('empty', Attribute.INTEGER)
+        with self.assertNumQueries(1):
+            values = [ua.value for ua in UserAttribute.objects.filter(user=self.user).order_by('id')
+                      .with_latest_values()]
+        self.assertEqual(values, [200, decimal.Decimal('70.5'), 'good', None])
+
+    def test_unknown_value_type(self):
+        user_attribute = self.user_attribute('steps', Attribute.INTEGER, 100)
+        UserAttributeData.objects.update(value_type=99)
+        self.assertIsNone(UserAttribute.objects.with_latest_values().get(pk=user_attribute.pk).value)
+
+
+@override_settings(ATTRIBUTE_CACHE='default')
+class CachedForUserTest(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.user = User.objects.create(username='cached', email='cached@example.com')
+        self.steps = Attribute.objects.create(name='steps', label='Steps')
+        self.user_attribute = UserAttribute.objects.create(user=self.user, attribute=self.steps)
+        self.data = UserAttributeData.objects.create(user_attribute=self.user_attribute, time=datetime.date(2015, 6, 1),
+                                                     value_type=Attribute.INTEGER, int_value=100)
+
+    def values(self):
+        return [ua.value for ua in self.user.attributes.active()]
+
+    def test_hit(self):
+        self.assertEqual(self.values(), [100])
+        # only the version stamps are read
+        with self.assertNumQueries(1):
+            self.assertEqual(self.values(), [100])
+
+    def test_data_changes_miss(self):
+        self.values()
+        self.data.int_value = 200
+        self.data.save()
+        self.assertEqual(self.values(), [200])
+        UserAttributeData.objects.bulk_upsert([(self.user_attribute, datetime.date(2015, 6, 2), 300)])
+        self.assertEqual(self.values(), [300])
+
+    def test_catalog_changes_miss(self):
+        self.values()
+        self.steps.label = 'Walking'
+        self.steps.save()
+        with self.assertNumQueries(2):
+            self.values()
+
+    def test_rolled_back_bumps_are_forgotten(self):
+        before = cache.versions(self.user.pk)
+        try:
+            with transaction.atomic():
+                cache.bump_user_version(self.user.pk)
+                bumped = cache.versions(self.user.pk)
+                raise DatabaseError
+        except DatabaseError:
+            pass
+        self.assertNotEqual(bumped, before)
+        self.assertEqual(cache.versions(self.user.pk), before)
+        # and the value it had is never handed out again
+        cache.bump_user_version(self.user.pk)
+        self.assertNotIn(cache.versions(self.user.pk), (before, bumped))
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        catalog.invalidate()
+        self.group = AttributeGroup.objects.create(name='activity', label='Activity')
+        self.steps = Attribute.objects.create(name='steps', label='Steps', group=self.group)
+
+    @override_settings(CATALOG_POLL_INTERVAL=0)
+    def test_version_change_rebuilds(self):
+        first = catalog.get_catalog()
+        self.assertIs(catalog.get_catalog(), first)
+        # as another process would: a change, then a bump when it commits
+        Attribute.objects.filter(pk=self.steps.pk).update(label='Walking')
+        self.assertIs(catalog.get_catalog(), first)
+        cache.bump_global_version()
+        rebuilt = catalog.get_catalog()
+        self.assertIsNot(rebuilt, first)
+        self.assertEqual(rebuilt.attribute(self.steps.pk).label, 'Walking')
+
+    @override_settings(CATALOG_POLL_INTERVAL=3600)
+    def test_polls_at_intervals(self):
+        first = catalog.get_catalog()
+        cache.bump_global_version()
+        with self.assertNumQueries(0):
+            self.assertIs(catalog.get_catalog(), first)
+
+    @override_settings(CATALOG_POLL_INTERVAL=3600)
+    def test_invalidate(self):
+        first = catalog.get_catalog()
+        catalog.invalidate()
+        self.assertIsNot(catalog.get_catalog(), first)
+
+    def test_changes_here_invalidate(self):
+        catalog.get_catalog()
+        self.steps.label = 'Walking'
+        self.steps.save()
+        self.assertEqual(catalog.attribute(self.steps.pk).label, 'Walking')
+
+    def test_hands_out_copies(self):
+        attribute = catalog.attribute(self.steps.pk)
+        attribute.label = 'Changed'
+        attribute.group.label = 'Changed'
+        attribute = catalog.attribute(self.steps.pk)
+        self.assertEqual((attribute.label, attribute.group.label), ('Steps', 'Activity'))
+        self.assertRaises(Attribute.DoesNotExist, catalog.attribute, self.steps.pk + 1000)
+
+
+class BulkUpsertTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='bulk', email='bulk@example.com')
+        self.steps = UserAttribute.objects.create(
+            user=self.user, attribute=Attribute.objects.create(name='steps', label='Steps'))
+        self.mood = UserAttribute.objects.create(
+            user=self.user, attribute=Attribute.objects.create(name='mood', label='Mood',
+                                                               value_type=Attribute.STRING))
+        self.day = datetime.date(2015, 6, 1)
+
+    def test_counts_inserts_updates_and_no_ops(self):
+        rows = [(self.steps, self.day, 100), (self.steps.pk, self.day, 150), (self.mood, self.day, 'good')]
+        self.assertEqual(UserAttributeData.objects.bulk_upsert(rows, batch_size=2), (2, 0))
+        self.assertEqual(UserAttributeData.objects.get(user_attribute=self.steps).int_value, 150)
+        self.assertEqual(UserAttributeData.objects.get(user_attribute=self.mood).string_value, 'good')
+
+        rows = [(self.steps, self.day, 150), (self.mood, self.day, 'better'),
+                (self.steps, self.day + datetime.timedelta(days=1), 80)]
+        self.assertEqual(UserAttributeData.objects.bulk_upsert(rows), (1, 1))
+        self.assertEqual(UserAttributeData.objects.bulk_upsert(rows), (0, 0))
+
+    def test_queues_correlations(self):
+        UserAttributeData.objects.bulk_upsert([(self.steps, self.day, 100)])
+        self.assertEqual(list(Job.objects.values_list('user_id', 'kind')), [(self.user.pk, Job.CORRELATIONS)])
+
+    def test_unknown_user_attributes(self):
+        rows = [(self.steps, self.day, 100), (self.steps.pk + 1000, self.day, 1)]
+        with self.assertRaisesRegex(ValueError, str(self.steps.pk + 1000)):
+            UserAttributeData.objects.bulk_upsert(rows)
+        self.assertFalse(UserAttributeData.objects.exists())
+
+
+class EventIngesterTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ingest', email='ingest@example.com')
+        self.steps = Attribute.objects.create(name='steps', label='Steps')
+        self.time = '2015-06-01T12:00:00Z'
+
+    def event(self, **fields):
+        return dict({'user': self.user.pk, 'attribute': 'steps', 'time': self.time, 'value': 10}, **fields)
+
+    def test_write_batch_counts(self):
+        batch = [
+            self.event(),
+            self.event(attribute=self.steps.pk, value=20),  # same key: the first one wins
+            self.event(time='2015-06-01T13:00:00', meta={'source': 'watch'}),
+            'not an event',
+            self.event(user=self.user.pk + 1000),
+            self.event(attribute='floors'),
+            self.event(time='yesterday'),
+            self.event(value='lots'),
+            self.event(value='NaN'),
+            self.event(meta=[1]),
+            self.event(value=10 ** 12),
+            self.event(value='1e40'),
+        ]
+        report = EventIngester().write_batch(batch)
+        self.assertEqual((report.received, report.inserted, report.duplicates), (12, 2, 1))
+        self.assertEqual([i for i, _ in report.errors], [3, 4, 5, 6, 7, 8, 9, 10, 11])
+        self.assertEqual(dict(report.errors)[5], "unknown attribute 'floors'")
+        self.assertEqual(dict(report.errors)[10], "value is out of range")
+
+        event = Event.objects.get(time=datetime.datetime(2015, 6, 1, 12, tzinfo=timezone.utc))
+        self.assertEqual((event.value, event.value_type), (10, Attribute.INTEGER))
+        # naive times are in the default timezone
+        event = Event.objects.get(time=timezone.make_aware(datetime.datetime(2015, 6, 1, 13),
+                                                           timezone.get_default_timezone()))
+        self.assertEqual(event.meta, {'source': 'watch'})
+        self.assertIsInstance(event.meta, dict)
+
+        report = EventIngester().write_batch(batch[:3])
+        self.assertEqual((report.inserted, report.duplicates, report.errors), (0, 3, []))
+
+    def test_values_round_to_four_places(self):
+        EventIngester().write_batch([self.event(value='999999999999.99994'), self.event(value='999999999999.99995',
+                                                                                         time='2015-06-02T12:00:00Z')])
+        self.assertEqual(list(Event.objects.values_list('value', flat=True)),
+                         [decimal.Decimal('999999999999.9999')])
+
+    def test_batches_json_lines(self):
+        lines = [json.dumps(self.event(time='2015-06-0%dT12:00:00Z' % day)) for day in range(1, 6)]
+        lines[1:1] = ['{"broken', '']
+        reports = list(ingest_jsonl(lines, batch_size=2))
+        self.assertEqual([report.received for report in reports], [2, 2, 2])
+        self.assertEqual(sum(report.inserted for report in reports), 5)
+        self.assertEqual(reports[0].errors, [(1, 'event must be an object')])
+        self.assertEqual(Event.objects.count(), 5)
+
+
+@mock.patch.object(UserLogBuffer, '_start')
+@mock.patch('core.logbuffer.write_logs')
+class ExecutorMonitorTest(SimpleTestCase):
+    def setUp(self):
+        self.app = mock.Mock(return_value=[b'ok'])
+        self.monitor = threadpool.ExecutorMonitor(self.app, max_queue=2, retry_after=7, thread_workers=5)
+        self.loop = mock.Mock()
+        patcher = mock.patch('exist.threadpool.get_event_loop', return_value=self.loop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.responses = []
+
+    def start_response(self, status, headers):
+        self.responses.append((status, dict(headers)))
+
+    def test_times_the_wait_for_a_thread(self):
+        environ = {}
+        with mock.patch('time.time', return_value=100.0):
+            self.monitor(environ, self.start_response)
+        self.loop.run_in_executor.assert_called_once_with(None, self.monitor.run, environ, self.start_response)
+        self.assertEqual(environ[threadpool.ENQUEUED_KEY], 100.0)
+        self.assertEqual(self.monitor.stats()['queued'], 1)
+
+        with mock.patch('time.time', side_effect=[100.5, 100.75]):
+            self.assertEqual(self.monitor.run(environ, self.start_response), [b'ok'])
+        self.assertEqual(self.monitor.stats(), {
+            'thread_workers': 5, 'active': 0, 'queued': 0, 'max_queue': 2, 'completed': 1, 'rejected': 0,
+            'wait_avg': 0.5, 'wait_max': 0.5, 'time_avg': 0.25, 'time_max': 0.25,
+        })
+
+    def test_rejects_before_queueing(self):
+        environs = [{}, {}]
+        for environ in environs:
+            self.monitor(environ, self.start_response)
+        self.assertEqual(self.monitor({}, self.start_response), [threadpool.UNAVAILABLE])
+        self.assertEqual(self.loop.run_in_executor.call_count, 2)
+        status, headers = self.responses[-1]
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertEqual(headers['Retry-After'], '7')
+        self.assertEqual(self.monitor.stats()['rejected'], 1)
+        self.assertFalse(self.app.called)
+
+        # a thread taking one frees a place
+        self.monitor.run(environs[0], self.start_response)
+        self.monitor({}, self.start_response)
+        self.assertEqual(self.loop.run_in_executor.call_count, 3)
+        self.assertEqual(self.monitor.stats()['queued'], 2)
+
+    def test_failed_requests_are_counted(self):
+        environ = {}
+        self.monitor(environ, self.start_response)
+        self.app.side_effect = ValueError
+        self.assertRaises(ValueError, self.monitor.run, environ, self.start_response)
+        stats = self.monitor.stats()
+        self.assertEqual((stats['active'], stats['queued'], stats['completed']), (0, 0, 1))
+
+
+class UserLogBufferTest(SimpleTestCase):
+    def buffer(self, policy='drop'):
+        return UserLogBuffer(max_size=2, flush_size=2, policy=policy)
+
+    def pages(self, logs):
+        return [log[2] for log in logs]
+
+    def test_drop(self, write_logs, start):
+        buffer = self.buffer()
+        self.assertEqual([buffer.append(1, page, 'view') for page in 'abc'], [True, True, False])
+        self.assertEqual(self.pages(buffer.logs), ['a', 'b'])
+        self.assertEqual(buffer.stats(), {'buffered': 2, 'flushed': 0, 'dropped': 1})
+        self.assertFalse(write_logs.called)
+
+    def test_drop_oldest(self, write_logs, start):
+        buffer = self.buffer('drop_oldest')
+        self.assertTrue(all(buffer.append(1, page, 'view') for page in 'abc'))
+        self.assertEqual(self.pages(buffer.logs), ['b', 'c'])
+        self.assertEqual(buffer.dropped, 1)
+
+    def test_flush_policy_blocks_to_make_room(self, write_logs, start):
+        buffer = self.buffer('flush')
+        self.assertTrue(all(buffer.append(1, page, 'view') for page in 'abc'))
+        self.assertEqual([self.pages(call[0][0]) for call in write_logs.call_args_list], [['a', 'b']])
+        self.assertEqual(self.pages(buffer.logs), ['c'])
+        self.assertEqual((buffer.flushed, buffer.dropped), (2, 0))
+
+    def test_full_batches_wake_the_flusher(self, write_logs, start):
+        buffer = self.buffer()
+        buffer.append(1, 'a', 'view')
+        self.assertFalse(buffer.wakeup.is_set())
+        buffer.append(1, 'b', 'view')
+        self.assertTrue(buffer.wakeup.is_set())
+
+    def test_flush_writes_batches(self, write_logs, start):
+        buffer = UserLogBuffer(max_size=10, flush_size=2)
+        for page in 'abcde':
+            buffer.append(1, page, 'view')
+        write_logs.side_effect = [None, DatabaseError, None]
+        with mock.patch.object(logbuffer.logger, 'exception'):
+            buffer.flush()
+        self.assertEqual([self.pages(call[0][0]) for call in write_logs.call_args_list],
+                         [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(buffer.stats(), {'buffered': 0, 'flushed': 3, 'dropped': 2})
+
+    def test_unknown_policy(self, write_logs, start):
+        self.assertRaises(ValueError, UserLogBuffer, policy='ignore')
+
+    def test_flushes_when_the_worker_stops(self, write_logs, start):
+        actor = mock.Mock()
+        buffer = self.buffer()
+        with mock.patch.object(logbuffer, 'get_buffer', return_value=buffer), \
+                mock.patch('pulsar.get_actor', return_value=actor):
+            self.assertTrue(logbuffer.flush_on_stop())
+        buffer.append(1, 'a', 'view')
+        event, callback = actor.bind_event.call_args[0]
+        self.assertEqual(event, 'stopping')
+        callback(actor)
+        self.assertEqual(self.pages(write_logs.call_args[0][0]), ['a'])
+
+
+class UserLogDayTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='logger', email='logger@example.com')
+        self.now = timezone.now()
+
+    def counts(self):
+        return sorted(UserLogDay.objects.values_list('page', 'action', 'count'))
+
+    def test_flushes_are_counted(self):
+        write_logs([(self.user.pk, self.now, 'home', 'view', None)] * 2 +
+                   [(self.user.pk, self.now, 'settings', 'view', 'tab=1')])
+        self.assertEqual(self.counts(), [('home', 'view', 2), ('settings', 'view', 1)])
+        write_logs([(self.user.pk, self.now, 'home', 'view', None)])
+        self.assertEqual(self.counts(), [('home', 'view', 3), ('settings', 'view', 1)])
+
+    def test_saved_logs_are_counted_by_recounting(self):
+        UserLog.objects.create(user=self.user, page='home', action='view')
+        # nothing extra on the request path
+        self.assertEqual(self.counts(), [])
+        out = StringIO()
+        call_command('userlog_days', stdout=out)
+        self.assertEqual(self.counts(), [('home', 'view', 1)])
+        call_command('userlog_days', stdout=out)
+        self.assertEqual(self.counts(), [('home', 'view', 1)])
+
+    def test_reports(self):
+        write_logs([(self.user.pk, self.now, 'home', 'view', None)] * 2 +
+                   [(self.user.pk, self.now, 'settings', 'view', 'tab=1')])
+        popular = list(UserLog.objects.most_popular_in_period(1))
+        self.assertTrue(all(isinstance(log, UserLog) for log in popular))
+        self.assertEqual([(log.page, log.action, log.log_count) for log in popular],
+                         [('home', 'view', 2), ('settings', 'view', 1)])
+        self.assertEqual([(user, user.log_count) for user in UserLog.objects.most_active_in_period(1)],
+                         [(self.user, 3)])
+        self.assertEqual(list(UserLog.objects.most_popular_in_period(10, 5)), [])
+
+
+class PartitionHelpersTest(SimpleTestCase):
+    def test_month_start(self):
+        day = datetime.date(2015, 12, 15)
+        self.assertEqual(partitions.month_start(day), datetime.date(2015, 12, 1))
+        self.assertEqual(partitions.month_start(day, 1), datetime.date(2016, 1, 1))
+        self.assertEqual(partitions.month_start(day, -12), datetime.date(2014, 12, 1))
+        self.assertEqual(partitions.month_start(datetime.date(2015, 1, 31), -1), datetime.date(2014, 12, 1))
+
+    def test_partition_name(self):
+        name = partitions.partition_name(datetime.date(2015, 3, 9))
+        self.assertEqual(name, 'core_userlog_p201503')
+        self.assertEqual(partitions.PARTITION_NAME.match(name).groups(), ('2015', '03'))
+        self.assertIsNone(partitions.PARTITION_NAME.match(partitions.DEFAULT_PARTITION))
+
+
+class UserLogPartitionsTest(TestCase):
+    def setUp(self):
+        if not partitions.is_partitioned():
+            self.skipTest("core_userlog is only partitioned on Postgres 11 and later")
+        self.user = User.objects.create(username='partitioned', email='partitioned@example.com')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def log(self, year, month):
+        # `created` is auto_now_add; updating it moves the row to its partition
+        log = UserLog.objects.create(user=self.user, page='home', action='view')
+        UserLog.objects.filter(pk=log.pk).update(created=datetime.datetime(year, month, 10, tzinfo=timezone.utc))
+        return log
+
+    def in_default(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT id FROM core_userlog_default ORDER BY id")
+        return [row[0] for row in cursor.fetchall()]
+
+    def test_create_partition_moves_rows_from_the_default(self):
+        log = self.log(2000, 2)
+        self.assertEqual(self.in_default(), [log.pk])
+        self.assertTrue(partitions.create_partition(datetime.date(2000, 2, 20)))
+        self.assertFalse(partitions.create_partition(datetime.date(2000, 2, 1)))
+        self.assertIn(datetime.date(2000, 2, 1), partitions.partitions())
+        self.assertEqual(self.in_default(), [])
+        self.assertEqual(UserLog.objects.get().pk, log.pk)
+
+    def test_command_archives_old_logs(self):
+        partitions.create_partition(datetime.date(2000, 1, 1))
+        archived = self.log(2000, 1)
+        stray = self.log(1999, 6)
+        kept = UserLog.objects.create(user=self.user, page='home', action='view')
+        out = StringIO()
+        call_command('userlog_partitions', archive_dir=self.directory, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertIn("archived partition for 2000-01", lines)
+        self.assertTrue(lines[-1].startswith("archived old rows of the default partition to "))
+
+        self.assertNotIn(datetime.date(2000, 1, 1), partitions.partitions())
+        self.assertEqual(list(UserLog.objects.values_list('id', flat=True)), [kept.pk])
+        with gzip.open(os.path.join(self.directory, 'core_userlog_p200001.csv.gz'), 'rt') as archive:
+            self.assertEqual(archive.read().splitlines()[1].split(',')[0], str(archived.pk))
+        with gzip.open(lines[-1].rsplit(' ', 1)[1], 'rt') as archive:
+            self.assertEqual(archive.read().splitlines()[1].split(',')[0], str(stray.pk))
+
+        # upcoming months are only created once
+        call_command('userlog_partitions', '--no-archive', stdout=StringIO())
+        out = StringIO()
+        call_command('userlog_partitions', '--no-archive', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+
+class ScoreData(object):
+    day = datetime.date(2015, 6, 1)
+
+    def create_scores(self):
+        steps = Attribute.objects.create(name='steps', label='Steps')
+        mood = Attribute.objects.create(name='mood', label='Mood', value_type=Attribute.STRING)
+        minor = Attribute.objects.create(name='minor', label='Minor', priority=10)
+        self.users = {}
+        for username, private, values in (('ann', False, [100]), ('bob', False, [50, 300]), ('cat', True, [100])):
+            user = self.users[username] = User.objects.create(username=username, email='%s@example.com' % username,
+                                                              private=private)
+            user_attribute = UserAttribute.objects.create(user=user, attribute=steps)
+            for offset, value in enumerate(values):
+                UserAttributeData.objects.create(user_attribute=user_attribute, value_type=Attribute.INTEGER,
+                                                 time=self.day + datetime.timedelta(days=offset), int_value=value)
+            for attribute, value in ((mood, {'string_value': 'fine'}), (minor, {'int_value': 1000})):
+                UserAttributeData.objects.create(
+                    user_attribute=UserAttribute.objects.create(user=user, attribute=attribute),
+                    value_type=attribute.value_type, time=self.day, **value)
+
+
+class ScoreHistoryTest(ScoreData, TestCase):
+    def setUp(self):
+        self.create_scores()
+        self.assertEqual(ScoreHistory.objects.compute_day(self.day), 3)
+
+    def scores(self, day):
+        return dict(ScoreHistory.objects.filter(day=day).values_list('user__username', 'score'))
+
+    def test_compute_day(self):
+        self.assertEqual(self.scores(self.day), {'ann': 100, 'bob': 50, 'cat': 100})
+        ScoreHistory.objects.compute_day(self.day + datetime.timedelta(days=1))
+        self.assertEqual(self.scores(self.day + datetime.timedelta(days=1)), {'ann': 100, 'bob': 300, 'cat': 100})
+
+    def test_recomputing_drops_users_without_a_score(self):
+        UserAttribute.objects.filter(user=self.users['ann']).update(active=False)
+        self.assertEqual(ScoreHistory.objects.compute_day(self.day), 2)
+        self.assertEqual(self.scores(self.day), {'bob': 50, 'cat': 100})
+
+    def test_leaderboard(self):
+        self.assertEqual([(row['rank'], row['username'], row['score'])
+                          for row in ScoreHistory.objects.leaderboard(self.day, public_only=False)],
+                         [(1, 'ann', 100), (1, 'cat', 100), (3, 'bob', 50)])
+        # private users are left out without closing up the ranks
+        self.assertEqual([(row['rank'], row['username']) for row in ScoreHistory.objects.leaderboard(self.day)],
+                         [(1, 'ann'), (3, 'bob')])
+        self.assertEqual([row['username'] for row in ScoreHistory.objects.leaderboard(
+            self.day, limit=1, offset=1, public_only=False)], ['cat'])
+
+    def test_percentile(self):
+        self.assertEqual(ScoreHistory.objects.percentile(self.users['bob'], self.day), 0.0)
+        self.assertAlmostEqual(ScoreHistory.objects.percentile(self.users['ann'].pk, self.day), 100.0 / 3)
+        self.assertIsNone(ScoreHistory.objects.percentile(self.users['ann'], self.day - datetime.timedelta(days=1)))
+
+    def test_distribution(self):
+        self.assertEqual(ScoreHistory.objects.distribution(self.day, (0.0, 0.5, 1.0)),
+                         OrderedDict([(0.0, 50), (0.5, 100), (1.0, 100)]))
+        self.assertEqual(ScoreHistory.objects.distribution(self.day - datetime.timedelta(days=1)), OrderedDict())
+
+
+class ScoreHistoryCommandTest(ScoreData, TransactionTestCase):
+    # days are computed on worker threads, each with its own connection,
+    # so the data has to be committed
+
+    def setUp(self):
+        self.create_scores()
+
+    def test_computes_each_day_in_the_range(self):
+        out = StringIO()
+        call_command('score_history', start='2015-06-01', end='2015-06-03', workers=2, stdout=out)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['2015-06-01: 3 users', '2015-06-02: 3 users', '2015-06-03: 3 users'])
+        self.assertEqual(ScoreHistory.objects.count(), 9)
+
+    def test_single_day_with_no_workers(self):
+        out = StringIO()
+        call_command('score_history', start='2015-06-02', workers=0, stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['2015-06-02: 3 users'])
+
+    def test_rejects_bad_ranges(self):
+        self.assertRaises(CommandError, call_command, 'score_history', start='2015-06-03', end='2015-06-01')
+        self.assertRaises(CommandError, call_command, 'score_history', start='June')
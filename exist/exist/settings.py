@@ -1,4 +1,5 @@
 # Django settings for exist project.
+import os
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -119,8 +120,9 @@ INSTALLED_APPS = (
     'django.contrib.admin',
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
-    'pulsar.apps.pulse',
+    # before pulsar.apps.pulse, whose pulse command core's replaces
     'core',
+    'pulsar.apps.pulse',
     
 )
 
@@ -164,5 +166,101 @@ REST_FRAMEWORK = {
 
 STATIC_ROOT = ''
 
+# 'shared' is seen by every process: create its table with
+# `manage.py createcachetable` (tests do this themselves). Memcached will do
+# as well once it's available.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'core_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+# Cache alias (from CACHES) holding per-user attribute lookups, see core.cache.
+# Must be shared between processes.
+ATTRIBUTE_CACHE = 'shared'
+ATTRIBUTE_CACHE_TIMEOUT = 60 * 60
+
+# How often (seconds) each worker checks whether its copy of the attribute,
+# group and service catalog is out of date, see core.catalog.
+CATALOG_POLL_INTERVAL = 30
+
+# Write-behind buffering for UserLog.objects.record(), see core.logbuffer.
+# POLICY is what happens when MAX_SIZE logs are waiting: 'drop' the new
+# log, 'drop_oldest', or 'flush' on the recording thread.
+USERLOG_BUFFER = {
+    'ENABLED': True,
+    'MAX_SIZE': 10000,
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 5.0,
+    'POLICY': 'drop',
+}
+
+# core_userlog is partitioned by month; `manage.py userlog_partitions`
+# archives partitions older than this many months to gzipped CSV here.
+USERLOG_RETENTION_MONTHS = 13
+USERLOG_ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   'archive', 'userlog')
+
+# `manage.py pulse` runs Django on each worker's executor, sized by
+# --thread-workers (default 5). Once MAX_QUEUE requests are waiting for a
+# thread, more get a 503 without being queued. See exist.threadpool.
+WSGI_EXECUTOR = {
+    'MAX_QUEUE': 50,
+    'RETRY_AFTER': 5,
+}
+
+# Background per-user jobs, see core.jobs. At most MAX_RUNNING run at once
+# across every `manage.py run_jobs` process.
+JOBS = {
+    'MAX_RUNNING': 4,
+    'BATCH_SIZE': 1,
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 60,
+    'STALE_AFTER': 15 * 60,
+    'KEEP_FINISHED': 24 * 60 * 60,
+}
+
+# Syncing profiles with their services, see core.sync. SERVICES overrides
+# DEFAULT per service slug; point BASE_URL at a local stand-in to test.
+SYNC = {
+    'DEFAULT': {
+        'CONCURRENCY': 4,
+        'RATE': 5.0,
+        'BURST': 10,
+        'RETRIES': 4,
+        'BACKOFF': 1.0,
+        'MAX_BACKOFF': 60.0,
+    },
+    'SERVICES': {},
+}
+
 
 from .local_settings import *
+
+# Pool connections per process (see core.db.pool). Connections go back to
+# the pool at the end of each request, so CONN_MAX_AGE stays 0. MAX_SIZE
+# should cover pulse's --thread-workers plus background threads. This comes
+# after local_settings so it covers a DATABASES defined there too; give
+# 'default' a POOL there to change these, or 'POOL': None to opt out.
+if (DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql_psycopg2'
+        and DATABASES['default'].get('POOL', {}) is not None):
+    DATABASES['default'].update({
+        'ENGINE': 'core.db.pooled',
+        'CONN_MAX_AGE': 0,
+    })
+    DATABASES['default'].setdefault('POOL', {
+        'MIN_SIZE': 1,
+        'MAX_SIZE': 12,
+        'CHECKOUT_TIMEOUT': 10.0,
+        'MAX_LIFETIME': 60 * 60,
+        'MAX_IDLE': 5 * 60,
+        'HEALTH_CHECK_AFTER': 5.0,
+    })
@@ -0,0 +1,146 @@
+"""
+Instrumentation and load shedding for the threads Django runs on under
+`manage.py pulse`.
+
+pulse runs the WSGI application on its event loop's executor, a pool of
+`--thread-workers` threads per worker process, so a slow request only
+holds up its own thread. ExecutorMonitor is what hands requests to that
+executor: on the event loop it stamps each request with the time it was
+queued and counts it as waiting, and on its thread it records how long it
+waited and how long Django took. When MAX_QUEUE requests are already
+waiting for a thread, the next one gets a 503 with Retry-After straight
+away, without being queued at all, which is cheap and drains the backlog,
+rather than a slow answer.
+
+pulsar's own pulse command puts its executor middleware around the
+application, so core's pulse command (core/management/commands/pulse.py)
+serves Wsgi below instead; it's pulsar 1.0.3's pulse.Wsgi with the
+monitor in place of that middleware, using only the loop's public
+run_in_executor. Under any other WSGI server requests don't go through
+here. Configured by settings.WSGI_EXECUTOR.
+"""
+import threading
+import time
+
+from django.conf import settings
+from pulsar import get_event_loop
+from pulsar.apps import pulse
+from pulsar.apps.wsgi import WsgiHandler, wait_for_body_middleware
+from pulsar.utils.importer import module_attribute
+
+DEFAULTS = {
+    'MAX_QUEUE': 50,
+    'RETRY_AFTER': 5,
+}
+
+UNAVAILABLE = b'Service temporarily overloaded, please retry.\n'
+
+ENQUEUED_KEY = 'exist.enqueued'
+
+
+class ExecutorMonitor(object):
+
+    def __init__(self, app, max_queue=50, retry_after=5, thread_workers=None):
+        self.app = app
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.thread_workers = thread_workers
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.time_total = 0.0
+        self.time_max = 0.0
+
+    def __call__(self, environ, start_response):
+        # on the event loop: queue the request for a thread, or turn it away
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                overloaded = True
+            else:
+                self.waiting += 1
+                overloaded = False
+        if overloaded:
+            return self.unavailable(start_response)
+        environ[ENQUEUED_KEY] = time.time()
+        return get_event_loop().run_in_executor(None, self.run, environ, start_response)
+
+    def run(self, environ, start_response):
+        # on an executor thread
+        started = time.time()
+        waited = started - environ[ENQUEUED_KEY]
+        with self.lock:
+            self.waiting -= 1
+            self.active += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        try:
+            return self.app(environ, start_response)
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+                self.time_total += elapsed
+                self.time_max = max(self.time_max, elapsed)
+
+    def unavailable(self, start_response):
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(UNAVAILABLE))),
+            ('Retry-After', str(self.retry_after)),
+        ])
+        return [UNAVAILABLE]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'thread_workers': self.thread_workers,
+                'active': self.active,
+                'queued': self.waiting,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_avg': self.wait_total / self.completed if self.completed else 0.0,
+                'wait_max': self.wait_max,
+                'time_avg': self.time_total / self.completed if self.completed else 0.0,
+                'time_max': self.time_max,
+            }
+
+
+_monitor = None
+
+
+def executor_monitor(app, thread_workers=None):
+    """
+    `app` wrapped in an ExecutorMonitor configured from settings.
+    """
+    global _monitor
+    options = dict(DEFAULTS, **getattr(settings, 'WSGI_EXECUTOR', {}))
+    _monitor = ExecutorMonitor(app, max_queue=options['MAX_QUEUE'], retry_after=options['RETRY_AFTER'],
+                               thread_workers=thread_workers)
+    return _monitor
+
+
+def stats():
+    """
+    This process's request thread stats, or None when requests aren't
+    monitored.
+    """
+    return _monitor.stats() if _monitor is not None else None
+
+
+class Wsgi(pulse.Wsgi):
+    """
+    pulse.Wsgi with requests handed to the executor by an ExecutorMonitor.
+    """
+
+    def setup(self, environ=None):
+        app = executor_monitor(module_attribute(settings.WSGI_APPLICATION),
+                               thread_workers=getattr(self.cfg, 'thread_workers', None))
+        # the third argument is `async`, a keyword in later Pythons
+        return WsgiHandler((wait_for_body_middleware, app), None, True)
@@ -21,16 +21,16 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "exist.settings")
 # file. This includes Django's development server, if the WSGI_APPLICATION
 # setting points here.
 from django.core.wsgi import get_wsgi_application
-from pulsar.apps import wsgi
+from core import logbuffer
 application = get_wsgi_application()
 
+# pulse imports this on the worker's own thread, the only place its
+# actor can be found; flush buffered UserLogs when the worker stops
+logbuffer.flush_on_stop()
+
 # Apply WSGI middleware here.
 #from helloworld.wsgi import HelloWorldApplication
 #application = HelloWorldApplication(application)
 
-middlewares = [
-    application,
-    wsgi.middleware.wait_for_body_middleware,
-]
-
-application = wsgi.handlers.WsgiHandler(middleware=middlewares) 
+# pulse runs this on its executor's threads (--thread-workers per worker),
+# handed over by exist.threadpool, which sheds load when they back up.